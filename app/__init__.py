@@ -13,7 +13,7 @@ from flask import Flask
 # Create Flask application
 app = Flask(__name__)
 
-from . import service
+from . import service, database
 
 # base directory of flask app
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # up one directory
@@ -38,11 +38,21 @@ SECRET_KEY = env('SECRET_KEY', 'Please, tell nobody... Shhhhh')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = SECRET_KEY
 app.config['LOGGING_LEVEL'] = logging.INFO
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+# send per request timings back in a Server-Timing header
+app.config['SERVER_TIMING'] = env.bool('SERVER_TIMING', False)
+# bearer token of the admin endpoints, which are turned off without one
+app.config['ADMIN_TOKEN'] = env('ADMIN_TOKEN', None)
 
 # Create Postgres connection string
 postgres_connection = 'postgres://{user}:{pw}@{host}/{db}'.format(user=DB_USER, pw=DB_PASSWORD, host=DB_HOST,
                                                                   db=DB_NAME)
 app.config['SQLALCHEMY_DATABASE_URI'] = postgres_connection
+# read replicas of the primary, with the same database name and credentials
+DB_REPLICA_HOSTS = env.list('DB_REPLICA_HOSTS', [])
+app.config['SQLALCHEMY_REPLICA_URIS'] = ['postgres://{user}:{pw}@{host}/{db}'.format(user=DB_USER, pw=DB_PASSWORD,
+                                                                                   host=host, db=DB_NAME)
+                                         for host in DB_REPLICA_HOSTS]
 
 # Set up logging for production
 print('Setting up logging for {}...'.format(__name__))
@@ -55,6 +65,8 @@ if __name__ != '__main__':
     else:
         service.initialize_logging()
 
-    service.init_db()  # make our sqlalchemy tables
+    # importing the app never connects to the database: connections are opened
+    # by the first request and the tables are created by `flask create-db`
+    database.init_app(app)
 
 app.logger.info('Logging established')
@@ -0,0 +1,130 @@
+"""
+Cache for serialized Orders
+The OrderCache keeps serialized Orders in a pluggable backend so that
+repeated reads of the same Order do not hit the database
+
+Backends
+--------
+CacheBackend - the interface a backend (e.g. a Redis client wrapper) must implement
+LRUCache - an in-process least recently used cache with a time to live (the default)
+
+Because the default backend lives in each worker process, an Order changed
+through one worker may be served stale by another until its entry expires,
+so keep ORDER_CACHE_TTL short or use a shared backend when running several workers
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+ORDER_CACHE_SIZE = int(os.getenv('ORDER_CACHE_SIZE', '1024'))
+ORDER_CACHE_TTL = float(os.getenv('ORDER_CACHE_TTL', '30'))
+
+
+class CacheBackend:
+    """ Interface for the storage behind an OrderCache """
+
+    def get(self, key):
+        """ Returns the value stored for key or None """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ Stores value for key """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Removes key if it is stored """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes every key """
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """ Thread safe in-process cache that evicts the least recently used entries and expired ones """
+
+    def __init__(self, max_size=ORDER_CACHE_SIZE, ttl=ORDER_CACHE_TTL, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class OrderCache:
+    """ Read-through cache of serialized Orders keyed by Order id """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else LRUCache()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, order_id, loader):
+        """ Returns the cached Order or calls loader() and caches the result if it is not None """
+        data = self.lookup(order_id)
+        if data is None:
+            data = loader()
+            if data is not None:
+                self.store(order_id, data)
+        return data
+
+    def lookup(self, order_id):
+        """ Returns the cached Order or None, counting the hit or miss """
+        data = self.backend.get(order_id)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def store(self, order_id, data):
+        """ Caches a serialized Order """
+        self.backend.set(order_id, data)
+
+    def invalidate(self, order_id):
+        """ Removes an Order from the cache """
+        self.backend.delete(order_id)
+
+    def invalidate_many(self, order_ids):
+        """ Removes Orders from the cache """
+        for order_id in order_ids:
+            self.backend.delete(order_id)
+
+    def clear(self):
+        """ Removes every Order from the cache """
+        self.backend.clear()
+
+    def stats(self):
+        """ Returns the hit and miss counters """
+        return {'hits': self.hits, 'misses': self.misses}
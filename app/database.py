@@ -0,0 +1,217 @@
+"""
+Database Engine Configuration for Orders Service
+Creates the SQLAlchemy object used by the models, builds its engine options
+from the environment, routes reads to replicas and reports the connection
+pool in the metrics
+
+Environment
+-----------
+DB_POOL_SIZE - connections kept open per process (default 5)
+DB_MAX_OVERFLOW - extra connections opened under load and closed afterwards (default 10)
+DB_POOL_TIMEOUT - seconds to wait for a free connection before failing (default 30)
+DB_POOL_RECYCLE - seconds after which a connection is replaced (default 1800)
+DB_POOL_PRE_PING - test connections before using them (default True)
+DB_STATEMENT_TIMEOUT - milliseconds after which Postgres cancels a statement, 0 for none (default 30000)
+DB_APPLICATION_NAME - the name of the connections in pg_stat_activity (default orders-service)
+
+Every process must use its own connections, so connections inherited from a
+parent process (e.g. gunicorn --preload) are discarded instead of being shared
+
+Read Replicas
+-------------
+When SQLALCHEMY_REPLICA_URIS lists replicas (see DB_REPLICA_HOSTS), the reads
+made inside db.replica() go to one of them, picked round-robin per session,
+i.e. per request. Everything else goes to the primary, and so does every read
+of a session once it has written (db.use_primary() does the same up front),
+so a request always reads its own writes. What a replica returns may be
+older than the last write, so it must not be cached (see GET /orders/<id>)
+"""
+import itertools
+import os
+import threading
+from contextlib import contextmanager
+
+from environs import Env
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import Pool
+
+from . import metrics
+
+env = Env()
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = env.bool('DB_POOL_PRE_PING', True)
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', '30000'))
+DB_APPLICATION_NAME = os.getenv('DB_APPLICATION_NAME', 'orders-service')
+
+
+def engine_options(database_uri):
+    """ Returns the SQLALCHEMY_ENGINE_OPTIONS for a database URI
+
+    SQLite keeps the defaults Flask-SQLAlchemy picks for it
+    """
+    if not make_url(database_uri).drivername.startswith('postgres'):
+        return {}
+    connect_args = {'application_name': DB_APPLICATION_NAME}
+    if DB_STATEMENT_TIMEOUT:
+        connect_args['options'] = '-c statement_timeout={}'.format(DB_STATEMENT_TIMEOUT)
+    return {'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_recycle': DB_POOL_RECYCLE,
+            'pool_pre_ping': DB_POOL_PRE_PING,
+            'connect_args': connect_args}
+
+
+class RoutingSession(SignallingSession):
+    """ A session that sends the reads made inside replica() to a read replica """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.db = db
+        self.primary_only = False
+        self._replica_depth = 0
+        self._replica_engine = None
+
+    @contextmanager
+    def replica(self):
+        """ Routes the reads made inside the block to a replica if there is one """
+        self._replica_depth += 1
+        try:
+            yield self
+        finally:
+            self._replica_depth -= 1
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._replica_depth and not self.primary_only and not self._flushing:
+            if self._replica_engine is None:
+                self._replica_engine = self.db.next_replica_engine(self.app)
+            if self._replica_engine is not None:
+                return self._replica_engine
+        return super().get_bind(mapper, clause)
+
+    @property
+    def reads_from_replica(self):
+        """ Checks if the reads of the session went to a replica """
+        return self._replica_engine is not None and not self.primary_only
+
+    def close(self):
+        super().close()
+        self.primary_only = False
+        self._replica_engine = None
+
+
+def _stick_to_primary(session, flush_context):
+    # the session has written, so its later reads must see the writes
+    session.primary_only = True
+
+
+event.listen(RoutingSession, 'after_flush', _stick_to_primary)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with sessions that can read from replicas """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._replicas = {}
+        self._replicas_lock = threading.Lock()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def replica(self):
+        """ Returns a context manager routing the reads of the current session to a replica """
+        return self.session().replica()
+
+    def use_primary(self):
+        """ Sends every later read of the current session to the primary """
+        self.session().primary_only = True
+
+    def reads_from_replica(self):
+        """ Checks if the reads of the current session went to a replica, which may lag behind the primary """
+        return self.session().reads_from_replica
+
+    def get_replica_engines(self, app):
+        """ Returns the engines of the replicas configured for app """
+        return self._replica_state(app)[1]
+
+    def next_replica_engine(self, app):
+        """ Returns the next replica engine in round-robin order, or None without replicas """
+        uris, engines, counter = self._replica_state(app)
+        return engines[next(counter) % len(engines)] if engines else None
+
+    def _replica_state(self, app):
+        uris = tuple(app.config.get('SQLALCHEMY_REPLICA_URIS') or ())
+        with self._replicas_lock:
+            state = self._replicas.get(app)
+            if state is None or state[0] != uris:
+                if state is not None:
+                    for engine in state[1]:
+                        engine.dispose()
+                state = (uris, [create_engine(uri, **engine_options(uri)) for uri in uris], itertools.count())
+                self._replicas[app] = state
+            return state
+
+
+# Create the SQLAlchemy object to be initialized later in init_db()
+db = RoutingSQLAlchemy()
+
+
+def dispose_engine(app):
+    """ Closes the pooled connections of app, e.g. in a process that was just forked """
+    db.get_engine(app).dispose()
+    for engine in db.get_replica_engines(app):
+        engine.dispose()
+
+
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    # a connection opened before a fork must not be used by both processes
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError('Connection opened by process {} was checked out by process {}'.format(
+            connection_record.info['pid'], pid))
+
+
+def _pool_connections():
+    """ Returns the number of connections of the pool by state """
+    pool = db.engine.pool
+    if not hasattr(pool, 'checkedout'):
+        return {}  # SQLite pools keep no counts
+    return {('checked_out',): pool.checkedout(),
+            ('idle',): pool.checkedin(),
+            ('overflow',): max(pool.overflow(), 0)}
+
+
+def _pool_size():
+    pool = db.engine.pool
+    return {(): pool.size()} if hasattr(pool, 'checkedout') else {}
+
+
+POOL_CONNECTIONS = metrics.REGISTRY.register(metrics.Gauge(
+    'orders_db_pool_connections', 'Connections of the database pool by state', ('state',), _pool_connections))
+POOL_SIZE = metrics.REGISTRY.register(metrics.Gauge(
+    'orders_db_pool_size', 'Connections the database pool keeps open', (), _pool_size))
+
+
+def init_app(app):
+    """ Configures the database of app from the environment and guards its pool against forks
+
+    Nothing connects to the database here: the engine is created and its
+    first connection opened by the first query, e.g. of the first request
+    """
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    db.init_app(app)
+    if not event.contains(Pool, 'connect', _remember_pid):
+        event.listen(Pool, 'connect', _remember_pid)
+        event.listen(Pool, 'checkout', _check_pid)
@@ -0,0 +1,195 @@
+"""
+Order Event Delivery for Orders Service
+Changes to Orders are recorded as OrderEvents in an outbox table in the same
+transaction as the change. An EventWorker running beside the web processes
+(see worker.py) delivers them in batches to a sink, so slow or unavailable
+downstream systems never add latency to the requests that change Orders
+
+Delivery is at least once: a batch that fails is retried with exponential
+backoff and may be sent again, so sinks should ignore event ids they have seen.
+The events of an Order are delivered in the order they were recorded: each
+one waits until the older events of the same Order are delivered
+
+Sinks
+-----
+EventSink - the interface a sink (e.g. a message queue producer) must implement
+FileSink - appends events as JSON lines to a local file (the default)
+HttpSink - POSTs batches of events as a JSON array to a URL
+"""
+import logging
+import os
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+from .models import OrderEvent, db
+from .serializers import dumps
+
+EVENT_SINK_URL = os.getenv('EVENT_SINK_URL')
+EVENT_SINK_PATH = os.getenv('EVENT_SINK_PATH', os.path.join('db', 'order_events.ndjson'))
+EVENT_BATCH_SIZE = int(os.getenv('EVENT_BATCH_SIZE', '100'))
+EVENT_MAX_ATTEMPTS = int(os.getenv('EVENT_MAX_ATTEMPTS', '10'))
+EVENT_RETRY_DELAY = float(os.getenv('EVENT_RETRY_DELAY', '1'))
+EVENT_MAX_RETRY_DELAY = float(os.getenv('EVENT_MAX_RETRY_DELAY', '300'))
+EVENT_POLL_INTERVAL = float(os.getenv('EVENT_POLL_INTERVAL', '1'))
+
+logger = logging.getLogger(__name__)
+
+
+class SinkBusyError(Exception):
+    """ Raised by a sink that asks to be called again later, without counting a failed attempt """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class EventSink:
+    """ Interface for the systems Order events are delivered to """
+
+    def send(self, events):
+        """ Delivers a batch of serialized events or raises an exception """
+        raise NotImplementedError
+
+
+class FileSink(EventSink):
+    """ Appends events to a file, one JSON document per line """
+
+    def __init__(self, path=EVENT_SINK_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, events):
+        lines = b''.join(dumps(event) + b'\n' for event in events)
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'ab') as sink_file:
+                sink_file.write(lines)
+
+
+class HttpSink(EventSink):
+    """ POSTs batches of events as a JSON array """
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, events):
+        http_request = urllib.request.Request(self.url, data=dumps(events), method='POST',
+                                              headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(http_request, timeout=self.timeout):
+                pass
+        except urllib.error.HTTPError as error:
+            if error.code in (429, 503):
+                retry_after = error.headers.get('Retry-After')
+                raise SinkBusyError('{} returned {}'.format(self.url, error.code),
+                                    float(retry_after) if retry_after and retry_after.isdigit() else None)
+            raise
+
+
+def sink_from_env():
+    """ Returns the HttpSink for EVENT_SINK_URL if it is set, otherwise the FileSink for EVENT_SINK_PATH """
+    if EVENT_SINK_URL:
+        return HttpSink(EVENT_SINK_URL)
+    return FileSink(EVENT_SINK_PATH)
+
+
+class EventDispatcher:
+    """ Delivers batches of pending OrderEvents to a sink and records the outcome """
+
+    def __init__(self, sink, batch_size=EVENT_BATCH_SIZE, max_attempts=EVENT_MAX_ATTEMPTS,
+                 retry_delay=EVENT_RETRY_DELAY, max_retry_delay=EVENT_MAX_RETRY_DELAY, clock=datetime.utcnow):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.clock = clock
+
+    def retry_delay_for(self, attempts):
+        """ Returns the seconds to wait before the next delivery of an event that failed attempts times """
+        return min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+
+    def dispatch_once(self):
+        """
+        Delivers one batch of due events
+        Returns:
+            the number of events delivered, 0 when there were none or the sink failed
+        Raises:
+            SinkBusyError: the sink asked to be called later, the events stay due
+        """
+        events = OrderEvent.pending(self.batch_size, self.max_attempts, self.clock())
+        if not events:
+            db.session.commit()
+            return 0
+        try:
+            self.sink.send([event.serialize() for event in events])
+        except SinkBusyError:
+            db.session.rollback()
+            raise
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning('Failed to deliver %d order events: %s', len(events), error)
+            now = self.clock()
+            for event in events:
+                event.attempts += 1
+                event.next_attempt_at = now + timedelta(seconds=self.retry_delay_for(event.attempts))
+                event.last_error = str(error)[:255]
+                if event.attempts >= self.max_attempts:
+                    logger.error('Giving up on order event %d after %d attempts', event.id, event.attempts)
+            db.session.commit()
+            return 0
+        OrderEvent.query.filter(OrderEvent.id.in_([event.id for event in events])) \
+            .update({'delivered_at': self.clock()}, synchronize_session=False)
+        db.session.commit()
+        return len(events)
+
+
+class EventWorker(threading.Thread):
+    """
+    Background thread that keeps dispatching events
+
+    Full batches are followed by the next one at once so a backlog drains at
+    the speed the sink accepts; otherwise the worker waits poll_interval.
+    Events of a failed batch are not due again until their own backoff has
+    passed, and when the sink is busy or the database fails the worker itself
+    backs off exponentially, or for as long as a busy sink asked
+    """
+
+    def __init__(self, app, dispatcher, poll_interval=EVENT_POLL_INTERVAL):
+        super().__init__(name='order-events', daemon=True)
+        self.app = app
+        self.dispatcher = dispatcher
+        self.poll_interval = poll_interval
+        self.failures = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        with self.app.app_context():
+            while not self._stopped.is_set():
+                self._stopped.wait(self.run_once())
+            db.session.remove()
+
+    def run_once(self):
+        """ Dispatches one batch and returns the seconds to wait before the next one """
+        try:
+            delivered = self.dispatcher.dispatch_once()
+        except SinkBusyError as error:
+            logger.info('Order event sink is busy: %s', error)
+            self.failures += 1
+            return error.retry_after or self.dispatcher.retry_delay_for(self.failures)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Order event dispatch failed')
+            db.session.rollback()
+            self.failures += 1
+            return self.dispatcher.retry_delay_for(self.failures)
+        self.failures = 0
+        return 0 if delivered >= self.dispatcher.batch_size else self.poll_interval
+
+    def stop(self, timeout=None):
+        """ Asks the worker to finish its current batch and waits for it """
+        self._stopped.set()
+        self.join(timeout)
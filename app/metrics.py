@@ -0,0 +1,221 @@
+"""
+Request Metrics for Orders Service
+Records per-route latency, SQL query count and time, response size and
+serialization time, exposed in the Prometheus text format by GET /metrics
+
+When SERVER_TIMING is enabled the same numbers for the current request are
+also sent back in a Server-Timing header. Streamed responses (e.g. NDJSON)
+query and serialize their rows while they are sent, so they are recorded
+when the response is closed and carry no Server-Timing header
+
+Metrics
+-------
+Histogram - counts of observations in cumulative buckets per set of labels
+Gauge - current values read from a callback when the metrics are rendered
+MetricsRegistry - the collection of metrics rendered by GET /metrics
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _format_labels(label_names, label_values):
+    """ Returns the {name="value",...} part of a sample line """
+    if not label_names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in label_values)
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in zip(label_names, escaped)) + '}'
+
+
+def _format_value(value):
+    """ Formats a sample value the way Prometheus expects """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """ Counts observations in cumulative buckets, kept per set of label values """
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """ Records one observation for the given label values """
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self._lock:
+            counts, total = self._series.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._series[key] = (counts, total + value)
+
+    def count(self, **labels):
+        """ Returns the number of observations for the given label values """
+        series = self._series.get(tuple(labels.get(name, '') for name in self.label_names))
+        return series[0][-1] if series else 0
+
+    def sum(self, **labels):
+        """ Returns the sum of the observations for the given label values """
+        series = self._series.get(tuple(labels.get(name, '') for name in self.label_names))
+        return series[1] if series else 0.0
+
+    def samples(self):
+        """ Returns the exposition lines of the histogram """
+        lines = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, counts):
+                    labels = _format_labels(self.label_names + ('le',), key + (_format_value(float(bound)),))
+                    lines.append('{}_bucket{} {}'.format(self.name, labels, count))
+                lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.label_names, key),
+                                                  _format_value(total)))
+                lines.append('{}_count{} {}'.format(self.name, _format_labels(self.label_names, key), counts[-1]))
+        return lines
+
+
+class Gauge:
+    """ Current values per set of label values, read from collect() on every render """
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, label_names=(), collect=dict):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.collect = collect
+
+    def samples(self):
+        """ Returns the exposition lines of the gauge """
+        return ['{}{} {}'.format(self.name, _format_labels(self.label_names, key), _format_value(value))
+                for key, value in sorted(self.collect().items())]
+
+
+class MetricsRegistry:
+    """ The metrics exposed by GET /metrics """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """ Adds a metric to the registry and returns it """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Returns all of the metrics in the Prometheus text exposition format """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.metric_type))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'orders_request_duration_seconds', 'Time spent handling requests',
+    ('method', 'route', 'status')))
+REQUEST_QUERIES = REGISTRY.register(Histogram(
+    'orders_request_db_queries', 'SQL statements executed per request',
+    ('method', 'route'), QUERY_COUNT_BUCKETS))
+REQUEST_QUERY_TIME = REGISTRY.register(Histogram(
+    'orders_request_db_duration_seconds', 'Time spent in SQL statements per request',
+    ('method', 'route')))
+RESPONSE_SIZE = REGISTRY.register(Histogram(
+    'orders_response_size_bytes', 'Size of response bodies',
+    ('method', 'route'), SIZE_BUCKETS))
+SERIALIZATION_TIME = REGISTRY.register(Histogram(
+    'orders_serialization_duration_seconds', 'Time spent serializing Orders per request',
+    ('method', 'route')))
+
+
+@contextmanager
+def timer(name):
+    """ Adds the time spent in the block to the named timing of the current request """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and hasattr(g, 'metrics_timings'):
+            g.metrics_timings[name] = g.metrics_timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the execution context, which is dropped with it when the statement fails
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    if has_request_context() and hasattr(g, 'metrics_queries'):
+        g.metrics_queries += 1
+        g.metrics_timings['db'] = g.metrics_timings.get('db', 0.0) + elapsed
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_timings = {}
+
+
+def _record_request(state, method, route, status_code):
+    """ Records the latency, queries and serialization time of a request from its g and returns the latency """
+    elapsed = time.perf_counter() - state.metrics_start
+    REQUEST_LATENCY.observe(elapsed, method=method, route=route, status=status_code)
+    REQUEST_QUERIES.observe(state.metrics_queries, method=method, route=route)
+    REQUEST_QUERY_TIME.observe(state.metrics_timings.get('db', 0.0), method=method, route=route)
+    if 'serialize' in state.metrics_timings:
+        SERIALIZATION_TIME.observe(state.metrics_timings['serialize'], method=method, route=route)
+    return elapsed
+
+
+def _finish_request(response, app):
+    if not hasattr(g, 'metrics_start'):
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    method = request.method
+    if response.is_streamed:
+        # the body is generated after this hook, in the request context kept by stream_with_context
+        state = g._get_current_object()
+        response.call_on_close(lambda: _record_request(state, method, route, response.status_code))
+        return response
+    elapsed = _record_request(g, method, route, response.status_code)
+    if response.content_length is not None:
+        RESPONSE_SIZE.observe(response.content_length, method=method, route=route)
+    if app.config.get('SERVER_TIMING'):
+        timings = ['app;dur={:.3f}'.format(elapsed * 1000),
+                   'db;dur={:.3f};desc="{} queries"'.format(g.metrics_timings.get('db', 0.0) * 1000,
+                                                            g.metrics_queries)]
+        if 'serialize' in g.metrics_timings:
+            timings.append('serialize;dur={:.3f}'.format(g.metrics_timings['serialize'] * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
+def init_app(app):
+    """ Starts recording metrics for every request handled by app """
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(lambda response: _finish_request(response, app))
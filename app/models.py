@@ -22,19 +22,86 @@ product_id (integer) - the id of product for this order item
 name (string) - name of the product for this order item
 quantity (integer) - quantity of the product for this order item
 price (float) - price of the product at the time of this order item
+
+
+OrderEvent - A change to an Order waiting in the outbox to be delivered to other systems
+
+Attributes:
+-----------
+order_id (integer) - id of the changed order, kept after the order is deleted
+event_type (string) - what happened, e.g. order.created
+payload (string) - JSON summary of the order when the event was recorded
+attempts (integer) - number of failed deliveries so far
+next_attempt_at (datetime) - when the event may next be delivered
+delivered_at (datetime) - when the event was delivered, null while pending
+
+
+ArchivedOrder, ArchivedOrderItem - Orders moved out of the order table by the
+retention job (see app.retention), with the same columns as Order and OrderItem
+plus archived_at
+
+
+OrderTombstone - the id of a deleted or archived Order, listed by the change feed
+
+Attributes:
+-----------
+order_id (integer) - id of the Order that was removed
+deleted_at (datetime) - when the Order was removed
+
+
+OrderRollup - the number of Orders and their revenue for a day and status,
+kept up to date by app.rollups
+
+Attributes:
+-----------
+day (date) - the day the orders were placed
+status (string) - status of the orders
+order_count (integer) - number of orders
+revenue (float) - sum of the order totals
 """
+import functools
+import json
 import logging
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from sqlalchemy import event, tuple_
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import aliased
+
+from . import schema
+from .database import db
+
+# Number of rows fetched per round-trip when streaming Orders
+STREAM_BATCH_SIZE = 500
+
+# Number of rows written per INSERT statement when bulk creating Orders
+BULK_INSERT_CHUNK_SIZE = 1000
 
-import dateutil.parser
-from flask_sqlalchemy import SQLAlchemy
+# Number of Orders whose status can be changed at once
+MAX_STATUS_CHANGES = 10000
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Columns of the serialized Order and OrderItem rows built without ORM objects
+ORDER_ROW_COLUMNS = ('id', 'customer_id', 'order_date', 'status', 'last_updated')
+ORDER_ITEM_ROW_COLUMNS = ('id', 'order_id', 'product_id', 'name', 'quantity', 'price')
+
+# The largest value of the INTEGER columns
+MAX_INTEGER = 2 ** 31 - 1
+
+CENT = Decimal('0.01')
 
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
-    pass
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+class StatusTransitionError(Exception):
+    """ Used when an Order may not move from its current status to another one """
 
 
 class OrderStatus:
@@ -44,6 +111,87 @@ class OrderStatus:
     DELIVERED = 'delivered'
     CANCELED = 'canceled'
 
+    ALL = (RECEIVED, PROCESSING, SHIPPED, DELIVERED, CANCELED)
+    # the statuses Orders never leave, so they can be archived
+    FINAL = (DELIVERED, CANCELED)
+
+    # the statuses an Order may move to from each status
+    TRANSITIONS = {RECEIVED: (PROCESSING, CANCELED),
+                   PROCESSING: (SHIPPED, CANCELED),
+                   SHIPPED: (DELIVERED,),
+                   DELIVERED: (),
+                   CANCELED: ()}
+
+    @classmethod
+    def sources(cls, target):
+        """ Returns the statuses an Order may move to target from """
+        return tuple(source for source in cls.ALL if target in cls.TRANSITIONS[source])
+
+    @classmethod
+    def check_transition(cls, order_id, source, target):
+        """ Raises StatusTransitionError unless an Order may move from source to target, or stay """
+        if source != target and target not in cls.TRANSITIONS.get(source, ()):
+            raise StatusTransitionError("Order with id '{}' cannot move from {} to {}.".format(
+                order_id, source, target))
+
+
+ORDER_ITEM_SCHEMA = schema.Schema(
+    required={'product_id': schema.integer(minimum=0, maximum=MAX_INTEGER),
+              'name': schema.string(max_length=63),
+              'quantity': schema.integer(minimum=1, maximum=MAX_INTEGER),
+              'price': schema.number(minimum=0)},
+    optional={'id': schema.integer(minimum=1, maximum=MAX_INTEGER)})
+
+ORDER_SCHEMA = schema.Schema(
+    required={'customer_id': schema.integer(minimum=0, maximum=MAX_INTEGER),
+              'status': schema.choice(OrderStatus.ALL),
+              'order_items': schema.list_of(ORDER_ITEM_SCHEMA)},
+    optional={'order_date': schema.iso_datetime})
+
+STATUS_CHANGE_SCHEMA = schema.Schema(
+    required={'ids': schema.list_of_values(schema.integer(minimum=1, maximum=MAX_INTEGER),
+                                           max_length=MAX_STATUS_CHANGES),
+              'status': schema.choice(OrderStatus.ALL)})
+
+
+def validate_order(data, partial=False):
+    """ Validates an Order payload and returns its converted values, raising every error at once """
+    clean, errors = ORDER_SCHEMA.validate(data, partial=partial)
+    if errors:
+        raise DataValidationError('Invalid order: ' + '; '.join(errors), errors)
+    return clean
+
+
+def validate_status_change(data):
+    """ Validates a status change payload and returns its converted values, raising every error at once """
+    clean, errors = STATUS_CHANGE_SCHEMA.validate(data)
+    if errors:
+        raise DataValidationError('Invalid status change: ' + '; '.join(errors), errors)
+    return clean
+
+
+def round_cents(amount):
+    """ Rounds an amount to cents half away from zero, the way round_cents_sql() does in Postgres
+
+    Postgres converts a double to numeric through its 15 significant digits,
+    so the amount is converted the same way before it is rounded
+    """
+    return float(Decimal('{:.15g}'.format(amount)).quantize(CENT, rounding=ROUND_HALF_UP))
+
+
+def round_cents_sql(amount):
+    """ Returns a SQL expression rounding an amount to cents, e.g. the total of an item """
+    return db.func.round(db.cast(amount, db.Numeric), 2)
+
+
+def replica_read(func):
+    """ Runs a read-only query method on a read replica when one is configured """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with db.replica():
+            return func(*args, **kwargs)
+    return wrapper
+
 
 class Order(db.Model):
     """
@@ -58,33 +206,64 @@ class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, nullable=False)
     order_date = db.Column(db.DateTime, server_default=db.func.now())
-    last_updated = db.Column(db.DateTime, server_default=db.func.now(), server_onupdate=db.func.now())
+    last_updated = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
     status = db.Column(db.String(63), nullable=False)
     order_items = db.relationship('OrderItem', backref='order', lazy='dynamic', passive_deletes=True)
 
+    __table_args__ = (
+        db.Index('ix_order_order_date_id', 'order_date', 'id'),
+        db.Index('ix_order_status_order_date', 'status', 'order_date'),
+        # a customer's history newest first; status and last_updated make it covering
+        # for the order rows, so a page can be read from the index alone
+        db.Index('ix_order_customer_id_order_date', customer_id, order_date.desc(), id.desc(), status, last_updated),
+        # the change feed pages through the Orders by (last_updated, id)
+        db.Index('ix_order_last_updated_id', 'last_updated', 'id'),
+    )
+
     def __repr__(self):
         return '<Order: %d - Ordered on: %s>' % (self.id, self.order_date)
 
-    def save(self):
+    def save(self, event_type=None):
         """
         Saves an Order to the data store
+        Args:
+            event_type (string): an OrderEvent type recorded in the same transaction
         """
         if not self.id:
             db.session.add(self)
+        else:
+            # item changes don't touch the order row, so bump last_updated explicitly
+            self.last_updated = db.func.now()
+        if event_type:
+            OrderEvent.record(self, event_type)
         db.session.commit()
 
-    def delete(self):
+    def delete(self, event_type=None):
         """ Removes an Order from the data store """
+        if event_type:
+            OrderEvent.record(self, event_type)
+        OrderRollupChange.mark([self.order_date])
+        OrderTombstone.record([self.id])
         db.session.delete(self)
         db.session.commit()
 
     def serialize(self):
         """ Serializes an Order into a dictionary """
+        order_items = list(self.get_order_items())
         return {"id": self.id,
                 "customer_id": self.customer_id,
                 "order_date": self.order_date.isoformat() if self.order_date else self.order_date,
                 "status": self.status,
-                "order_items": [order_item.serialize() for order_item in self.order_items]}
+                "last_updated": self.last_updated.isoformat() if self.last_updated else self.last_updated,
+                "total": round(sum(order_item.total for order_item in order_items), 2),
+                "order_items": [order_item.serialize() for order_item in order_items]}
+
+    def get_order_items(self):
+        """ Returns the preloaded order items if available, otherwise queries them """
+        loaded_items = self.__dict__.get('_loaded_order_items')
+        if loaded_items is None:
+            return self.order_items
+        return loaded_items
 
     def deserialize(self, data):
         """
@@ -92,25 +271,157 @@ class Order(db.Model):
         Args:
             data (dict): A dictionary containing the Order data
         """
-        try:
-            self.customer_id = data['customer_id']
-            self.status = data['status']
-            if 'order_date' in data and data['order_date']:
-                self.order_date = dateutil.parser.parse(data['order_date'])
-            for order_item in data['order_items']:
-                self.order_items.append(OrderItem(product_id=order_item['product_id'],
-                                                  name=order_item['name'],
-                                                  quantity=order_item['quantity'],
-                                                  price=float(order_item['price'])))
-        except KeyError as error:
-            raise DataValidationError('Invalid order: missing ' + error.args[0])
-        except TypeError:
-            raise DataValidationError('Invalid order: body of request contained bad or no data')
+        data = validate_order(data)
+        self.customer_id = data['customer_id']
+        self.status = data['status']
+        self.__dict__.pop('_loaded_order_items', None)
+        if 'order_date' in data:
+            self.order_date = data['order_date']
+        self.order_items.extend([OrderItem(product_id=order_item['product_id'],
+                                           name=order_item['name'],
+                                           quantity=order_item['quantity'],
+                                           price=order_item['price']) for order_item in data['order_items']])
         return self
 
+    def update(self, data, partial=False):
+        """
+        Updates a saved Order from a dictionary, only changing what differs
+
+        Incoming items are matched to the existing ones by id, then by
+        product_id; matched items are updated in place, new ones are inserted
+        and existing items that were not matched are deleted in one statement
+        Args:
+            data (dict): A dictionary containing the Order data
+            partial (bool): only update the fields present in data (PATCH)
+        Raises:
+            StatusTransitionError: the status may not move to the new one (see OrderStatus.TRANSITIONS)
+        """
+        data = validate_order(data, partial=partial)
+        if 'status' in data:
+            OrderStatus.check_transition(self.id, self.status, data['status'])
+        if self.order_date and data.get('order_date', self.order_date) != self.order_date:
+            OrderRollupChange.mark([self.order_date])  # the rollup of the old day loses the Order
+        for field in ('customer_id', 'status', 'order_date'):
+            if field in data:
+                setattr(self, field, data[field])
+        if 'order_items' in data:
+            self._merge_order_items(data['order_items'])
+        return self
+
+    def _merge_order_items(self, items_data):
+        """ Applies a full list of items as inserts, updates and deletes of the existing items """
+        self.__dict__.pop('_loaded_order_items', None)
+        remaining = {order_item.id: order_item for order_item in self.order_items}
+        matches = [remaining.pop(item_data.get('id'), None) for item_data in items_data]
+        by_product = defaultdict(list)
+        for order_item in remaining.values():
+            by_product[order_item.product_id].append(order_item)
+
+        new_items = []
+        for item_data, order_item in zip(items_data, matches):
+            if order_item is None and by_product[item_data['product_id']]:
+                order_item = by_product[item_data['product_id']].pop(0)
+                del remaining[order_item.id]
+            if order_item is None:
+                new_items.append(OrderItem(product_id=item_data['product_id'],
+                                           name=item_data['name'],
+                                           quantity=item_data['quantity'],
+                                           price=item_data['price']))
+            else:
+                order_item.product_id = item_data['product_id']
+                order_item.name = item_data['name']
+                order_item.quantity = item_data['quantity']
+                order_item.price = item_data['price']
+        self.order_items.extend(new_items)
+
+        if remaining:
+            OrderItem.query.filter(OrderItem.id.in_(list(remaining))).delete(synchronize_session=False)
+
+    @classmethod
+    def bulk_create(cls, orders, chunk_size=BULK_INSERT_CHUNK_SIZE, event_type=None):
+        """ Inserts many deserialized Orders and their items in a single transaction
+
+        Rows are written with multi-row INSERT statements of at most chunk_size
+        rows, so creating N Orders takes a handful of round-trips instead of
+        one per Order and one per OrderItem.
+        Args:
+            orders (list): unsaved Orders built with deserialize()
+            event_type (string): an OrderEvent type recorded for every Order
+        Returns:
+            the list of new Order ids in the same order as orders
+        """
+        cls.logger.info('Bulk creating %d Orders', len(orders))
+        order_table = cls.__table__
+        item_table = OrderItem.__table__
+        order_ids = []
+        try:
+            for start in range(0, len(orders), chunk_size):
+                chunk = orders[start:start + chunk_size]
+                order_rows = [{'customer_id': order.customer_id,
+                               'status': order.status,
+                               'order_date': order.order_date or db.func.now()} for order in chunk]
+                result = db.session.execute(order_table.insert().values(order_rows).returning(order_table.c.id))
+                chunk_ids = [row[0] for row in result]
+                order_ids.extend(chunk_ids)
+
+                item_rows = [{'order_id': order_id,
+                              'product_id': order_item.product_id,
+                              'name': order_item.name,
+                              'quantity': order_item.quantity,
+                              'price': order_item.price}
+                             for order_id, order in zip(chunk_ids, chunk)
+                             for order_item in order.get_order_items()]
+                for item_start in range(0, len(item_rows), chunk_size):
+                    db.session.execute(item_table.insert().values(item_rows[item_start:item_start + chunk_size]))
+                if event_type:
+                    event_rows = [OrderEvent.row(order_id, order, event_type)
+                                  for order_id, order in zip(chunk_ids, chunk)]
+                    db.session.execute(OrderEvent.__table__.insert().values(event_rows))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return order_ids
+
+    @classmethod
+    def change_status(cls, order_ids, target, event_type=None):
+        """ Moves many Orders to a status with one UPDATE statement
+
+        Only the Orders whose current status may move to target (see
+        OrderStatus.TRANSITIONS) are changed; the database checks the status of
+        each row as it updates it, so concurrent changes cannot skip a state
+        Args:
+            order_ids (list): ids of the Orders to change
+            target (string): the new OrderStatus
+            event_type (string): an OrderEvent type recorded for every changed Order
+        Returns:
+            the sorted list of the ids of the Orders that were changed
+        """
+        cls.logger.info('Changing the status of %d Orders to %s', len(order_ids), target)
+        sources = OrderStatus.sources(target)
+        if not order_ids or not sources:
+            return []
+        order_table = cls.__table__
+        try:
+            result = db.session.execute(
+                order_table.update()
+                .where(order_table.c.id.in_(order_ids))
+                .where(order_table.c.status.in_(sources))
+                .values(status=target, last_updated=db.func.now())
+                .returning(order_table.c.id, order_table.c.customer_id, order_table.c.status))
+            rows = sorted(result, key=lambda row: row.id)
+            if event_type and rows:
+                db.session.execute(OrderEvent.__table__.insert().values(
+                    [OrderEvent.row(row.id, row, event_type) for row in rows]))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return [row.id for row in rows]
+
     @classmethod
     def init_db(cls, app):
-        """ Initializes the database session """
+        """ Initializes the database session and creates the tables, for local runs and tests """
         cls.logger.info('Initializing database')
         cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
@@ -120,24 +431,121 @@ class Order(db.Model):
 
     @property
     def total(self):
-        order_total = 0
-        for order_item in self.order_items:
-            order_total += order_item.total
-        return order_total
+        """ Returns the sum of the item totals, computed by the database for saved Orders """
+        if self.id is None or '_loaded_order_items' in self.__dict__:
+            return round(sum(order_item.total for order_item in self.get_order_items()), 2)
+        return Order.totals([self.id]).get(self.id, 0)
+
+    @staticmethod
+    @replica_read
+    def totals(order_ids):
+        """ Returns a dictionary of Order id to Order total, the sum of the item totals, computed with one query """
+        if not order_ids:
+            return {}
+        rows = db.session.query(OrderItem.order_id, db.func.sum(OrderItem.total)) \
+            .filter(OrderItem.order_id.in_(order_ids)) \
+            .group_by(OrderItem.order_id)
+        return {order_id: round(float(order_total), 2) for order_id, order_total in rows}
+
+    @classmethod
+    @replica_read
+    def stats(cls, top=10, **criteria):
+        """ Returns Order counts and revenue computed with SQL aggregates
+        Args:
+            top (int): the number of customers and products to return
+            criteria: the filters accepted by filter_by_criteria
+        Returns:
+            a dictionary with the counts and revenue by status, by day, for the
+            top customers by revenue and for the top products by revenue
+        """
+        cls.logger.info('Processing order stats for %s ...', criteria)
+        matching = cls.filter_by_criteria(**criteria).with_entities(cls.id).subquery()
+        revenue = db.func.coalesce(db.func.sum(OrderItem.total), 0)
+        order_count = db.func.count(db.distinct(cls.id))
+
+        def order_totals(*group_by):
+            """ Returns count and revenue grouped by the given columns """
+            return db.session.query(*group_by, order_count, revenue) \
+                .select_from(cls) \
+                .join(matching, matching.c.id == cls.id) \
+                .outerjoin(OrderItem, OrderItem.order_id == cls.id) \
+                .group_by(*group_by)
+
+        day = db.func.date(cls.order_date)
+        by_status = order_totals(cls.status).order_by(cls.status)
+        by_day = order_totals(day).order_by(day)
+        by_customer = order_totals(cls.customer_id).order_by(revenue.desc(), cls.customer_id).limit(top)
+        top_products = db.session.query(OrderItem.product_id, db.func.min(OrderItem.name),
+                                        db.func.sum(OrderItem.quantity), revenue) \
+            .join(matching, matching.c.id == OrderItem.order_id) \
+            .group_by(OrderItem.product_id) \
+            .order_by(revenue.desc(), OrderItem.product_id) \
+            .limit(top)
+
+        return {'by_status': [{'status': order_status, 'count': count, 'revenue': round(float(total), 2)}
+                              for order_status, count, total in by_status],
+                'by_day': [{'day': str(order_day), 'count': count, 'revenue': round(float(total), 2)}
+                           for order_day, count, total in by_day],
+                'by_customer': [{'customer_id': customer_id, 'count': count, 'revenue': round(float(total), 2)}
+                                for customer_id, count, total in by_customer],
+                'top_products': [{'product_id': product_id, 'name': name, 'quantity': int(quantity),
+                                  'revenue': round(float(total), 2)}
+                                 for product_id, name, quantity, total in top_products]}
 
     # return all orders
     @classmethod
+    @replica_read
     def all(cls):
         """ Returns all of the Orders in the database """
         cls.logger.info('Processing all Orders')
-        return cls.query.all()
+        return cls.load_with_items(cls.query)
+
+    @staticmethod
+    @replica_read
+    def customer_summary(customer_id):
+        """ Returns the number of Orders of a customer, their total and the dates of the first and last one,
+        computed with one aggregate query
+        """
+        order_count, lifetime_total, first_order_date, last_order_date = db.session.query(
+            db.func.count(db.distinct(Order.id)),
+            db.func.coalesce(db.func.sum(OrderItem.total), 0),
+            db.func.min(Order.order_date),
+            db.func.max(Order.order_date)) \
+            .outerjoin(OrderItem, OrderItem.order_id == Order.id) \
+            .filter(Order.customer_id == customer_id).one()
+        return {'customer_id': customer_id,
+                'order_count': order_count,
+                'lifetime_total': round(float(lifetime_total), 2),
+                'first_order_date': first_order_date.isoformat() if first_order_date else None,
+                'last_order_date': last_order_date.isoformat() if last_order_date else None}
 
     @classmethod
+    @replica_read
     def find(cls, order_id):
         """ Finds an order by it's ID """
         cls.logger.info('Processing lookup for id %s ...', order_id)
         return cls.query.get(order_id)
 
+    @classmethod
+    @replica_read
+    def find_with_items(cls, order_id):
+        """ Finds an order by it's ID and loads its items from the same database """
+        cls.logger.info('Processing lookup with items for id %s ...', order_id)
+        order = cls.query.get(order_id)
+        if order is not None:
+            cls.preload_items([order])
+        return order
+
+    @classmethod
+    def find_for_update(cls, order_id):
+        """ Finds an order by it's ID on the primary and locks it until the transaction ends
+
+        Concurrent writers wait for the lock, so what the caller checks (e.g. the
+        If-Match ETag or the status) is still true when it writes the Order
+        """
+        cls.logger.info('Processing locked lookup for id %s ...', order_id)
+        return cls.query.with_for_update().populate_existing().get(order_id)
+
     # @classmethod
     # def find_or_404(cls, order_id):
     #     """ Find a order by it's id """
@@ -146,25 +554,258 @@ class Order(db.Model):
 
     # find orders since date
     @classmethod
+    @replica_read
     def find_since(cls, order_date_since):
         """ Finds all orders since a date """
         cls.logger.info('Processing lookup for orders since %s ...', order_date_since)
-        return cls.query.filter(cls.order_date >= order_date_since).all()
+        return cls.load_with_items(cls.query.filter(cls.order_date >= order_date_since))
 
     @classmethod
+    @replica_read
     def find_by_status(cls, status):
         """ Returns all of the Orders with a status
         Args:
             status (string): the status of the Orders you want to match
         """
         cls.logger.info('Processing status query for %s ...', status)
-        return cls.query.filter(cls.status == status)
+        return cls.load_with_items(cls.query.filter(cls.status == status))
+
+    @classmethod
+    @replica_read
+    def find_page(cls, limit, after=None, columns=ORDER_ROW_COLUMNS, newest_first=False, **criteria):
+        """ Returns one page of Orders in (order_date, id) order using keyset pagination
+        Args:
+            limit (int): the maximum number of Orders in the page
+            after (tuple): the (order_date, id) of the last Order of the previous page
+            columns (tuple): the Order columns to select
+            newest_first (bool): page through the Orders in descending (order_date, id) order
+            criteria: the filters accepted by filter_by_criteria
+        Returns:
+            a tuple of the list of Order rows (see fetch_rows) and whether there are more Orders after them
+        """
+        cls.logger.info('Processing page of %s Orders after %s ...', limit, after)
+        query = cls.filter_by_criteria(**criteria)
+        if newest_first:
+            if after:
+                query = query.filter(tuple_(cls.order_date, cls.id) < tuple_(*after))
+            query = query.order_by(cls.order_date.desc(), cls.id.desc())
+        else:
+            if after:
+                query = query.filter(tuple_(cls.order_date, cls.id) > tuple_(*after))
+            query = query.order_by(cls.order_date, cls.id)
+        order_rows = cls.fetch_rows(query.limit(limit + 1), columns)
+        has_more = len(order_rows) > limit
+        return order_rows[:limit], has_more
+
+    @classmethod
+    def find_changes(cls, limit, after=None, until=None, columns=ORDER_ROW_COLUMNS):
+        """ Returns the Orders changed after a point of the change feed in (last_updated, id) order
+        Args:
+            limit (int): the maximum number of Orders returned
+            after (tuple): the (last_updated, id) of the last Order already seen
+            until (datetime): only return Orders last updated at or before this time
+            columns (tuple): the Order columns to select
+        Returns:
+            the list of Order rows (see fetch_rows)
+        """
+        query = cls.query
+        if after:
+            query = query.filter(tuple_(cls.last_updated, cls.id) > tuple_(*after))
+        if until:
+            query = query.filter(cls.last_updated <= until)
+        return cls.fetch_rows(query.order_by(cls.last_updated, cls.id).limit(limit), columns)
+
+    @classmethod
+    def stream(cls, batch_size=STREAM_BATCH_SIZE, fieldset=None, **criteria):
+        """ Yields all of the matching Orders as rows with items from a server-side cursor
+
+        Orders are fetched batch_size rows at a time and the items of each
+        batch are loaded with one query, so memory use does not grow with
+        the size of the table.
+        """
+        cls.logger.info('Streaming Orders matching %s ...', criteria)
+        fieldset = fieldset or Fieldset()
+        columns = [getattr(cls, name) for name in fieldset.columns]
+        query = cls.filter_by_criteria(**criteria).with_entities(*columns).order_by(cls.id) \
+            .execution_options(stream_results=True).yield_per(batch_size)
+        batch = []
+        with db.replica():
+            for row in query:
+                batch.append(dict(zip(fieldset.columns, row)))
+                if len(batch) == batch_size:
+                    for order_row in fieldset.load(batch):
+                        yield order_row
+                    batch = []
+            for order_row in fieldset.load(batch):
+                yield order_row
+
+    @classmethod
+    @replica_read
+    def fetch_rows(cls, query, columns=ORDER_ROW_COLUMNS):
+        """ Returns the Orders selected by query as serialized rows without building ORM objects
+
+        The rows have the same keys as serialize() but keep their dates as
+        datetimes for the JSON encoder, and have no order_items or total
+        until fetch_item_rows() adds them
+        Args:
+            query (Query): the Order query to run
+            columns (tuple): the names of the Order columns to select
+        """
+        return [dict(zip(columns, row)) for row in query.with_entities(*[getattr(cls, name) for name in columns])]
+
+    @staticmethod
+    @replica_read
+    def fetch_item_rows(order_rows):
+        """ Adds the serialized order_items and total to Order rows with a single query """
+        order_ids = [order_row['id'] for order_row in order_rows]
+        items_by_order = defaultdict(list)
+        if order_ids:
+            columns = [getattr(OrderItem, name) for name in ORDER_ITEM_ROW_COLUMNS]
+            item_rows = db.session.query(*columns).filter(OrderItem.order_id.in_(order_ids)) \
+                .order_by(OrderItem.order_id, OrderItem.id)
+            for item_row in item_rows:
+                items_by_order[item_row[1]].append(dict(zip(ORDER_ITEM_ROW_COLUMNS, item_row)))
+        for order_row in order_rows:
+            order_items = items_by_order.get(order_row['id'], [])
+            order_row['total'] = round(sum(round_cents(item['price'] * item['quantity']) for item in order_items), 2)
+            order_row['order_items'] = order_items
+        return order_rows
+
+    @classmethod
+    @replica_read
+    def find_by_criteria(cls, **criteria):
+        """ Returns all of the Orders matching all of the given criteria in a single query """
+        cls.logger.info('Processing query for %s ...', criteria)
+        return cls.load_with_items(cls.filter_by_criteria(**criteria))
+
+    @classmethod
+    def filter_by_criteria(cls, customer_id=None, status=None, since=None, before=None):
+        """ Returns a query for the Orders matching all of the given criteria
+        Args:
+            customer_id (int): only match Orders placed by this customer
+            status (string): only match Orders with this status
+            since (date): only match Orders placed on or after this date
+            before (date): only match Orders placed before this date
+        """
+        query = cls.query
+        if customer_id is not None:
+            query = query.filter(cls.customer_id == customer_id)
+        if status:
+            query = query.filter(cls.status == status)
+        if since:
+            query = query.filter(cls.order_date >= since)
+        if before:
+            query = query.filter(cls.order_date < before)
+        return query
+
+    @classmethod
+    def load_with_items(cls, query):
+        """ Runs an Order query and loads the items of every Order in one extra query
+        Args:
+            query (Query): the Order query to run
+        """
+        orders = query.all()
+        cls.preload_items(orders)
+        return orders
+
+    @staticmethod
+    @replica_read
+    def preload_items(orders):
+        """ Fetches the OrderItems for a list of Orders in a single query
+
+        The items are grouped in memory and kept on each Order until it is
+        expired by the session (e.g. after a commit), so serializing a list
+        of Orders does not issue one SELECT per Order.
+        """
+        order_ids = [order.id for order in orders if order.id is not None]
+        items_by_order = defaultdict(list)
+        if order_ids:
+            order_items = OrderItem.query.filter(OrderItem.order_id.in_(order_ids)) \
+                .order_by(OrderItem.order_id, OrderItem.id).all()
+            for order_item in order_items:
+                items_by_order[order_item.order_id].append(order_item)
+        for order in orders:
+            order.__dict__['_loaded_order_items'] = items_by_order.get(order.id, [])
+        return orders
 
     @classmethod
     def delete_all(cls):
         cls.query.delete()
+        OrderRollup.query.delete()
+        OrderRollupChange.query.delete()
+        OrderRollupState.query.delete()
+        OrderTombstone.query.delete()
         db.session.commit()
 
+    @classmethod
+    def remove(cls, order_ids, event_type=None):
+        """ Deletes Orders by id with one statement, without loading them
+
+        Their items are deleted by the database through the cascading foreign key
+        Args:
+            order_ids (list): ids of the Orders to delete
+            event_type (string): an OrderEvent type recorded for every deleted Order
+        Returns:
+            the sorted list of the ids of the Orders that were deleted
+        """
+        if not order_ids:
+            return []
+        order_table = cls.__table__
+        try:
+            result = db.session.execute(
+                order_table.delete()
+                .where(order_table.c.id.in_(order_ids))
+                .returning(order_table.c.id, order_table.c.customer_id, order_table.c.status,
+                           order_table.c.order_date))
+            rows = sorted(result, key=lambda row: row.id)
+            if event_type and rows:
+                db.session.execute(OrderEvent.__table__.insert().values(
+                    [OrderEvent.row(row.id, row, event_type) for row in rows]))
+            OrderRollupChange.mark([row.order_date for row in rows])
+            OrderTombstone.record([row.id for row in rows])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return [row.id for row in rows]
+
+    @classmethod
+    def archive_batch(cls, cutoff, batch_size, statuses=OrderStatus.FINAL):
+        """ Moves at most batch_size Orders placed before cutoff to the archive tables
+
+        The Orders and their items are copied with INSERT ... SELECT and deleted
+        with one DELETE that cascades to the items, in one transaction, so no
+        ORM objects are loaded and an Order is never lost or in both places
+        Args:
+            cutoff (datetime): only Orders placed before it are archived
+            batch_size (int): the most Orders moved by this call
+            statuses (tuple): only Orders in these statuses are archived
+        Returns:
+            the list of the ids of the archived Orders
+        """
+        query = db.session.query(cls.id).filter(cls.status.in_(statuses), cls.order_date < cutoff).limit(batch_size)
+        if db.session.bind.dialect.name == 'postgresql':
+            # concurrent jobs and requests never wait on each other's rows
+            query = query.with_for_update(skip_locked=True)
+        try:
+            order_ids = [row.id for row in query]
+            if order_ids:
+                order_table = cls.__table__
+                item_table = OrderItem.__table__
+                order_columns = [order_table.c[name] for name in ORDER_ROW_COLUMNS]
+                item_columns = [item_table.c[name] for name in ORDER_ITEM_ROW_COLUMNS]
+                db.session.execute(ArchivedOrder.__table__.insert().from_select(
+                    ORDER_ROW_COLUMNS, db.select(order_columns).where(order_table.c.id.in_(order_ids))))
+                db.session.execute(ArchivedOrderItem.__table__.insert().from_select(
+                    ORDER_ITEM_ROW_COLUMNS, db.select(item_columns).where(item_table.c.order_id.in_(order_ids))))
+                db.session.execute(order_table.delete().where(order_table.c.id.in_(order_ids)))
+                OrderTombstone.record(order_ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return order_ids
+
 
 class OrderItem(db.Model):
     """
@@ -174,7 +815,7 @@ class OrderItem(db.Model):
     """
 
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id', ondelete='CASCADE'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id', ondelete='CASCADE'), nullable=False, index=True)
     # order = db.relationship('Order', back_populates='order_items')  # TODO this doesn't work right now
     product_id = db.Column(db.Integer, nullable=False)
     name = db.Column(db.String(63), nullable=False)
@@ -184,9 +825,14 @@ class OrderItem(db.Model):
     def __repr__(self):
         return '<Order Id: %d - Product Id: %s>' % (self.order_id, self.product_id)
 
-    @property
+    @hybrid_property
     def total(self):
-        return round(self.price * self.quantity, 2)
+        """ Returns the price times the quantity rounded to cents, the same in Python and in SQL """
+        return round_cents(self.price * self.quantity)
+
+    @total.expression
+    def total(cls):
+        return round_cents_sql(cls.price * cls.quantity)
 
     def serialize(self):
         """ Serializes an OrderItem into a dictionary """
@@ -196,3 +842,272 @@ class OrderItem(db.Model):
                 'name': self.name,
                 'quantity': self.quantity,
                 'price': self.price}
+
+
+class ArchivedOrder(db.Model):
+    """ Class that represents an Order moved to the archive by the retention job """
+    __tablename__ = 'order_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    customer_id = db.Column(db.Integer, nullable=False, index=True)
+    order_date = db.Column(db.DateTime)
+    last_updated = db.Column(db.DateTime)
+    status = db.Column(db.String(63), nullable=False)
+    archived_at = db.Column(db.DateTime, server_default=db.func.now())
+
+    def __repr__(self):
+        return '<ArchivedOrder: %d - Ordered on: %s>' % (self.id, self.order_date)
+
+
+class ArchivedOrderItem(db.Model):
+    """ Class that represents an OrderItem of an archived Order """
+    __tablename__ = 'order_item_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order_archive.id', ondelete='CASCADE'), nullable=False,
+                         index=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(63), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return '<ArchivedOrderItem Order Id: %d - Product Id: %s>' % (self.order_id, self.product_id)
+
+
+class OrderTombstone(db.Model):
+    """ Class that represents an Order removed by a delete or the retention job, for the change feed """
+    __tablename__ = 'order_tombstone'
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    __table_args__ = (
+        db.Index('ix_order_tombstone_deleted_at_id', 'deleted_at', 'id'),
+    )
+
+    def __repr__(self):
+        return '<OrderTombstone: Order %d deleted at %s>' % (self.order_id, self.deleted_at)
+
+    @classmethod
+    def record(cls, order_ids):
+        """ Adds tombstones for removed Orders to the current transaction """
+        if order_ids:
+            db.session.execute(cls.__table__.insert().values([{'order_id': order_id} for order_id in order_ids]))
+
+    @classmethod
+    def find_after(cls, limit, after=None, until=None):
+        """ Returns the tombstones recorded after a point of the change feed in (deleted_at, id) order """
+        query = cls.query
+        if after:
+            query = query.filter(tuple_(cls.deleted_at, cls.id) > tuple_(*after))
+        if until:
+            query = query.filter(cls.deleted_at <= until)
+        return query.order_by(cls.deleted_at, cls.id).limit(limit).all()
+
+
+class OrderRollup(db.Model):
+    """
+    Class that represents the Orders of a day and status
+    The rollups are recomputed from the orders (and the archived orders) of the
+    days that changed by app.rollups.refresh_rollups, so reading a day costs
+    one row per status however many Orders it has
+    """
+    __tablename__ = 'order_daily_rollup'
+
+    day = db.Column(db.Date, primary_key=True)
+    status = db.Column(db.String(63), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False)
+    revenue = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return '<OrderRollup: %s - %s>' % (self.day, self.status)
+
+    def serialize(self):
+        """ Serializes an OrderRollup into a dictionary """
+        return {'day': self.day.isoformat(),
+                'status': self.status,
+                'order_count': self.order_count,
+                'revenue': round(self.revenue, 2)}
+
+    @classmethod
+    @replica_read
+    def find_range(cls, first_day, last_day):
+        """ Returns the rollups of the days from first_day to last_day included """
+        return cls.query.filter(cls.day >= first_day, cls.day <= last_day).order_by(cls.day, cls.status).all()
+
+
+class OrderRollupChange(db.Model):
+    """ Class that represents a day whose rollups must be recomputed because an Order left it """
+    __tablename__ = 'order_rollup_change'
+
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+
+    @classmethod
+    def mark(cls, order_dates):
+        """ Adds the days of order_dates to the current transaction """
+        days = {order_date.date() for order_date in order_dates if order_date}
+        if days:
+            db.session.execute(cls.__table__.insert().values([{'day': day} for day in sorted(days)]))
+
+
+class OrderRollupState(db.Model):
+    """ Class that represents how far the rollups are up to date """
+    __tablename__ = 'order_rollup_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    watermark = db.Column(db.DateTime, nullable=False)
+
+    @classmethod
+    @replica_read
+    def current_watermark(cls):
+        """ Returns the time up to which the rollups include the changes, None before the first refresh """
+        state = cls.query.get(1)
+        return state.watermark if state else None
+
+
+class OrderEvent(db.Model):
+    """
+    Class that represents a change to an Order in the outbox
+    Events are written in the transaction that changes the Order, so they are
+    recorded if and only if the change is committed, and are delivered to other
+    systems later by the EventDispatcher in app.events
+    """
+    CREATED = 'order.created'
+    UPDATED = 'order.updated'
+    CANCELED = 'order.canceled'
+    DELETED = 'order.deleted'
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    event_type = db.Column(db.String(63), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    delivered_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(255))
+
+    __table_args__ = (
+        db.Index('ix_order_event_pending', 'delivered_at', 'next_attempt_at', 'id'),
+        db.Index('ix_order_event_order', 'order_id', 'id'),
+    )
+
+    def __repr__(self):
+        return '<OrderEvent: %d - %s of Order %d>' % (self.id, self.event_type, self.order_id)
+
+    @staticmethod
+    def row(order_id, order, event_type):
+        """ Returns the column values of an event about an Order
+
+        The payload only summarizes the Order so recording an event costs no
+        extra queries; consumers read the full Order from GET /orders/<id>
+        """
+        payload = {'id': order_id, 'customer_id': order.customer_id, 'status': order.status}
+        return {'order_id': order_id,
+                'event_type': event_type,
+                'payload': json.dumps(payload),
+                'attempts': 0,
+                'next_attempt_at': datetime.utcnow()}
+
+    @classmethod
+    def record(cls, order, event_type):
+        """ Adds an event about an Order to the current transaction """
+        if order.id is None:
+            db.session.flush()  # assigns the id of a new Order
+        db.session.add(cls(**cls.row(order.id, order, event_type)))
+
+    @classmethod
+    def pending(cls, limit, max_attempts, now=None):
+        """
+        Returns the oldest events that are due for delivery, locking them on databases that can
+
+        An event waits until the older events of its Order are delivered or
+        given up on, so the events of an Order reach the sink in the order they
+        were recorded, even with concurrent workers
+        """
+        older = aliased(cls)
+        undelivered = db.session.query(older).filter(older.order_id == cls.order_id,
+                                                 older.id < cls.id,
+                                                 older.delivered_at.is_(None),
+                                                 older.attempts < max_attempts)
+        query = cls.query.filter(cls.delivered_at.is_(None),
+                                 cls.attempts < max_attempts,
+                                 cls.next_attempt_at <= (now or datetime.utcnow()),
+                                 ~undelivered.exists()) \
+            .order_by(cls.id).limit(limit)
+        if db.session.bind.dialect.name == 'postgresql':
+            # concurrent workers skip the events another worker is delivering
+            query = query.with_for_update(skip_locked=True)
+        return query.all()
+
+    @classmethod
+    def backlog(cls, max_attempts):
+        """ Returns the numbers of events waiting for delivery and of those that were given up on """
+        pending, failed = db.session.query(
+            db.func.count(cls.id).filter(cls.attempts < max_attempts),
+            db.func.count(cls.id).filter(cls.attempts >= max_attempts)) \
+            .filter(cls.delivered_at.is_(None)).one()
+        return {'pending': pending, 'failed': failed}
+
+    def serialize(self):
+        """ Serializes an OrderEvent into the dictionary sent to the sinks """
+        return {'id': self.id,
+                'type': self.event_type,
+                'order_id': self.order_id,
+                'created_at': self.created_at.isoformat() if self.created_at else self.created_at,
+                'data': json.loads(self.payload)}
+
+
+class Fieldset:
+    """
+    The parts of an Order a client asked for with fields= and include=items
+    Only the requested columns are selected, plus the ones needed for page
+    cursors and ETags, and the items or totals are only queried when requested
+    """
+    FIELDS = ORDER_ROW_COLUMNS + ('total', 'order_items')
+    KEY_COLUMNS = ('id', 'order_date', 'last_updated')
+
+    def __init__(self, fields=None, include_items=False):
+        if fields is None:
+            self.fields = self.FIELDS
+        else:
+            if not fields:
+                raise DataValidationError('fields must list at least one field')
+            unknown = [field for field in fields if field not in self.FIELDS]
+            if unknown:
+                raise DataValidationError('Invalid fields: ' + ', '.join(unknown))
+            self.fields = tuple(field for field in self.FIELDS
+                                if field in fields or (field == 'order_items' and include_items))
+        self.columns = tuple(column for column in ORDER_ROW_COLUMNS
+                             if column in self.fields or column in self.KEY_COLUMNS)
+        self.is_full = self.fields == self.FIELDS
+
+    @property
+    def tag(self):
+        """ Identifies the representation in ETags, empty for full Orders """
+        return '' if self.is_full else ','.join(self.fields)
+
+    def load(self, order_rows):
+        """ Adds the items or totals to Order rows if they were requested """
+        if 'order_items' in self.fields:
+            Order.fetch_item_rows(order_rows)
+        elif 'total' in self.fields:
+            totals = Order.totals([order_row['id'] for order_row in order_rows])
+            for order_row in order_rows:
+                order_row['total'] = totals.get(order_row['id'], 0)
+        return order_rows
+
+    def project(self, order_row):
+        """ Returns only the requested fields of a serialized Order """
+        if self.is_full:
+            return order_row
+        return {field: order_row[field] for field in self.fields}
+
+
+@event.listens_for(Order, 'expire')
+def _discard_loaded_items(target, attrs):
+    """ Drops preloaded items whenever the session expires an Order """
+    target.__dict__.pop('_loaded_order_items', None)
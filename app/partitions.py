@@ -0,0 +1,196 @@
+"""
+Monthly Partitions of the Order Table
+On Postgres the order table can be partitioned by month of order_date, so
+queries filtered by date (e.g. find_since) only scan the months they ask for
+and a month of old Orders can be detached from the table in an instant
+
+The partitioned tables are created by flask create-db when DB_PARTITION_ORDERS
+is set, on an empty database; an existing order table is never converted.
+flask partition-orders, run e.g. daily, creates the partitions of the coming
+months ahead of time and detaches old ones. Orders outside every monthly
+partition go to the order_default partition so inserts never fail; they are
+moved to the partition of their month when it is created
+
+Postgres requires the primary key of a partitioned table to include order_date,
+so ids are only kept unique by their sequence, and the order_item foreign key
+cannot reference order.id: a trigger deletes the items of deleted Orders
+instead of the ON DELETE CASCADE. The items stay in one table, found through
+their order_id index, because Postgres routes a row to its partition before
+any trigger could copy order_date onto it
+
+Other databases (e.g. SQLite) keep the plain tables, and the models work the
+same on both
+
+Environment
+-----------
+DB_PARTITION_ORDERS - create the order table partitioned by month (default False)
+PARTITION_MONTHS_AHEAD - months of partitions created ahead of the current one (default 3)
+"""
+import logging
+import os
+import re
+from datetime import datetime
+
+from environs import Env
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable
+
+from .models import Order, OrderItem
+
+env = Env()
+
+DB_PARTITION_ORDERS = env.bool('DB_PARTITION_ORDERS', False)
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', '3'))
+
+DEFAULT_PARTITION = 'order_default'
+PARTITION_NAME = re.compile(r'^order_y(\d{4})m(\d{2})$')
+
+# the order table of the model with (id, order_date) as its primary key
+ORDER_TABLE_DDL = """
+CREATE TABLE "order" (
+    id SERIAL NOT NULL,
+    customer_id INTEGER NOT NULL,
+    order_date TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+    last_updated TIMESTAMP WITHOUT TIME ZONE DEFAULT now(),
+    status VARCHAR(63) NOT NULL,
+    PRIMARY KEY (id, order_date)
+) PARTITION BY RANGE (order_date)
+"""
+
+# an Order moved to another partition by a new order_date is deleted and
+# inserted again, so its items are only deleted when the id is gone
+DELETE_ITEMS_TRIGGER_DDL = """
+CREATE OR REPLACE FUNCTION order_delete_items() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM "order" WHERE id = OLD.id) THEN
+        DELETE FROM order_item WHERE order_id = OLD.id;
+    END IF;
+    RETURN NULL;
+END
+$$;
+CREATE TRIGGER order_delete_items AFTER DELETE ON "order" FOR EACH ROW EXECUTE PROCEDURE order_delete_items();
+"""
+
+
+def month_start(value, months=0):
+    """ Returns the first day of the month of value, moved by a number of months """
+    year, month = divmod(value.year * 12 + value.month - 1 + months, 12)
+    return datetime(year, month + 1, 1)
+
+
+def partition_name(month):
+    """ Returns the name of the partition holding the Orders of a month """
+    return 'order_y{:04d}m{:02d}'.format(month.year, month.month)
+
+
+def is_postgres(bind):
+    """ Checks if the engine or connection is for Postgres, the only database partitioned """
+    return bind.dialect.name == 'postgresql'
+
+
+def is_partitioned(bind):
+    """ Checks if the order table is partitioned """
+    if not is_postgres(bind):
+        return False
+    return bind.execute(text("SELECT count(*) FROM pg_partitioned_table "
+                             "WHERE partrelid = to_regclass('\"order\"')")).scalar() > 0
+
+
+def create_tables(engine):
+    """
+    Creates the partitioned order table and the order_item table with its trigger
+    Returns:
+        True if the tables were created, False on other databases or when the order table exists
+    """
+    if not is_postgres(engine) or engine.dialect.has_table(engine, Order.__tablename__):
+        return False
+    with engine.begin() as connection:
+        connection.execute(text(ORDER_TABLE_DDL))
+        connection.execute(CreateTable(OrderItem.__table__, include_foreign_key_constraints=[]))
+        for index in list(Order.__table__.indexes) + list(OrderItem.__table__.indexes):
+            index.create(connection)
+        connection.execute(text(DELETE_ITEMS_TRIGGER_DDL))
+        connection.execute(text('CREATE TABLE {} PARTITION OF "order" DEFAULT'.format(DEFAULT_PARTITION)))
+    logging.getLogger(__name__).info('Created the partitioned order table')
+    return True
+
+
+def list_partitions(bind):
+    """ Returns the first days of the months that have a partition, oldest first """
+    if not is_partitioned(bind):
+        return []
+    names = bind.execute(text("SELECT child.relname FROM pg_inherits "
+                              "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                              "WHERE pg_inherits.inhparent = to_regclass('\"order\"')")).fetchall()
+    matches = [PARTITION_NAME.match(name) for name, in names]
+    return sorted(datetime(int(match.group(1)), int(match.group(2)), 1) for match in matches if match)
+
+
+def create_partitions(engine, months_ahead=PARTITION_MONTHS_AHEAD, now=None):
+    """
+    Creates the missing partitions from the current month to months_ahead months ahead
+
+    Each partition is created in its own transaction. Postgres refuses a
+    partition while the default partition holds Orders of its month (e.g.
+    placed beyond the months created so far), so those are moved into the new
+    partition while the default partition is detached
+    Returns:
+        the names of the partitions created
+    """
+    if not is_partitioned(engine):
+        return []
+    current = month_start(now or datetime.utcnow())
+    existing = set(list_partitions(engine))
+    created = []
+    for offset in range(months_ahead + 1):
+        month = month_start(current, offset)
+        if month in existing:
+            continue
+        name = partition_name(month)
+        bounds = {'start': month, 'end': month_start(month, 1)}
+        in_month = 'order_date >= :start AND order_date < :end'
+        with engine.begin() as connection:
+            # creating the partition takes this lock anyway, taking it first keeps inserts out of the default
+            connection.execute(text('LOCK TABLE "order" IN ACCESS EXCLUSIVE MODE'))
+            misplaced = connection.execute(text('SELECT EXISTS (SELECT 1 FROM {} WHERE {})'.format(
+                DEFAULT_PARTITION, in_month)), bounds).scalar()
+            if misplaced:
+                connection.execute(text('ALTER TABLE "order" DETACH PARTITION {}'.format(DEFAULT_PARTITION)))
+            connection.execute(text('CREATE TABLE {} PARTITION OF "order" FOR VALUES FROM (\'{}\') TO (\'{}\')'.format(
+                name, month.isoformat(), month_start(month, 1).isoformat())))
+            if misplaced:
+                moved = connection.execute(text('INSERT INTO {} SELECT * FROM {} WHERE {}'.format(
+                    name, DEFAULT_PARTITION, in_month)), bounds).rowcount
+                connection.execute(text('DELETE FROM {} WHERE {}'.format(DEFAULT_PARTITION, in_month)), bounds)
+                connection.execute(text('ALTER TABLE "order" ATTACH PARTITION {} DEFAULT'.format(DEFAULT_PARTITION)))
+                logging.getLogger(__name__).info('Moved %d Orders from %s to %s', moved, DEFAULT_PARTITION, name)
+        created.append(name)
+    return created
+
+
+def detach_partitions(engine, before):
+    """
+    Detaches the monthly partitions of the Orders placed before a date
+
+    A detached partition keeps its Orders as a plain table that can be
+    archived or dropped; their items are moved to a <partition>_item table
+    and the change feed lists the Orders as deleted.
+    Detaching waits for the transactions reading the order table to finish
+    Returns:
+        the names of the partitions detached
+    """
+    detached = []
+    for month in list_partitions(engine):
+        if month_start(month, 1) > before:
+            break
+        name = partition_name(month)
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE "order" DETACH PARTITION {}'.format(name)))
+            # the detached table must not depend on the id sequence of the order table
+            connection.execute(text('ALTER TABLE {} ALTER COLUMN id DROP DEFAULT'.format(name)))
+            connection.execute(text('CREATE TABLE {0}_item AS SELECT order_item.* FROM order_item '
+                                    'WHERE order_id IN (SELECT id FROM {0})'.format(name)))
+            connection.execute(text('DELETE FROM order_item WHERE order_id IN (SELECT id FROM {})'.format(name)))
+            connection.execute(text('INSERT INTO order_tombstone (order_id) SELECT id FROM {}'.format(name)))
+        detached.append(name)
+    return detached
@@ -0,0 +1,56 @@
+"""
+Order Retention for Orders Service
+Delivered and canceled Orders older than the retention period are moved to
+the order_archive and order_item_archive tables in bounded batches, so the
+order table that every request reads stays small
+
+Each batch is its own short transaction, so the job can be stopped at any
+time, never holds locks for long and can run while the service is serving
+
+Environment
+-----------
+RETENTION_DAYS - age in days after which delivered and canceled Orders are archived (default 365)
+RETENTION_BATCH_SIZE - Orders moved per transaction (default 1000)
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from .models import Order
+
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', '365'))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '1000'))
+# the longest retention period accepted, a century
+MAX_RETENTION_DAYS = 36500
+
+logger = logging.getLogger(__name__)
+
+
+def archive_orders(older_than_days=RETENTION_DAYS, batch_size=RETENTION_BATCH_SIZE, max_batches=None,
+                   clock=datetime.utcnow, on_batch=None):
+    """
+    Archives the Orders in a final status placed more than older_than_days ago
+    Args:
+        older_than_days (int): the retention period in days
+        batch_size (int): the most Orders moved per transaction
+        max_batches (int): stop after this many batches, None to archive every old Order
+        on_batch (callable): called with the ids of the Orders of each batch once it is archived
+    Returns:
+        a dictionary with the cutoff date, the number of Orders archived and of
+        batches, and whether every old Order was archived
+    """
+    cutoff = clock() - timedelta(days=older_than_days)
+    archived = 0
+    batches = 0
+    done = False
+    while max_batches is None or batches < max_batches:
+        order_ids = Order.archive_batch(cutoff, batch_size)
+        batches += 1
+        archived += len(order_ids)
+        if on_batch is not None:
+            on_batch(order_ids)
+        if len(order_ids) < batch_size:
+            done = True
+            break
+    logger.info('Archived %d orders placed before %s in %d batches', archived, cutoff, batches)
+    return {'cutoff': cutoff, 'archived': archived, 'batches': batches, 'done': done}
@@ -0,0 +1,108 @@
+"""
+Daily Order Rollups for Orders Service
+The order_daily_rollup table keeps the number of Orders and their revenue per
+day and status, so dashboards read a few rows per day instead of every Order
+
+refresh_rollups() recomputes only the days that changed since its last run:
+the days of the Orders whose last_updated passed the watermark, and the days
+Orders left when they were deleted or moved to another date, which the write
+paths record in order_rollup_change. A day is always recomputed whole from the
+orders and archived orders, so running it again is harmless, and refreshes
+take turns through a lock on their watermark.
+Run it periodically with flask refresh-rollups; until then a rollup can lag
+behind the orders by the time between runs
+
+last_updated is set when a transaction starts, so a transaction that commits
+after a refresh may carry a time before the watermark; every refresh looks
+ROLLUP_OVERLAP seconds further back than the last watermark to catch those
+
+Environment
+-----------
+ROLLUP_OVERLAP - seconds before the watermark that every refresh looks at again (default 300)
+"""
+import logging
+import os
+from datetime import datetime, time, timedelta
+
+from .models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem, OrderRollup, OrderRollupChange, \
+    OrderRollupState, db, round_cents_sql
+
+ROLLUP_OVERLAP = float(os.getenv('ROLLUP_OVERLAP', '300'))
+
+logger = logging.getLogger(__name__)
+
+
+def _as_date(value):
+    # SQLite returns date() as a string
+    return datetime.strptime(value, '%Y-%m-%d').date() if isinstance(value, str) else value
+
+
+def _day_totals(order_model, item_model, days):
+    """ Returns a query of the day, status, count and revenue of the Orders of order_model placed on days """
+    day = db.func.date(order_model.order_date)
+    query = db.session.query(day.label('day'), order_model.status.label('status'),
+                             db.func.count(db.distinct(order_model.id)).label('order_count'),
+                             db.func.coalesce(db.func.sum(round_cents_sql(item_model.price * item_model.quantity)), 0)
+                             .label('revenue')) \
+        .outerjoin(item_model, item_model.order_id == order_model.id) \
+        .group_by(day, order_model.status)
+    if days is not None:
+        # the range lets the order_date indexes find the rows, the IN keeps only the days asked for
+        query = query.filter(order_model.order_date >= datetime.combine(min(days), time()),
+                             order_model.order_date < datetime.combine(max(days) + timedelta(days=1), time()),
+                             day.in_(days))
+    return query
+
+
+def recompute_days(days=None):
+    """
+    Replaces the rollups of days, or of every day when days is None, in the current transaction
+    Returns:
+        the number of rollup rows written
+    """
+    if days is not None and not days:
+        return 0
+    totals = _day_totals(Order, OrderItem, days).union_all(_day_totals(ArchivedOrder, ArchivedOrderItem, days)) \
+        .subquery()
+    rows = db.session.query(totals.c.day, totals.c.status, db.func.sum(totals.c.order_count),
+                            db.func.sum(totals.c.revenue)) \
+        .group_by(totals.c.day, totals.c.status).all()
+    stale = OrderRollup.query
+    if days is not None:
+        stale = stale.filter(OrderRollup.day.in_(days))
+    stale.delete(synchronize_session=False)
+    if rows:
+        db.session.execute(OrderRollup.__table__.insert().values(
+            [{'day': day, 'status': status, 'order_count': int(count), 'revenue': float(revenue)}
+             for day, status, count, revenue in rows]))
+    return len(rows)
+
+
+def refresh_rollups():
+    """
+    Recomputes the rollups of the days that changed since the last refresh, or of every day the first time
+    Returns:
+        the number of days recomputed, None when every day was
+    """
+    # the database clock, in the time zone last_updated is stored in
+    started = db.session.query(db.func.now()).scalar().replace(tzinfo=None)
+    state = OrderRollupState.query.with_for_update().get(1)
+    changes = OrderRollupChange.query.all()
+    if state is None:
+        days = None
+        state = OrderRollupState(id=1, watermark=started)
+        db.session.add(state)
+    else:
+        since = state.watermark - timedelta(seconds=ROLLUP_OVERLAP)
+        changed_days = db.session.query(db.func.date(Order.order_date)).filter(Order.last_updated >= since) \
+            .distinct()
+        days = {_as_date(day) for day, in changed_days}
+        days.update(change.day for change in changes)
+        state.watermark = started
+    recompute_days(None if days is None else sorted(days))
+    if changes:
+        OrderRollupChange.query.filter(OrderRollupChange.id.in_([change.id for change in changes])) \
+            .delete(synchronize_session=False)
+    db.session.commit()
+    logger.info('Refreshed the order rollups of %s days', 'all' if days is None else len(days))
+    return None if days is None else len(days)
@@ -0,0 +1,173 @@
+"""
+Payload Validation for Orders Service
+A Schema is compiled once from field checkers and validates a whole payload
+in one pass, collecting every error instead of stopping at the first one
+
+Checkers
+--------
+integer - an int, or a string of digits, with an optional minimum and maximum
+number - a finite float or int, or a numeric string, with an optional minimum
+string - a non-empty string with a maximum length
+choice - one of a fixed set of values
+iso_datetime - an ISO 8601 date or date and time, parsed without dateutil when possible
+list_of - a list of payloads validated by another Schema
+list_of_values - a list of values checked by another checker, with an optional maximum length
+"""
+import math
+import re
+from datetime import datetime
+
+import dateutil.parser
+
+# YYYY-MM-DD with an optional [T ]HH:MM[:SS[.ffffff]] and no time zone
+ISO_DATETIME = re.compile(r'^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?)?$')
+
+
+def parse_datetime(value):
+    """ Parses an ISO 8601 date and time, falling back to dateutil for other formats """
+    match = ISO_DATETIME.match(value)
+    if match is None:
+        return dateutil.parser.parse(value)
+    year, month, day, hour, minute, second, fraction = match.groups()
+    return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                    int((fraction or '0').ljust(6, '0')))
+
+
+def integer(minimum=None, maximum=None):
+    """ Returns a checker for integers """
+    def check(value):
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError('must be an integer')
+        if minimum is not None and value < minimum:
+            raise ValueError('must be at least {}'.format(minimum))
+        if maximum is not None and value > maximum:
+            raise ValueError('must be at most {}'.format(maximum))
+        return value
+    return check
+
+
+def number(minimum=None):
+    """ Returns a checker for numbers, converted to float """
+    def check(value):
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError('must be a number')
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError('must be a number')
+        if minimum is not None and value < minimum:
+            raise ValueError('must be at least {}'.format(minimum))
+        return float(value)
+    return check
+
+
+def string(max_length):
+    """ Returns a checker for non-empty strings """
+    def check(value):
+        if not isinstance(value, str) or not value:
+            raise ValueError('must be a non-empty string')
+        if len(value) > max_length:
+            raise ValueError('must be at most {} characters'.format(max_length))
+        return value
+    return check
+
+
+def choice(choices):
+    """ Returns a checker for one of a fixed set of values """
+    allowed = frozenset(choices)
+
+    def check(value):
+        if not isinstance(value, str) or value not in allowed:
+            raise ValueError('must be one of {}'.format(', '.join(sorted(allowed))))
+        return value
+    return check
+
+
+def iso_datetime(value):
+    """ Checks and parses a date and time string """
+    if not isinstance(value, str):
+        raise ValueError('must be an ISO 8601 date')
+    try:
+        return parse_datetime(value)
+    except (ValueError, OverflowError):
+        raise ValueError('must be an ISO 8601 date')
+
+
+def list_of(schema):
+    """ Returns a checker for a list of payloads, reporting the errors of every element """
+    def check(value, path):
+        if not isinstance(value, list):
+            return None, ['{} must be a list'.format(path)]
+        results = []
+        errors = []
+        for index, element in enumerate(value):
+            clean, element_errors = schema.validate(element, path='{}[{}].'.format(path, index))
+            results.append(clean)
+            errors.extend(element_errors)
+        return results, errors
+    check.nested = True
+    return check
+
+
+def list_of_values(checker, max_length=None):
+    """ Returns a checker for a non-empty list of values, reporting the errors of every element """
+    def check(value, path):
+        if not isinstance(value, list) or not value:
+            return None, ['{} must be a non-empty list'.format(path)]
+        if max_length is not None and len(value) > max_length:
+            return None, ['{} must have at most {} elements'.format(path, max_length)]
+        results = []
+        errors = []
+        for index, element in enumerate(value):
+            try:
+                results.append(checker(element))
+            except ValueError as error:
+                errors.append('{}[{}] {}'.format(path, index, error))
+        return results, errors
+    check.nested = True
+    return check
+
+
+class Schema:
+    """ Validates dictionaries against a set of required and optional fields """
+
+    def __init__(self, required=None, optional=None):
+        # compile the fields into one flat list that validate() walks without lookups
+        self.fields = [(name, checker, True, getattr(checker, 'nested', False))
+                       for name, checker in (required or {}).items()]
+        self.fields += [(name, checker, False, getattr(checker, 'nested', False))
+                        for name, checker in (optional or {}).items()]
+
+    def validate(self, data, partial=False, path=''):
+        """
+        Validates a payload
+        Args:
+            data (dict): the payload to validate
+            partial (bool): don't require the required fields (PATCH)
+            path (string): prefix of the field names in the error messages
+        Returns:
+            a tuple of the dictionary of converted values that were present and
+            the list of error messages, which is empty when data is valid
+        """
+        if not isinstance(data, dict):
+            return None, ['{} must be an object'.format(path.rstrip('.') or 'body of request')]
+        clean = {}
+        errors = []
+        for name, checker, required, nested in self.fields:
+            value = data.get(name)
+            if value is None or value == '':
+                if required and not partial:
+                    errors.append('missing {}{}'.format(path, name))
+                continue
+            if nested:
+                clean[name], nested_errors = checker(value, path + name)
+                errors.extend(nested_errors)
+                continue
+            try:
+                clean[name] = checker(value)
+            except ValueError as error:
+                errors.append('{}{} {}'.format(path, name, error))
+        return clean, errors
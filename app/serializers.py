@@ -0,0 +1,34 @@
+"""
+JSON Encoding for Orders Service
+Encodes responses as compact JSON, using orjson when it is installed and the
+standard library json module otherwise. Dates are encoded as ISO 8601
+strings so rows can be passed without formatting them first
+"""
+import json
+from datetime import date
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _encode_date(value):
+    """ Encodes the values the json module does not know about """
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def dumps(data):
+    """ Returns data encoded as compact JSON bytes """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':'), default=_encode_date).encode('utf-8')
+
+
+def json_response(data, status_code, headers=None):
+    """ Returns a response with data encoded as compact JSON """
+    return Response(dumps(data), status_code, headers, mimetype='application/json')
@@ -3,25 +3,60 @@ Order Service
 Paths:
 ------
 GET /orders - Returns a list all of Orders
+GET /orders?customer_id={id}&status={status}&orders_since={date}&orders_until={date} - Returns the matching Orders
+GET /orders?limit={n}&cursor={cursor} - Returns a page of Orders, the next page is in the Link header
+GET /orders?stream=1 - Streams all of the Orders as newline delimited JSON (also Accept: application/x-ndjson)
 GET /orders/{id} - Returns the Order with a given id number
+GET /orders?fields=id,status,order_date&include=items - Returns only some fields of the Orders (also for /orders/{id})
+GET /orders/cache - Returns the hit and miss counters of the Order cache
+GET /customers/{id}/orders?limit={n}&cursor={cursor} - Returns a page of the Orders of a customer, newest first
+GET /customers/{id}/orders/summary - Returns the number of Orders of a customer and their lifetime total
+GET /orders/changes?since={token}&limit={n} - Returns the Orders changed or deleted since a token, oldest first
+GET /orders/events - Returns the number of Order events waiting for the event worker
+GET /orders/stats - Returns Order counts and revenue by status, day, customer and product
+GET /orders/rollups?from={date}&to={date} - Returns the Order counts and revenue per day and status
 POST /orders - creates a new Order record in the database
+POST /orders/bulk - creates many Orders from a JSON array or newline delimited JSON
 PUT /orders/{id} - update a complete order
 PATCH /orders/{id} - update part of an order
 DELETE /orders/{id} - delete an order
 PUT /orders/{id}/cancel - cancel an order
+POST /orders/status - move many Orders to a status allowed from their current one
+POST /orders/archive - move old delivered and canceled Orders to the archive tables (admin, see ADMIN_TOKEN)
+GET /metrics - Returns request metrics in the Prometheus text format
+
+Orders and lists of Orders carry an ETag built from Order.last_updated, so
+GET honors If-None-Match (and If-Modified-Since for single Orders) with a
+304, while PUT, PATCH and cancel honor If-Match with a 412 when the Order
+changed; they lock the Order while they check and write it
 """
 
+import base64
+import binascii
+import hashlib
+import hmac
 import logging
+import os
 import sys
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
-from flask import jsonify, request, abort, url_for, make_response
+import click
+import dateutil.parser
+
+from flask import jsonify, request, abort, url_for, make_response, json, Response, stream_with_context
 from flask_api import status  # HTTP Status Codes
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, PreconditionFailed
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
-from .models import Order, DataValidationError, OrderStatus
+from .models import db, Order, DataValidationError, OrderStatus, OrderEvent, OrderRollup, OrderRollupState, \
+    OrderTombstone, Fieldset, StatusTransitionError, validate_status_change
+from .cache import OrderCache
+from .events import EVENT_MAX_ATTEMPTS
+from .retention import RETENTION_DAYS, RETENTION_BATCH_SIZE, MAX_RETENTION_DAYS, archive_orders
+from .rollups import refresh_rollups
+from .serializers import dumps, json_response
+from . import database, metrics, partitions, schema
 
 # Import Flask application
 from . import app
@@ -29,13 +64,58 @@ from . import app
 # kind of hacky, but now all urls will work
 app.url_map.strict_slashes = False
 
+metrics.init_app(app)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NDJSON = 'application/x-ndjson'
+MAX_BULK_ORDERS = 10000
+# seconds the change feed stays behind the database clock, longer than any
+# write transaction so no change can commit with a time the feed has passed
+CHANGE_FEED_DELAY = float(os.getenv('CHANGE_FEED_DELAY', '60'))
+# customers and products listed at most by GET /orders/stats
+MAX_STATS_TOP = 100
+# days of rollups returned by default and at most
+DEFAULT_ROLLUP_DAYS = 31
+MAX_ROLLUP_DAYS = 366
+# batches archived per POST /orders/archive so a request stays short, the CLI has no limit
+MAX_ARCHIVE_BATCHES = 10
+
+ARCHIVE_SCHEMA = schema.Schema(optional={'older_than_days': schema.integer(minimum=1, maximum=MAX_RETENTION_DAYS),
+                                         'batch_size': schema.integer(minimum=1),
+                                         'max_batches': schema.integer(minimum=1)})
+
+# serialized Orders served by GET /orders/<id>, invalidated by every write
+order_cache = OrderCache()
+
+
+@app.before_request
+def route_reads():
+    """ Requests that change Orders read them from the primary, never from a lagging replica """
+    if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        db.use_primary()
+
 ######################################################################
 # Error Handlers
 ######################################################################
 @app.errorhandler(DataValidationError)
 def request_validation_error(error):
-    """ Handles Value Errors from bad data """
-    return bad_request(error)
+    """ Handles Value Errors from bad data, listing every invalid field """
+    app.logger.warning(str(error))
+    return jsonify(status=status.HTTP_400_BAD_REQUEST,
+                   error='Bad Request',
+                   message=str(error),
+                   errors=error.errors), status.HTTP_400_BAD_REQUEST
+
+
+@app.errorhandler(StatusTransitionError)
+def status_transition_error(error):
+    """ Handles moves to a status not allowed from the current one with 409_CONFLICT """
+    message = str(error)
+    app.logger.warning(message)
+    return jsonify(status=status.HTTP_409_CONFLICT,
+                   error='Conflict',
+                   message=message), status.HTTP_409_CONFLICT
 
 
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
@@ -48,6 +128,16 @@ def bad_request(error):
                    message=message), status.HTTP_400_BAD_REQUEST
 
 
+@app.errorhandler(status.HTTP_403_FORBIDDEN)
+def forbidden(error):
+    """ Handles requests without the admin token with 403_FORBIDDEN """
+    message = str(error)
+    app.logger.warning(message)
+    return jsonify(status=status.HTTP_403_FORBIDDEN,
+                   error='Forbidden',
+                   message=message), status.HTTP_403_FORBIDDEN
+
+
 @app.errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
     """ Handles resources not found with 404_NOT_FOUND """
@@ -68,6 +158,16 @@ def method_not_supported(error):
                    message=message), status.HTTP_405_METHOD_NOT_ALLOWED
 
 
+@app.errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """ Handles stale If-Match requests with 412_PRECONDITION_FAILED """
+    message = str(error)
+    app.logger.warning(message)
+    return jsonify(status=status.HTTP_412_PRECONDITION_FAILED,
+                   error='Precondition Failed',
+                   message=message), status.HTTP_412_PRECONDITION_FAILED
+
+
 @app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -111,21 +211,63 @@ def index():
 ######################################################################
 @app.route('/orders', methods=['GET'])
 def list_orders():
-    """ Returns all of the Orders """
+    """ Returns all of the Orders matching the customer_id, status, orders_since and orders_until filters """
     app.logger.info('Request for order list')
-    order_status = request.args.get('status')
-    orders_since = request.args.get('orders_since')
-
-    if order_status:
-        orders = Order.find_by_status(order_status)
-    elif orders_since:
-        orders_since_date = datetime.strptime(orders_since, '%Y-%m-%d').date()
-        orders = Order.find_since(orders_since_date)
-    else:
-        orders = Order.all()
-
-    results = [order.serialize() for order in orders]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    criteria = get_order_criteria()
+    fieldset = get_fieldset()
+
+    if 'limit' in request.args or 'cursor' in request.args:
+        return list_orders_page(criteria, fieldset)
+    if wants_stream():
+        return stream_orders(criteria, fieldset)
+
+    # the list is built straight from row tuples, skipping the ORM objects
+    order_rows = Order.fetch_rows(Order.filter_by_criteria(**criteria).order_by(Order.id), fieldset.columns)
+    etag = orders_etag(order_rows, fieldset.tag)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    fieldset.load(order_rows)
+    with metrics.timer('serialize'):
+        response = json_response([fieldset.project(order_row) for order_row in order_rows], status.HTTP_200_OK)
+    response.set_etag(etag)
+    return response
+
+
+def list_orders_page(criteria, fieldset, newest_first=False, endpoint='list_orders', **view_args):
+    """ Returns one page of Orders with a Link header pointing to the next page """
+    limit = get_page_limit()
+    after = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+
+    order_rows, has_more = Order.find_page(limit, after=after, columns=fieldset.columns, newest_first=newest_first,
+                                           **criteria)
+    headers = {}
+    if has_more:
+        next_cursor = encode_cursor(order_rows[-1])
+        next_args = request.args.to_dict()
+        next_args.update(view_args, limit=limit, cursor=next_cursor)
+        headers['Link'] = '<{}>; rel="next"'.format(url_for(endpoint, _external=True, **next_args))
+        headers['X-Next-Cursor'] = next_cursor
+    etag = orders_etag(order_rows, fieldset.tag)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag, headers)
+    fieldset.load(order_rows)
+    with metrics.timer('serialize'):
+        response = json_response([fieldset.project(order_row) for order_row in order_rows], status.HTTP_200_OK,
+                                 headers)
+    response.set_etag(etag)
+    return response
+
+
+def stream_orders(criteria, fieldset):
+    """ Streams the Orders one JSON document per line without building the whole list """
+
+    def generate():
+        for order_row in Order.stream(fieldset=fieldset, **criteria):
+            with metrics.timer('serialize'):
+                line = dumps(fieldset.project(order_row)) + b'\n'
+            yield line
+
+    return Response(stream_with_context(generate()), status.HTTP_200_OK, mimetype=NDJSON)
 
 
 ######################################################################
@@ -138,10 +280,179 @@ def get_orders(order_id):
     This endpoint will return a order based on it's id
     """
     app.logger.info('Request for order with id: %s', order_id)
-    order = Order.find(order_id)
-    if not order:
+    fieldset = get_fieldset()
+    data = order_cache.lookup(order_id)
+    if data is None and not fieldset.is_full:
+        return get_order_fields(order_id, fieldset)
+    if data is None:
+        # the items are read from the same replica as the Order, not lazily from the primary
+        order = Order.find_with_items(order_id)
+        if not order:
+            raise NotFound("Order with id '{}' was not found.".format(order_id))
+        etag = order_etag(order.id, order.last_updated)
+        if is_not_modified(etag, order.last_updated):
+            return not_modified(etag)
+        with metrics.timer('serialize'):
+            data = order.serialize()
+        # a lagging replica could put the Order as it was before the last write back into the cache
+        if not db.reads_from_replica():
+            order_cache.store(order_id, data)
+
+    last_updated = dateutil.parser.parse(data['last_updated']) if data['last_updated'] else None
+    etag = order_etag(data['id'], last_updated, fieldset.tag)
+    if is_not_modified(etag, last_updated):
+        return not_modified(etag)
+    with metrics.timer('serialize'):
+        response = make_response(jsonify(fieldset.project(data)), status.HTTP_200_OK)
+    response.set_etag(etag)
+    response.last_modified = last_updated
+    return response
+
+
+def get_order_fields(order_id, fieldset):
+    """ Returns some fields of an Order, only querying the columns and items that were requested """
+    order_rows = Order.fetch_rows(Order.query.filter(Order.id == order_id), fieldset.columns)
+    if not order_rows:
         raise NotFound("Order with id '{}' was not found.".format(order_id))
-    return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+    order_row = order_rows[0]
+    etag = order_etag(order_row['id'], order_row['last_updated'], fieldset.tag)
+    if is_not_modified(etag, order_row['last_updated']):
+        return not_modified(etag)
+    fieldset.load(order_rows)
+    with metrics.timer('serialize'):
+        response = json_response(fieldset.project(order_row), status.HTTP_200_OK)
+    response.set_etag(etag)
+    response.last_modified = order_row['last_updated']
+    return response
+
+
+######################################################################
+# LIST THE ORDERS OF A CUSTOMER
+######################################################################
+@app.route('/customers/<int:customer_id>/orders', methods=['GET'])
+def list_customer_orders(customer_id):
+    """ Returns a page of the Orders of a customer, newest first """
+    app.logger.info('Request for the orders of customer %s', customer_id)
+    criteria = get_order_criteria()
+    criteria['customer_id'] = customer_id
+    return list_orders_page(criteria, get_fieldset(), newest_first=True, endpoint='list_customer_orders',
+                            customer_id=customer_id)
+
+
+@app.route('/customers/<int:customer_id>/orders/summary', methods=['GET'])
+def get_customer_order_summary(customer_id):
+    """ Returns the number of Orders of a customer and their lifetime total """
+    return make_response(jsonify(Order.customer_summary(customer_id)), status.HTTP_200_OK)
+
+
+######################################################################
+# ORDER STATISTICS
+######################################################################
+@app.route('/orders/stats', methods=['GET'])
+def get_order_stats():
+    """
+    Returns Order statistics
+    The counts and revenue are aggregated by the database and accept the same filters as GET /orders
+    """
+    app.logger.info('Request for order stats')
+    try:
+        top = int(request.args.get('top', 10))
+    except ValueError:
+        top = -1
+    if top < 0 or top > MAX_STATS_TOP:
+        raise DataValidationError('top must be an integer between 0 and {}'.format(MAX_STATS_TOP))
+    return make_response(jsonify(Order.stats(top=top, **get_order_criteria())), status.HTTP_200_OK)
+
+
+######################################################################
+# DAILY ORDER ROLLUPS
+######################################################################
+@app.route('/orders/rollups', methods=['GET'])
+def get_order_rollups():
+    """
+    Returns the Order counts and revenue per day and status
+    The rollups are read from the order_daily_rollup table kept up to date by
+    flask refresh-rollups, so they include the changes up to the watermark
+    """
+    app.logger.info('Request for order rollups')
+    last_day = parse_date(request.args['to'], 'to') if request.args.get('to') else datetime.utcnow().date()
+    first_day = parse_date(request.args['from'], 'from') if request.args.get('from') \
+        else last_day - timedelta(days=min(DEFAULT_ROLLUP_DAYS - 1, (last_day - date.min).days))
+    if first_day > last_day or (last_day - first_day).days >= MAX_ROLLUP_DAYS:
+        raise DataValidationError('from must be at most {} days before to'.format(MAX_ROLLUP_DAYS - 1))
+    rollups = OrderRollup.find_range(first_day, last_day)
+    watermark = OrderRollupState.current_watermark()
+    return make_response(jsonify({'from': first_day.isoformat(),
+                                  'to': last_day.isoformat(),
+                                  'watermark': watermark.isoformat() if watermark else None,
+                                  'rollups': [rollup.serialize() for rollup in rollups]}), status.HTTP_200_OK)
+
+
+######################################################################
+# ORDER CACHE STATISTICS
+######################################################################
+@app.route('/orders/cache', methods=['GET'])
+def get_order_cache_stats():
+    """ Returns the hit and miss counters of the Order cache """
+    return make_response(jsonify(order_cache.stats()), status.HTTP_200_OK)
+
+
+######################################################################
+# ORDER CHANGE FEED
+######################################################################
+@app.route('/orders/changes', methods=['GET'])
+def list_order_changes():
+    """
+    Returns the Orders changed since a token
+    This endpoint lists the Orders created or changed (upsert) and the ids of
+    the Orders deleted or archived (delete) since the token returned as next by
+    the previous call, oldest first; without since it starts from the beginning.
+    Keep calling with next while has_more is true, then poll with it later
+    """
+    app.logger.info('Request for order changes')
+    # a lagging replica could let the token move past changes it has not replayed yet
+    db.use_primary()
+    limit = get_page_limit()
+    order_after, tombstone_after = decode_change_token(request.args['since']) if request.args.get('since') \
+        else (None, None)
+    fieldset = get_fieldset()
+    until = db.session.query(db.func.now()).scalar().replace(tzinfo=None) - timedelta(seconds=CHANGE_FEED_DELAY)
+
+    # the next limit changes are among the next limit of each kind
+    order_rows = Order.find_changes(limit + 1, order_after, until, fieldset.columns)
+    tombstones = OrderTombstone.find_after(limit + 1, tombstone_after, until)
+    changes = sorted([(order_row['last_updated'], order_row['id'], order_row) for order_row in order_rows] +
+                     [(tombstone.deleted_at, tombstone.id, tombstone) for tombstone in tombstones],
+                     key=lambda change: change[:2])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    for changed_at, key, change in changes:
+        if isinstance(change, OrderTombstone):
+            tombstone_after = (changed_at, key)
+        else:
+            order_after = (changed_at, key)
+    fieldset.load([change for _, _, change in changes if not isinstance(change, OrderTombstone)])
+
+    next_token = encode_change_token(order_after, tombstone_after)
+    headers = {}
+    if has_more:
+        headers['Link'] = '<{}>; rel="next"'.format(url_for('list_order_changes', _external=True,
+                                                            **dict(request.args.to_dict(), since=next_token)))
+    results = [{'type': 'delete', 'id': change.order_id, 'changed_at': changed_at}
+               if isinstance(change, OrderTombstone) else
+               {'type': 'upsert', 'id': change['id'], 'changed_at': changed_at, 'order': fieldset.project(change)}
+               for changed_at, _, change in changes]
+    return json_response({'changes': results, 'next': next_token, 'has_more': has_more}, status.HTTP_200_OK,
+                         headers)
+
+
+######################################################################
+# ORDER EVENT BACKLOG
+######################################################################
+@app.route('/orders/events', methods=['GET'])
+def get_order_event_stats():
+    """ Returns the number of Order events not delivered yet """
+    return make_response(jsonify(OrderEvent.backlog(EVENT_MAX_ATTEMPTS)), status.HTTP_200_OK)
 
 
 ######################################################################
@@ -157,7 +468,7 @@ def create_orders():
     check_content_type('application/json')
     order = Order()
     order.deserialize(request.get_json())
-    order.save()
+    order.save(OrderEvent.CREATED)
     message = order.serialize()
     location_url = url_for('get_orders', order_id=order.id, _external=True)
     return make_response(jsonify(message), status.HTTP_201_CREATED,
@@ -166,6 +477,52 @@ def create_orders():
                          })
 
 
+######################################################################
+# ADD MANY ORDERS
+######################################################################
+@app.route('/orders/bulk', methods=['POST'])
+def create_orders_bulk():
+    """
+    Creates many Orders
+    This endpoint validates every Order in the posted JSON array (or NDJSON)
+    and creates them all in one transaction, or none of them if any is invalid
+    """
+    app.logger.info('Request to bulk create orders')
+    check_content_type('application/json', NDJSON)
+    if request.headers['Content-Type'] == NDJSON:
+        try:
+            payload = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError as error:
+            raise DataValidationError('Invalid NDJSON: {}'.format(error))
+    else:
+        payload = request.get_json()
+    if not isinstance(payload, list):
+        raise DataValidationError('Invalid orders: body of request must be a list of orders')
+    if len(payload) > MAX_BULK_ORDERS:
+        raise DataValidationError('Invalid orders: at most {} orders can be created at once'.format(MAX_BULK_ORDERS))
+
+    orders = []
+    errors = []
+    for index, data in enumerate(payload):
+        try:
+            orders.append(Order().deserialize(data))
+        except DataValidationError as error:
+            errors.append({'index': index, 'message': str(error), 'errors': error.errors})
+    if errors:
+        app.logger.warning('Rejected bulk create with %d invalid orders', len(errors))
+        return make_response(jsonify(status=status.HTTP_400_BAD_REQUEST,
+                                     error='Bad Request',
+                                     message='{} of {} orders are invalid'.format(len(errors), len(payload)),
+                                     errors=errors), status.HTTP_400_BAD_REQUEST)
+
+    order_ids = Order.bulk_create(orders, event_type=OrderEvent.CREATED)
+    results = [{'index': index,
+                'id': order_id,
+                'location': url_for('get_orders', order_id=order_id, _external=True)}
+               for index, order_id in enumerate(order_ids)]
+    return make_response(jsonify(results), status.HTTP_201_CREATED)
+
+
 ######################################################################
 # UPDATE AN EXISTING ORDER
 ######################################################################
@@ -177,16 +534,36 @@ def update_orders(order_id):
     """
     app.logger.info('Request to update order with order id: %s', order_id)
     check_content_type('application/json')
-    order = Order.find(order_id)
+    order = Order.find_for_update(order_id)
     if not order:
         raise NotFound("Order with id '{}' was not found.".format(order_id))
-    # this is a bit of a hack, but since full order is posted, delete order items so not duplicated
-    order.order_items.delete()
-    # now deserialize json
-    order.deserialize(request.get_json())
-    order.id = order_id
-    order.save()
-    return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+    check_if_match(order)
+    # only the items that changed are inserted, updated or deleted
+    order.update(request.get_json())
+    order.save(OrderEvent.UPDATED)
+    order_cache.invalidate(order_id)
+    return order_response(order)
+
+
+######################################################################
+# UPDATE PART OF AN EXISTING ORDER
+######################################################################
+@app.route('/orders/<int:order_id>', methods=['PATCH'])
+def patch_orders(order_id):
+    """
+    Update part of an Order
+    This endpoint will only change the fields present in the body that is posted
+    """
+    app.logger.info('Request to patch order with order id: %s', order_id)
+    check_content_type('application/json')
+    order = Order.find_for_update(order_id)
+    if not order:
+        raise NotFound("Order with id '{}' was not found.".format(order_id))
+    check_if_match(order)
+    order.update(request.get_json(), partial=True)
+    order.save(OrderEvent.UPDATED)
+    order_cache.invalidate(order_id)
+    return order_response(order)
 
 
 ######################################################################
@@ -199,9 +576,9 @@ def delete_orders(order_id):
     This endpoint will delete an order based the id specified in the path
     """
     app.logger.info('Request to delete order with id: %s', order_id)
-    order = Order.find(order_id)
-    if order:
-        order.delete()
+    # one DELETE, the items go with the order through the cascading foreign key
+    if Order.remove([order_id], OrderEvent.DELETED):
+        order_cache.invalidate(order_id)
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 
@@ -212,19 +589,85 @@ def delete_orders(order_id):
 def cancel_orders(order_id):
     """
     Cancel an order
-    This endpoint will cancel an order and notify any other systems
+    This endpoint will cancel an order that has not been shipped yet; other
+    systems like shipping and billing are notified by the event worker
     """
     app.logger.info('Request to cancel order with id: %s', order_id)
-    order = Order.find(order_id)
+    order = Order.find_for_update(order_id)
     if not order:
         raise NotFound("Order with id '{}' was not found.".format(order_id))
 
-    # TODO should probably check to make sure this order hasn't been shipped or delivered first
-    order.id = order_id
-    order.status = OrderStatus.CANCELED
-    order.save()
-    # Notify other systems like shipping/billing of cancellation...
-    return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+    check_if_match(order)
+    OrderStatus.check_transition(order_id, order.status, OrderStatus.CANCELED)
+    # the UPDATE only cancels the Order if its status still allows it
+    if not Order.change_status([order_id], OrderStatus.CANCELED, OrderEvent.CANCELED):
+        raise StatusTransitionError("Order with id '{}' can no longer be canceled.".format(order_id))
+    order_cache.invalidate(order_id)
+    return order_response(order)
+
+
+######################################################################
+# CHANGE THE STATUS OF MANY ORDERS
+######################################################################
+@app.route('/orders/status', methods=['POST'])
+def change_orders_status():
+    """
+    Change the status of many Orders
+    This endpoint moves the Orders listed in the posted {"ids": [...], "status": ...}
+    to the status with one UPDATE; Orders that don't exist or whose current
+    status may not move to it (e.g. delivered to processing) are left unchanged
+    """
+    check_content_type('application/json')
+    data = validate_status_change(request.get_json())
+    order_ids = sorted(set(data['ids']))
+    app.logger.info('Request to change the status of %d orders to %s', len(order_ids), data['status'])
+    event_type = OrderEvent.CANCELED if data['status'] == OrderStatus.CANCELED else OrderEvent.UPDATED
+    changed = Order.change_status(order_ids, data['status'], event_type)
+    order_cache.invalidate_many(changed)
+    changed_ids = set(changed)
+    return make_response(jsonify(status=data['status'],
+                                 changed=changed,
+                                 unchanged=[order_id for order_id in order_ids if order_id not in changed_ids]),
+                         status.HTTP_200_OK)
+
+
+######################################################################
+# ARCHIVE OLD ORDERS (admin)
+######################################################################
+@app.route('/orders/archive', methods=['POST'])
+def archive_old_orders():
+    """
+    Archive old Orders
+    This endpoint moves delivered and canceled Orders older than older_than_days
+    (default RETENTION_DAYS) to the archive tables, at most max_batches batches
+    per request; done is false while older Orders remain. It requires the
+    ADMIN_TOKEN as a bearer token and is turned off when none is set
+    """
+    check_admin_token()
+    data = {}
+    if request.get_data():
+        check_content_type('application/json')
+        data, errors = ARCHIVE_SCHEMA.validate(request.get_json())
+        if errors:
+            raise DataValidationError('Invalid archive request: ' + '; '.join(errors), errors)
+    app.logger.info('Request to archive orders with %s', data)
+    result = archive_orders(data.get('older_than_days', RETENTION_DAYS),
+                            data.get('batch_size', RETENTION_BATCH_SIZE),
+                            min(data.get('max_batches', MAX_ARCHIVE_BATCHES), MAX_ARCHIVE_BATCHES),
+                            on_batch=order_cache.invalidate_many)
+    return make_response(jsonify(cutoff=result['cutoff'].isoformat(),
+                                 archived=result['archived'],
+                                 batches=result['batches'],
+                                 done=result['done']), status.HTTP_200_OK)
+
+
+######################################################################
+# METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """ Returns the request metrics in the Prometheus text format """
+    return Response(metrics.REGISTRY.render(), status.HTTP_200_OK, mimetype='text/plain; version=0.0.4')
 
 
 ######################################################################
@@ -234,6 +677,7 @@ def cancel_orders(order_id):
 def pets_reset():
     """ Removes all orders from the database """
     Order.delete_all()
+    order_cache.clear()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 
@@ -244,15 +688,212 @@ def pets_reset():
 def init_db():
     """ Initializes the SQLAlchemy app """
     # global app
+    database.init_app(app)
     Order.init_db(app)
 
 
-def check_content_type(content_type):
+@app.cli.command('create-db')
+def create_db():
+    """ Creates the database tables and indexes that do not exist yet """
+    database.init_app(app)
+    if partitions.DB_PARTITION_ORDERS:
+        partitions.create_tables(db.engine)
+    db.create_all()
+    partitions.create_partitions(db.engine)
+    app.logger.info('Database tables created')
+
+
+@app.cli.command('refresh-rollups')
+def refresh_rollups_command():
+    """ Recomputes the daily order rollups of the days that changed since the last run """
+    database.init_app(app)
+    days = refresh_rollups()
+    click.echo('Refreshed the rollups of {} days'.format('all' if days is None else days))
+
+
+@app.cli.command('partition-orders')
+@click.option('--months-ahead', type=int, default=partitions.PARTITION_MONTHS_AHEAD, show_default=True,
+              help='Months of partitions to create ahead of the current one')
+@click.option('--detach-before', type=click.DateTime(formats=['%Y-%m-%d', '%Y-%m']),
+              help='Detach the partitions of the months that end before this date')
+def partition_orders_command(months_ahead, detach_before):
+    """ Creates the coming monthly partitions of the order table and detaches old ones """
+    database.init_app(app)
+    if not partitions.is_partitioned(db.engine):
+        raise click.ClickException('The order table is not partitioned, see DB_PARTITION_ORDERS')
+    for name in partitions.create_partitions(db.engine, months_ahead):
+        click.echo('Created partition {}'.format(name))
+    if detach_before:
+        for name in partitions.detach_partitions(db.engine, detach_before):
+            click.echo('Detached partition {}'.format(name))
+
+
+@app.cli.command('archive-orders')
+@click.option('--older-than-days', type=click.IntRange(1, MAX_RETENTION_DAYS), default=RETENTION_DAYS,
+              show_default=True, help='Archive delivered and canceled orders placed more than this many days ago')
+@click.option('--batch-size', type=int, default=RETENTION_BATCH_SIZE, show_default=True,
+              help='Orders moved per transaction')
+def archive_orders_command(older_than_days, batch_size):
+    """ Moves old delivered and canceled orders to the archive tables """
+    database.init_app(app)
+    result = archive_orders(older_than_days, batch_size)
+    click.echo('Archived {} orders placed before {}'.format(result['archived'], result['cutoff'].isoformat()))
+
+
+def encode_cursor(order_row):
+    """ Builds an opaque page cursor from the (order_date, id) of an Order row """
+    key = '{}|{}'.format(order_row['order_date'].isoformat(), order_row['id'])
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Returns the (order_date, id) stored in a page cursor """
+    try:
+        order_date, order_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        return dateutil.parser.parse(order_date), int(order_id)
+    except (binascii.Error, UnicodeError, ValueError, OverflowError):
+        raise DataValidationError('Invalid cursor: {}'.format(cursor))
+
+
+def encode_change_token(order_key, tombstone_key):
+    """ Builds an opaque change feed token from the last (last_updated, id) of the Orders and of the tombstones """
+    parts = []
+    for key in (order_key, tombstone_key):
+        parts.extend([key[0].isoformat(), str(key[1])] if key else ['', ''])
+    return base64.urlsafe_b64encode('|'.join(parts).encode('utf-8')).decode('ascii')
+
+
+def decode_change_token(token):
+    """ Returns the Order and tombstone keys stored in a change feed token """
+    try:
+        parts = base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8').split('|')
+        if len(parts) != 4:
+            raise ValueError(token)
+        return tuple((dateutil.parser.parse(changed_at), int(key)) if changed_at else None
+                     for changed_at, key in (parts[:2], parts[2:]))
+    except (binascii.Error, UnicodeError, ValueError, OverflowError):
+        raise DataValidationError('Invalid since token: {}'.format(token))
+
+
+def get_page_limit():
+    """ Reads the limit query parameter of a page """
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise DataValidationError('limit must be an integer between 1 and {}'.format(MAX_PAGE_SIZE))
+    return limit
+
+
+def get_order_criteria():
+    """ Collects the Order filters from the query string """
+    criteria = {}
+    if request.args.get('customer_id'):
+        try:
+            criteria['customer_id'] = int(request.args['customer_id'])
+        except ValueError:
+            raise DataValidationError('customer_id must be an integer')
+    if request.args.get('status'):
+        criteria['status'] = request.args['status']
+    if request.args.get('orders_since'):
+        criteria['since'] = parse_date(request.args['orders_since'], 'orders_since')
+    if request.args.get('orders_until'):
+        # orders_until is inclusive so match anything before the start of the next day
+        try:
+            criteria['before'] = parse_date(request.args['orders_until'], 'orders_until') + timedelta(days=1)
+        except OverflowError:
+            raise DataValidationError('orders_until must be before {}'.format(date.max.isoformat()))
+    return criteria
+
+
+def get_fieldset():
+    """ Reads the fields and include query parameters """
+    fields = request.args.get('fields')
+    include = [name.strip() for name in request.args.get('include', '').split(',') if name.strip()]
+    if any(name != 'items' for name in include):
+        raise DataValidationError('include only accepts items')
+    if fields is None:
+        return Fieldset()
+    return Fieldset([field.strip() for field in fields.split(',') if field.strip()], include_items=bool(include))
+
+
+def parse_date(value, name):
+    """ Parses a YYYY-MM-DD query parameter """
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise DataValidationError('{} must be a date formatted as YYYY-MM-DD'.format(name))
+
+
+def order_etag(order_id, last_updated, fields=''):
+    """ Returns the strong ETag of an Order version, fields tells partial representations apart """
+    version = '{}:{}:{}'.format(order_id, last_updated.isoformat() if last_updated else '', fields)
+    return hashlib.sha1(version.encode('utf-8')).hexdigest()
+
+
+def orders_etag(order_rows, fields=''):
+    """ Returns the ETag of a list of Order rows, which changes when any of them is added, removed or updated """
+    digest = hashlib.sha1(fields.encode('utf-8'))
+    for order_row in order_rows:
+        digest.update(order_etag(order_row['id'], order_row['last_updated']).encode('ascii'))
+    return digest.hexdigest()
+
+
+def is_not_modified(etag, last_updated):
+    """ Checks the If-None-Match and If-Modified-Since headers of a GET """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_updated:
+        return last_updated.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def not_modified(etag, headers=None):
+    """ Returns an empty 304_NOT_MODIFIED response """
+    response = make_response('', status.HTTP_304_NOT_MODIFIED, headers or {})
+    response.set_etag(etag)
+    return response
+
+
+def check_if_match(order):
+    """ Rejects the request with 412 if its If-Match header doesn't match the Order locked by find_for_update """
+    if request.if_match and not request.if_match.contains(order_etag(order.id, order.last_updated)):
+        raise PreconditionFailed("Order with id '{}' has been modified.".format(order.id))
+
+
+def order_response(order):
+    """ Returns an Order with its ETag and Last-Modified headers """
+    with metrics.timer('serialize'):
+        response = make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+    response.set_etag(order_etag(order.id, order.last_updated))
+    response.last_modified = order.last_updated
+    return response
+
+
+def wants_stream():
+    """ Checks if the client asked for a streamed NDJSON response """
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def check_content_type(*content_types):
     """ Checks that the media type is correct """
-    if request.headers['Content-Type'] == content_type:
+    if request.headers.get('Content-Type') in content_types:
+        return
+    app.logger.error('Invalid Content-Type: %s', request.headers.get('Content-Type'))
+    abort(415, 'Content-Type must be {}'.format(' or '.join(content_types)))
+
+
+def check_admin_token():
+    """ Checks that the request carries the admin token """
+    token = app.config.get('ADMIN_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    if token and hmac.compare_digest(authorization.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8')):
         return
-    app.logger.error('Invalid Content-Type: %s', request.headers['Content-Type'])
-    abort(415, 'Content-Type must be {}'.format(content_type))
+    app.logger.error('Admin request without the admin token')
+    abort(403, 'Authorization must be Bearer with the admin token')
 
 
 def initialize_logging(log_level=logging.INFO):
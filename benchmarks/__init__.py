@@ -0,0 +1,4 @@
+"""
+Package: benchmarks
+Micro-benchmarks and regression reports for the Orders Service
+"""
@@ -0,0 +1,161 @@
+"""
+Orders Service Concurrency Benchmark
+Starts the service under gunicorn with each worker class at the same number
+of workers and measures throughput and latency percentiles while clients
+send requests concurrently
+
+Like bench_orders it drops and recreates the tables of the database it runs
+against, which is the one configured by the DB_* environment variables
+since gunicorn starts the app from them, so point it at a scratch database
+
+Usage:
+  python -m benchmarks.bench_concurrency --workers 2 --concurrency 1 8 32
+  python -m benchmarks.bench_concurrency --worker-classes sync gevent --duration 10
+"""
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from app import service
+from benchmarks import bench_orders
+
+DEFAULT_WORKER_CLASSES = ('sync', 'gevent')
+DEFAULT_WORKERS = 2
+DEFAULT_CONCURRENCY = (1, 8, 32)
+DEFAULT_DURATION = 5.0
+DEFAULT_SIZE = 1000
+STARTUP_TIMEOUT = 30.0
+
+# the requests each client sends in turn, {order_id} is a random seeded Order
+PATHS = ('/orders?limit=50', '/orders/{order_id}', '/orders/stats')
+
+
+def free_port():
+    """ Returns a TCP port nothing listens on """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(worker_class, workers, port):
+    """ Starts gunicorn and waits until it answers """
+    # gunicorn 19 cannot be run with -m
+    command = [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+               '--config', 'gunicorn.conf.py', '--bind', '127.0.0.1:{}'.format(port),
+               '--workers', str(workers), '--worker-class', worker_class, 'run:app']
+    server = subprocess.Popen(command, cwd=bench_orders.ROOT_DIR, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen('http://127.0.0.1:{}/orders/cache'.format(port), timeout=1).close()
+            return server
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            if server.poll() is not None:
+                break
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('gunicorn with {} workers did not start'.format(worker_class))
+
+
+def load(base_url, order_ids, concurrency, duration, paths=PATHS):
+    """ Sends requests from concurrency threads for duration seconds
+    Returns:
+        the requests per second, latency percentiles in milliseconds and error count
+    """
+    samples = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(seed):
+        rand = random.Random(seed)
+        latencies = []
+        failures = 0
+        while time.monotonic() < deadline:
+            path = rand.choice(paths).format(order_id=rand.choice(order_ids))
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base_url + path, timeout=30) as response:
+                    response.read()
+                latencies.append((time.perf_counter() - start) * 1000)
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                failures += 1
+        with lock:
+            samples.extend(latencies)
+            errors[0] += failures
+
+    started = time.monotonic()
+    clients = [threading.Thread(target=client, args=(seed,)) for seed in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return {'requests_per_sec': len(samples) / elapsed,
+            'p50': bench_orders.percentile(samples, 0.50) if samples else 0.0,
+            'p99': bench_orders.percentile(samples, 0.99) if samples else 0.0,
+            'errors': errors[0]}
+
+
+def run(worker_classes=DEFAULT_WORKER_CLASSES, workers=DEFAULT_WORKERS, concurrency=DEFAULT_CONCURRENCY,
+        duration=DEFAULT_DURATION, size=DEFAULT_SIZE):
+    """ Runs the load at every concurrency against every worker class
+    Returns:
+        {worker class: {concurrency: result}}
+    """
+    service.init_db()
+    order_ids = bench_orders.seed_orders(size)
+    results = {}
+    for worker_class in worker_classes:
+        port = free_port()
+        server = start_server(worker_class, workers, port)
+        try:
+            results[worker_class] = {}
+            for clients in concurrency:
+                results[worker_class][str(clients)] = load('http://127.0.0.1:{}'.format(port), order_ids,
+                                                           clients, duration)
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def format_results(results, workers):
+    """ Returns the results as a text table """
+    lines = ['{} workers per class'.format(workers),
+             '{:<8} {:>7} {:>9} {:>9} {:>9} {:>7}'.format('class', 'clients', 'req/s', 'p50 ms', 'p99 ms', 'errors')]
+    for worker_class, by_concurrency in results.items():
+        for clients, result in by_concurrency.items():
+            lines.append('{:<8} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>7}'.format(
+                worker_class, clients, result['requests_per_sec'], result['p50'], result['p99'], result['errors']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description='Compare the gunicorn worker classes of the Orders Service')
+    parser.add_argument('--worker-classes', nargs='+', default=list(DEFAULT_WORKER_CLASSES),
+                        help='gunicorn worker classes to compare')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='worker processes of every class')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=list(DEFAULT_CONCURRENCY),
+                        help='numbers of concurrent clients')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='seconds of load per run')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE, help='number of orders to seed')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('GUNICORN_WORKER_CONNECTIONS', str(max(args.concurrency)))
+    results = run(args.worker_classes, args.workers, args.concurrency, args.duration, args.size)
+    print(format_results(results, args.workers))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,308 @@
+"""
+Orders Service Benchmarks
+Seeds N orders with the test factory and measures the latency percentiles
+and SQL statements per call of the service endpoints and model methods
+
+The benchmarks drop and recreate the tables of the database they run
+against, so point them at a scratch database. Importing the app still needs
+the DB_* environment variables
+
+Usage:
+  python -m benchmarks.bench_orders --sizes 100 1000 10000 --save benchmarks/baseline.json
+  python -m benchmarks.bench_orders --sizes 100 1000 10000 --compare benchmarks/baseline.json
+  python -m benchmarks.bench_orders --database-uri postgres://postgres@localhost/orders_bench
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import dateutil.parser
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app, schema, service
+from app.models import Order, db
+from app.serializers import json_response
+from tests.order_factory import OrderFactory
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DATABASE_URI = 'sqlite:///{}'.format(os.path.join(ROOT_DIR, 'db', 'benchmark.sqlite'))
+DEFAULT_SIZES = (100, 1000, 10000)
+DEFAULT_ITERATIONS = 20
+DEFAULT_THRESHOLD = 0.2
+SEED_CHUNK_SIZE = 1000
+
+# name -> function(context) returning the callable to time, in registration order
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """ Registers a benchmark setup function """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class BenchmarkContext:
+    """ The state shared by the benchmarks of one data size """
+
+    def __init__(self, size, order_ids):
+        self.size = size
+        self.order_ids = order_ids
+        self.client = app.test_client()
+        self.random = random.Random(size)
+
+    def random_order_id(self):
+        """ Returns the id of one of the seeded orders """
+        return self.random.choice(self.order_ids)
+
+
+######################################################################
+#  B E N C H M A R K S
+######################################################################
+@benchmark('boot')
+def bench_boot(context):
+    """ The time a new worker process takes to import the app, without touching the database """
+    command = [sys.executable, '-c', 'import run']
+    return lambda: subprocess.run(command, cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  check=True)
+
+
+@benchmark('list_orders_page')
+def bench_list_orders_page(context):
+    return lambda: context.client.get('/orders', query_string='limit=100')
+
+
+@benchmark('list_orders')
+def bench_list_orders(context):
+    return lambda: context.client.get('/orders')
+
+
+@benchmark('get_orders')
+def bench_get_orders(context):
+    def get_order():
+        service.order_cache.clear()
+        return context.client.get('/orders/{}'.format(context.random_order_id()))
+    return get_order
+
+
+@benchmark('get_orders_cached')
+def bench_get_orders_cached(context):
+    order_id = context.random_order_id()
+    return lambda: context.client.get('/orders/{}'.format(order_id))
+
+
+@benchmark('create_orders')
+def bench_create_orders(context):
+    payload = OrderFactory().serialize()
+    return lambda: context.client.post('/orders', json=payload, content_type='application/json')
+
+
+@benchmark('update_orders')
+def bench_update_orders(context):
+    order_id = context.random_order_id()
+    payload = context.client.get('/orders/{}'.format(order_id)).get_json()
+
+    def update_order():
+        payload['order_items'][0]['quantity'] += 1
+        return context.client.put('/orders/{}'.format(order_id), json=payload, content_type='application/json')
+    return update_order
+
+
+@benchmark('serialize')
+def bench_serialize(context):
+    order = Order.preload_items([Order.find(context.random_order_id())])[0]
+    return order.serialize
+
+
+@benchmark('encode_list_orm')
+def bench_encode_list_orm(context):
+    """ The list encoding used before the row fast path, for reference """
+    orders = Order.all()
+    return lambda: app.response_class(json.dumps([order.serialize() for order in orders], indent=2),
+                                      mimetype='application/json')
+
+
+@benchmark('encode_list_rows')
+def bench_encode_list_rows(context):
+    order_rows = Order.fetch_item_rows(Order.fetch_rows(Order.query.order_by(Order.id)))
+    return lambda: json_response(order_rows, 200)
+
+
+@benchmark('deserialize')
+def bench_deserialize(context):
+    payload = OrderFactory().serialize()
+    return lambda: Order().deserialize(payload)
+
+
+@benchmark('parse_date')
+def bench_parse_date(context):
+    return lambda: schema.parse_datetime('2019-04-01T12:30:05.123456')
+
+
+@benchmark('parse_date_dateutil')
+def bench_parse_date_dateutil(context):
+    """ The order_date parsing used before the schema fast path, for reference """
+    return lambda: dateutil.parser.parse('2019-04-01T12:30:05.123456')
+
+
+######################################################################
+#  H A R N E S S
+######################################################################
+@contextmanager
+def count_queries():
+    """ Counts the SQL statements executed inside the block """
+    counter = {'queries': 0}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counter['queries'] += 1
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def percentile(samples, fraction):
+    """ Returns the nearest-rank percentile of a list of samples """
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def measure(func, iterations):
+    """ Times func and returns its latency percentiles in milliseconds, queries per call
+    and, when func returns a response, the body size and throughput in bytes per second
+    """
+    func()  # warm up caches and connections
+    samples = []
+    body_bytes = 0
+    with count_queries() as counter:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            result = func()
+            samples.append((time.perf_counter() - start) * 1000)
+            if hasattr(result, 'get_data'):
+                body_bytes += len(result.get_data())
+    return {'p50': percentile(samples, 0.50),
+            'p95': percentile(samples, 0.95),
+            'p99': percentile(samples, 0.99),
+            'mean': sum(samples) / len(samples),
+            'queries': counter['queries'] / iterations,
+            'bytes': body_bytes / iterations,
+            'bytes_per_sec': body_bytes / (sum(samples) / 1000) if sum(samples) else 0.0}
+
+
+def seed_orders(size):
+    """ Recreates the tables and inserts size orders made by the test factory """
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    service.order_cache.clear()
+    for start in range(0, size, SEED_CHUNK_SIZE):
+        orders = [Order().deserialize(OrderFactory().serialize())
+                  for _ in range(min(SEED_CHUNK_SIZE, size - start))]
+        if db.engine.name == 'postgresql':
+            Order.bulk_create(orders)
+        else:
+            db.session.add_all(orders)
+            db.session.commit()
+    return [order_id for (order_id,) in db.session.query(Order.id).order_by(Order.id)]
+
+
+def run(sizes=DEFAULT_SIZES, iterations=DEFAULT_ITERATIONS, names=None, database_uri=None):
+    """ Runs the benchmarks at every size and returns {size: {name: result}} """
+    app.debug = False
+    if database_uri:
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    service.init_db()
+    results = {}
+    for size in sizes:
+        context = BenchmarkContext(size, seed_orders(size))
+        results[str(size)] = {}
+        for name, setup in BENCHMARKS.items():
+            if names and name not in names:
+                continue
+            results[str(size)][name] = measure(setup(context), iterations)
+    db.session.remove()
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """ Compares the p50 latencies with a baseline
+    Returns:
+        a list of (size, name, baseline p50, current p50, change) for every
+        benchmark present in both, and the list of those that got slower than threshold
+    """
+    rows = []
+    for size, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            if name not in baseline.get(size, {}):
+                continue
+            before = baseline[size][name]['p50']
+            change = (result['p50'] - before) / before if before else 0.0
+            rows.append((size, name, before, result['p50'], change))
+    regressions = [row for row in rows if row[4] > threshold]
+    return rows, regressions
+
+
+def format_results(results):
+    """ Returns the results as a text table """
+    lines = ['{:>7} {:<20} {:>9} {:>9} {:>9} {:>8} {:>9}'.format('size', 'benchmark', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                                 'queries', 'MB/s')]
+    for size, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            lines.append('{:>7} {:<20} {:>9.3f} {:>9.3f} {:>9.3f} {:>8.1f} {:>9.2f}'.format(
+                size, name, result['p50'], result['p95'], result['p99'], result['queries'],
+                result.get('bytes_per_sec', 0.0) / 1e6))
+    return '\n'.join(lines)
+
+
+def format_comparison(rows, threshold=DEFAULT_THRESHOLD):
+    """ Returns the comparison with the baseline as a text table """
+    lines = ['{:>7} {:<20} {:>12} {:>12} {:>8}'.format('size', 'benchmark', 'baseline p50', 'p50', 'change')]
+    for size, name, before, after, change in rows:
+        flag = '  REGRESSION' if change > threshold else ''
+        lines.append('{:>7} {:<20} {:>12.3f} {:>12.3f} {:>+7.1%}{}'.format(size, name, before, after, change, flag))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description='Benchmark the Orders Service')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='numbers of orders to seed')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help='timed calls per benchmark')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('--database-uri', default=DEFAULT_DATABASE_URI,
+                        help='scratch database to seed (its tables are dropped)')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with this JSON baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='p50 slowdown reported as a regression, 0.2 is 20%%')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.iterations, args.only, args.database_uri)
+    print(format_results(results))
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            rows, regressions = compare(results, json.load(baseline_file), args.threshold)
+        print()
+        print(format_comparison(rows, args.threshold))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
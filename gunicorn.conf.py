@@ -0,0 +1,30 @@
+"""
+Gunicorn Configuration
+Used by the Procfile: gunicorn --config gunicorn.conf.py run:app
+
+GUNICORN_WORKER_CLASS=gevent serves each worker's requests concurrently on
+greenlets instead of one at a time: gunicorn patches the standard library
+and psycogreen makes psycopg2 yield while it waits on Postgres, so a request
+blocked on the database no longer blocks its worker. Concurrent requests per
+worker are capped by GUNICORN_WORKER_CONNECTIONS and, for those that query,
+by the connection pool (DB_POOL_SIZE + DB_MAX_OVERFLOW). The gevent and
+psycogreen packages are only needed for this mode
+"""
+import os
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '8000'))
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '100'))
+
+
+def post_fork(server, worker):
+    """ Makes the database driver cooperative for gevent workers and drops the connections
+    a preloaded app opened in the master process
+    """
+    if server.cfg.worker_class_str == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    if server.cfg.preload_app:
+        from app import app, database
+        database.dispose_engine(app)
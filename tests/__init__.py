@@ -1,2 +1,12 @@
 from tests.test_orders import TestOrders
 from tests.test_server import TestOrderServer
+from tests.test_cache import TestOrderCache
+from tests.test_metrics import TestMetrics
+from tests.test_benchmarks import TestBenchmarks
+from tests.test_serializers import TestSerializers
+from tests.test_schema import TestSchema
+from tests.test_events import TestOrderEvents
+from tests.test_database import TestDatabase, TestReadReplicas
+from tests.test_retention import TestRetention
+from tests.test_partitions import TestPartitions
+from tests.test_rollups import TestRollups
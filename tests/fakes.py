@@ -0,0 +1,13 @@
+"""
+Fakes shared by the test cases
+"""
+
+
+class FakeClock:
+    """ A clock that only moves when told to """
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
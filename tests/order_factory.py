@@ -76,6 +76,13 @@ class OrderItemFactory(factory.Factory):
         self.order_id = extracted
 
 
+def save_order(event_type=None, **kwargs):
+    """ Saves an Order made by OrderFactory, with its items and an optional event, and returns it """
+    order = Order().deserialize(OrderFactory(**kwargs).serialize())
+    order.save(event_type)
+    return order
+
+
 if __name__ == '__main__':
     for _ in range(10):
         order = OrderFactory()
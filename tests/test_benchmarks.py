@@ -0,0 +1,92 @@
+"""
+Test cases for the benchmark suite
+Test cases can be run with:
+  pytest
+  coverage report -m
+"""
+
+import socketserver
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from app import app
+from app.models import db
+from benchmarks import bench_concurrency, bench_orders
+
+
+class StubServer(socketserver.ThreadingMixIn, HTTPServer):
+    """ An HTTP server that answers every GET with the requested path, or 500 for /fail """
+    daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(500 if self.path == '/fail' else 200)
+            self.end_headers()
+            self.wfile.write(self.path.encode())
+
+        def log_message(self, *args):
+            pass
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestBenchmarks(unittest.TestCase):
+    """ Benchmark Suite Tests """
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all(app=app)
+
+    def test_run_benchmarks(self):
+        """ Run every benchmark on a tiny data set """
+        results = bench_orders.run(sizes=[3], iterations=2)
+        self.assertEqual(list(results), ['3'])
+        self.assertEqual(list(results['3']), list(bench_orders.BENCHMARKS))
+        for result in results['3'].values():
+            self.assertLessEqual(result['p50'], result['p99'])
+            self.assertGreaterEqual(result['queries'], 0)
+        self.assertEqual(results['3']['get_orders_cached']['queries'], 0)
+        self.assertIn('list_orders_page', bench_orders.format_results(results))
+
+    def test_percentile(self):
+        """ Nearest-rank percentiles """
+        samples = list(range(1, 101))
+        self.assertEqual(bench_orders.percentile(samples, 0.5), 50)
+        self.assertEqual(bench_orders.percentile(samples, 0.99), 99)
+        self.assertEqual(bench_orders.percentile([7], 0.95), 7)
+
+    def test_compare_with_baseline(self):
+        """ Report p50 slowdowns beyond the threshold """
+        baseline = {'10': {'get_orders': {'p50': 1.0}, 'list_orders': {'p50': 2.0}}}
+        results = {'10': {'get_orders': {'p50': 1.1}, 'list_orders': {'p50': 3.0}, 'serialize': {'p50': 0.1}}}
+        rows, regressions = bench_orders.compare(results, baseline, threshold=0.2)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual([(size, name) for size, name, _, _, _ in regressions], [('10', 'list_orders')])
+        self.assertIn('REGRESSION', bench_orders.format_comparison(rows, 0.2))
+
+    def test_concurrent_load(self):
+        """ The concurrency benchmark counts requests and errors of every client """
+        server = StubServer(('127.0.0.1', 0), StubServer.Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        result = bench_concurrency.load(base_url, [1, 2], concurrency=3, duration=0.2, paths=('/orders/{order_id}',))
+        self.assertGreater(result['requests_per_sec'], 0)
+        self.assertLessEqual(result['p50'], result['p99'])
+        self.assertEqual(result['errors'], 0)
+        result = bench_concurrency.load(base_url, [1], concurrency=2, duration=0.1, paths=('/fail',))
+        self.assertGreater(result['errors'], 0)
+        self.assertEqual(result['p50'], 0.0)
+        table = bench_concurrency.format_results({'sync': {'3': result}}, 2)
+        self.assertIn('2 workers per class', table)
+        self.assertIn('sync', table)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Test cases for the Order cache
+Test cases can be run with:
+  pytest
+  coverage report -m
+"""
+
+import unittest
+
+from app.cache import CacheBackend, LRUCache, OrderCache
+from .fakes import FakeClock
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestOrderCache(unittest.TestCase):
+    """ Test Cases for the Order cache """
+
+    def setUp(self):
+        self.clock = FakeClock(0.0)
+        self.backend = LRUCache(max_size=2, ttl=10, clock=self.clock)
+        self.cache = OrderCache(self.backend)
+
+    def test_lru_eviction(self):
+        """ The least recently used entry is evicted first """
+        self.backend.set(1, 'one')
+        self.backend.set(2, 'two')
+        self.assertEqual(self.backend.get(1), 'one')
+        self.backend.set(3, 'three')
+        self.assertEqual(len(self.backend), 2)
+        self.assertIsNone(self.backend.get(2))
+        self.assertEqual(self.backend.get(1), 'one')
+        self.assertEqual(self.backend.get(3), 'three')
+
+    def test_ttl_expiry(self):
+        """ Entries expire after their time to live """
+        self.backend.set(1, 'one')
+        self.clock.now = 9.9
+        self.assertEqual(self.backend.get(1), 'one')
+        self.clock.now = 10
+        self.assertIsNone(self.backend.get(1))
+        self.assertEqual(len(self.backend), 0)
+
+    def test_read_through(self):
+        """ Misses call the loader and hits do not """
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return {'id': 1}
+
+        self.assertEqual(self.cache.get(1, loader), {'id': 1})
+        self.assertEqual(self.cache.get(1, loader), {'id': 1})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_missing_values_are_not_cached(self):
+        """ A loader returning None is called again next time """
+        self.assertIsNone(self.cache.get(1, lambda: None))
+        self.assertIsNone(self.cache.get(1, lambda: None))
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 2})
+
+    def test_invalidate_and_clear(self):
+        """ Invalidated entries are loaded again """
+        self.cache.get(1, lambda: 'one')
+        self.cache.get(2, lambda: 'two')
+        self.cache.invalidate(1)
+        self.assertEqual(self.cache.get(1, lambda: 'new one'), 'new one')
+        self.cache.invalidate_many([1, 2])
+        self.assertEqual(self.cache.get(1, lambda: 'newer one'), 'newer one')
+        self.cache.clear()
+        self.assertEqual(self.cache.get(2, lambda: 'new two'), 'new two')
+
+    def test_backend_interface(self):
+        """ The backend interface must be implemented """
+        backend = CacheBackend()
+        self.assertRaises(NotImplementedError, backend.get, 1)
+        self.assertRaises(NotImplementedError, backend.set, 1, 'one')
+        self.assertRaises(NotImplementedError, backend.delete, 1)
+        self.assertRaises(NotImplementedError, backend.clear)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+"""
+Test cases for the database engine configuration
+Test cases can be run with:
+  pytest
+  coverage report -m
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+
+from app import app, database, service
+from app.models import Order, OrderItem, OrderStatus, db
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestDatabase(unittest.TestCase):
+    """ Database Engine Tests """
+
+    def setUp(self):
+        database.init_app(app)
+        Order.init_db(app)
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_engine_options(self):
+        """ Postgres gets the pool and session options, SQLite keeps its defaults """
+        options = database.engine_options('postgres://postgres@localhost/orders')
+        self.assertEqual(options['pool_size'], database.DB_POOL_SIZE)
+        self.assertEqual(options['max_overflow'], database.DB_MAX_OVERFLOW)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'application_name': 'orders-service',
+                                                   'options': '-c statement_timeout=30000'})
+        self.assertEqual(database.engine_options('sqlite:///db/test.sqlite'), {})
+
+    def test_session_settings(self):
+        """ Connections carry the statement timeout and application name """
+        self.assertEqual(db.session.execute('SHOW statement_timeout').scalar(), '30s')
+        self.assertEqual(db.session.execute('SHOW application_name').scalar(), 'orders-service')
+        self.assertEqual(db.engine.pool.size(), database.DB_POOL_SIZE)
+
+    def test_connections_are_not_shared_after_fork(self):
+        """ A connection opened by another process is replaced on checkout """
+        db.session.remove()
+        connection = db.engine.connect()
+        record = connection.connection._connection_record
+        dbapi_connection = record.connection
+        connection.close()
+        record.info['pid'] = os.getpid() + 1  # as if opened before a fork
+        connection = db.engine.connect()
+        self.assertIsNot(connection.connection.connection, dbapi_connection)
+        self.assertEqual(connection.connection._connection_record.info['pid'], os.getpid())
+        connection.close()
+
+    def test_import_does_not_connect(self):
+        """ The app can be imported while the database is unreachable """
+        environment = dict(os.environ, DB_HOST='db.invalid', DB_REPLICA_HOSTS='')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run([sys.executable, '-c', 'import run'], cwd=root, env=environment, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def test_create_db_command(self):
+        """ flask create-db creates the missing tables """
+        db.drop_all()
+        result = app.test_cli_runner().invoke(args=['create-db'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(Order.query.count(), 0)
+
+    def test_dispose_engine(self):
+        """ Disposing drops the pooled connections """
+        db.engine.connect().close()
+        self.assertGreater(db.engine.pool.checkedin(), 0)
+        database.dispose_engine(app)
+        self.assertEqual(db.engine.pool.checkedin(), 0)
+
+
+class TestReadReplicas(unittest.TestCase):
+    """ Read Replica Routing Tests """
+
+    def setUp(self):
+        service.init_db()
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        service.order_cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.replica_uris = []
+        # each replica holds one Order of its own so the tests can tell where a read went
+        for customer_id in (101, 102):
+            uri = 'sqlite:///{}'.format(os.path.join(self.directory, 'replica{}.sqlite'.format(customer_id)))
+            engine = create_engine(uri)
+            db.Model.metadata.create_all(engine)
+            engine.execute(Order.__table__.insert().values(customer_id=customer_id, status=OrderStatus.RECEIVED))
+            engine.dispose()
+            self.replica_uris.append(uri)
+        app.config['SQLALCHEMY_REPLICA_URIS'] = self.replica_uris
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+        db.get_replica_engines(app)  # disposes the replica engines
+        db.drop_all()
+        shutil.rmtree(self.directory)
+
+    def _customers(self):
+        return [order.customer_id for order in Order.all()]
+
+    def test_reads_round_robin(self):
+        """ Each session reads from the next replica and keeps using it """
+        Order(customer_id=1, status=OrderStatus.RECEIVED).save()
+        db.session.remove()
+        first = self._customers()
+        self.assertIn(first, ([101], [102]))
+        self.assertEqual(self._customers(), first)
+        db.session.remove()
+        second = self._customers()
+        self.assertEqual(sorted(first + second), [101, 102])
+
+    def test_read_after_write_uses_primary(self):
+        """ Once a session has written, it reads from the primary """
+        order = Order(customer_id=1, status=OrderStatus.RECEIVED)
+        order.save()
+        self.assertEqual(self._customers(), [1])
+        self.assertEqual(Order.find(order.id).customer_id, 1)
+        db.session.remove()
+        db.use_primary()
+        self.assertEqual(self._customers(), [1])
+
+    def test_replica_reads_are_not_cached(self):
+        """ Orders read from a replica are served but not cached, Orders read from the primary are """
+        client = app.test_client()
+        resp = client.get('/orders/1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(resp.get_json()['customer_id'], (101, 102))
+        self.assertIsNone(service.order_cache.lookup(1))
+
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+        db.session.remove()
+        order = Order(customer_id=1, status=OrderStatus.RECEIVED)
+        order.save()
+        order_id = order.id
+        db.session.remove()
+        self.assertEqual(client.get('/orders/{}'.format(order_id)).status_code, 200)
+        self.assertEqual(service.order_cache.lookup(order_id)['customer_id'], 1)
+
+    def test_order_items_read_from_the_same_replica(self):
+        """ GET /orders/<id> reads the items of the Order from the replica it read the Order from """
+        for uri, customer_id in zip(self.replica_uris, (101, 102)):
+            engine = create_engine(uri)
+            engine.execute(OrderItem.__table__.insert().values(order_id=1, product_id=1, quantity=1, price=1.0,
+                                                               name='Item {}'.format(customer_id)))
+            engine.dispose()
+        Order(customer_id=1, status=OrderStatus.RECEIVED,
+              order_items=[OrderItem(product_id=1, name='Item 1', quantity=1, price=1.0)]).save()
+        db.session.remove()
+        data = app.test_client().get('/orders/1').get_json()
+        self.assertIn(data['customer_id'], (101, 102))
+        self.assertEqual([item['name'] for item in data['order_items']], ['Item {}'.format(data['customer_id'])])
+
+    def test_writes_read_from_primary(self):
+        """ GET requests read from a replica, requests that write find Orders on the primary """
+        for customer_id in (1, 2):
+            Order(customer_id=customer_id, status=OrderStatus.RECEIVED).save()
+        order_id = Order.query.filter_by(customer_id=2).one().id  # not an id the replicas have
+        db.session.remove()
+        client = app.test_client()
+        customers = [order['customer_id'] for order in client.get('/orders').get_json()]
+        self.assertIn(customers, ([101], [102]))
+        db.session.remove()
+        resp = client.put('/orders/{}/cancel'.format(order_id))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['customer_id'], 2)
+        self.assertEqual(resp.get_json()['status'], OrderStatus.CANCELED)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
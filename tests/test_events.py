@@ -0,0 +1,211 @@
+"""
+Test cases for the Order event outbox and its delivery
+Test cases can be run with:
+  pytest
+  coverage report -m
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.error
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from app import app
+from app.events import EventDispatcher, EventSink, EventWorker, FileSink, HttpSink, SinkBusyError
+from app.models import Order, OrderEvent, OrderStatus, db
+from .fakes import FakeClock
+from .order_factory import save_order
+
+
+class RecordingSink(EventSink):
+    """ A sink that keeps the batches it receives, or fails with an error """
+
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def send(self, events):
+        if self.error:
+            raise self.error
+        self.batches.append(events)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestOrderEvents(unittest.TestCase):
+    """ Test Cases for Order events """
+
+    def setUp(self):
+        Order.init_db(app)
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        self.clock = FakeClock(datetime(2019, 4, 1, 12, 0))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def _dispatcher(self, sink, **kwargs):
+        # events are recorded with the real clock, so start the fake one after them
+        self.clock.now = datetime.utcnow() + timedelta(seconds=1)
+        return EventDispatcher(sink, retry_delay=10, clock=self.clock, **kwargs)
+
+    def test_save_records_event(self):
+        """ Saving with an event type records the event with the Order """
+        order = save_order(OrderEvent.CREATED, status=OrderStatus.RECEIVED)
+        order.status = OrderStatus.CANCELED
+        order.save(OrderEvent.CANCELED)
+        events = OrderEvent.query.order_by(OrderEvent.id).all()
+        self.assertEqual([event.event_type for event in events], [OrderEvent.CREATED, OrderEvent.CANCELED])
+        self.assertEqual(events[1].serialize()['data'],
+                         {'id': order.id, 'customer_id': order.customer_id, 'status': OrderStatus.CANCELED})
+        order.delete(OrderEvent.DELETED)
+        self.assertEqual(OrderEvent.query.filter_by(event_type=OrderEvent.DELETED, order_id=order.id).count(), 1)
+
+    def test_event_rolled_back_with_order(self):
+        """ An event is only kept if the change of the Order is committed """
+        order = Order(customer_id=7, status=OrderStatus.RECEIVED)
+        db.session.add(order)
+        OrderEvent.record(order, OrderEvent.CREATED)
+        self.assertIsNotNone(order.id)
+        db.session.rollback()
+        self.assertEqual(OrderEvent.query.count(), 0)
+        self.assertEqual(Order.query.count(), 0)
+
+    def test_bulk_create_records_events(self):
+        """ Bulk created Orders get one event each """
+        orders = [Order(customer_id=customer_id, status=OrderStatus.RECEIVED) for customer_id in range(3)]
+        order_ids = Order.bulk_create(orders, chunk_size=2, event_type=OrderEvent.CREATED)
+        events = OrderEvent.query.order_by(OrderEvent.id).all()
+        self.assertEqual([event.order_id for event in events], order_ids)
+        self.assertEqual([json.loads(event.payload)['customer_id'] for event in events], [0, 1, 2])
+
+    def test_dispatch_delivers_batches(self):
+        """ Due events are delivered in batches and marked as delivered """
+        for _ in range(3):
+            save_order(OrderEvent.CREATED, status=OrderStatus.RECEIVED)
+        sink = RecordingSink()
+        dispatcher = self._dispatcher(sink, batch_size=2)
+        self.assertEqual(dispatcher.dispatch_once(), 2)
+        self.assertEqual(dispatcher.dispatch_once(), 1)
+        self.assertEqual(dispatcher.dispatch_once(), 0)
+        self.assertEqual([[event['id'] for event in batch] for batch in sink.batches], [[1, 2], [3]])
+        self.assertEqual(sink.batches[0][0]['type'], OrderEvent.CREATED)
+        self.assertEqual(OrderEvent.backlog(10), {'pending': 0, 'failed': 0})
+
+    def test_dispatch_retries_with_backoff(self):
+        """ A failed batch is retried after an exponential backoff and given up on eventually """
+        save_order(OrderEvent.CREATED, status=OrderStatus.RECEIVED)
+        sink = RecordingSink(error=IOError('connection refused'))
+        dispatcher = self._dispatcher(sink, max_attempts=3)
+        self.assertEqual(dispatcher.dispatch_once(), 0)
+        event = OrderEvent.query.one()
+        self.assertEqual((event.attempts, event.last_error), (1, 'connection refused'))
+        self.assertEqual(event.next_attempt_at, self.clock.now + timedelta(seconds=10))
+
+        self.clock.now += timedelta(seconds=9)
+        self.assertEqual(dispatcher.dispatch_once(), 0)
+        self.assertEqual(OrderEvent.query.one().attempts, 1)  # not due yet
+        self.clock.now += timedelta(seconds=1)
+        dispatcher.dispatch_once()
+        self.assertEqual(OrderEvent.query.one().next_attempt_at, self.clock.now + timedelta(seconds=20))
+
+        self.clock.now += timedelta(seconds=20)
+        dispatcher.dispatch_once()
+        self.assertEqual(OrderEvent.backlog(3), {'pending': 0, 'failed': 1})
+        self.clock.now += timedelta(days=1)
+        sink.error = None
+        self.assertEqual(dispatcher.dispatch_once(), 0)
+        self.assertEqual(sink.batches, [])
+
+    def test_retried_event_holds_back_its_order(self):
+        """ Later events of an Order wait until an older one is delivered, other Orders go on """
+        order = save_order(OrderEvent.CREATED, status=OrderStatus.RECEIVED)
+        sink = RecordingSink(error=IOError('connection refused'))
+        dispatcher = self._dispatcher(sink)
+        self.assertEqual(dispatcher.dispatch_once(), 0)
+        sink.error = None
+        order.status = OrderStatus.CANCELED
+        order.save(OrderEvent.CANCELED)
+        other = save_order(OrderEvent.CREATED, status=OrderStatus.RECEIVED)
+
+        self.assertEqual(dispatcher.dispatch_once(), 1)
+        self.assertEqual([event['order_id'] for event in sink.batches[0]], [other.id])
+        self.assertEqual(dispatcher.dispatch_once(), 0)  # the created event is not due yet
+        self.clock.now += timedelta(seconds=10)
+        self.assertEqual(dispatcher.dispatch_once(), 1)
+        self.assertEqual(dispatcher.dispatch_once(), 1)
+        self.assertEqual([(event['order_id'], event['type']) for batch in sink.batches[1:] for event in batch],
+                         [(order.id, OrderEvent.CREATED), (order.id, OrderEvent.CANCELED)])
+
+    def test_busy_sink_keeps_events_due(self):
+        """ A busy sink pauses the worker without counting an attempt """
+        save_order(OrderEvent.CREATED, status=OrderStatus.RECEIVED)
+        sink = RecordingSink(error=SinkBusyError('busy', retry_after=30))
+        worker = EventWorker(app, self._dispatcher(sink), poll_interval=2)
+        self.assertEqual(worker.run_once(), 30)
+        self.assertEqual(OrderEvent.query.one().attempts, 0)
+        sink.error = None
+        self.assertEqual(worker.run_once(), 2)
+        self.assertEqual(worker.failures, 0)
+        self.assertEqual(len(sink.batches), 1)
+
+    def test_worker_drains_backlog(self):
+        """ The worker asks for the next batch at once after a full one and backs off after errors """
+        for _ in range(2):
+            save_order(OrderEvent.CREATED, status=OrderStatus.RECEIVED)
+        worker = EventWorker(app, self._dispatcher(RecordingSink(), batch_size=2), poll_interval=2)
+        self.assertEqual(worker.run_once(), 0)
+        self.assertEqual(worker.run_once(), 2)
+        with patch.object(OrderEvent, 'pending', side_effect=RuntimeError('database is down')):
+            self.assertEqual(worker.run_once(), 10)
+            self.assertEqual(worker.run_once(), 20)
+
+    def test_worker_thread_stops(self):
+        """ The worker thread delivers events until it is stopped """
+        save_order(OrderEvent.CREATED, status=OrderStatus.RECEIVED)
+        sink = RecordingSink()
+        worker = EventWorker(app, EventDispatcher(sink), poll_interval=0.01)
+        worker.start()
+        worker.stop(timeout=5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(len(sink.batches), 1)
+
+    def test_file_sink(self):
+        """ The file sink appends one JSON document per event """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        sink = FileSink(os.path.join(directory, 'events', 'orders.ndjson'))
+        sink.send([{'id': 1}, {'id': 2}])
+        sink.send([{'id': 3}])
+        with open(sink.path) as sink_file:
+            self.assertEqual([json.loads(line)['id'] for line in sink_file], [1, 2, 3])
+
+    @patch('app.events.urllib.request.urlopen')
+    def test_http_sink(self, urlopen):
+        """ The HTTP sink POSTs JSON arrays and reports a busy server """
+        sink = HttpSink('http://shipping.example/events', timeout=3)
+        sink.send([{'id': 1}])
+        http_request = urlopen.call_args[0][0]
+        self.assertEqual(http_request.get_method(), 'POST')
+        self.assertEqual(json.loads(http_request.data.decode()), [{'id': 1}])
+        self.assertEqual(urlopen.call_args[1], {'timeout': 3})
+
+        urlopen.side_effect = urllib.error.HTTPError(sink.url, 503, 'Busy', {'Retry-After': '15'}, None)
+        with self.assertRaises(SinkBusyError) as context:
+            sink.send([{'id': 1}])
+        self.assertEqual(context.exception.retry_after, 15)
+        urlopen.side_effect = urllib.error.HTTPError(sink.url, 500, 'Error', {}, None)
+        self.assertRaises(urllib.error.HTTPError, sink.send, [{'id': 1}])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
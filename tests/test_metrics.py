@@ -0,0 +1,134 @@
+"""
+Test cases for the request metrics
+Test cases can be run with:
+  pytest
+  coverage report -m
+"""
+
+import copy
+import logging
+import unittest
+
+from flask_api import status  # HTTP Status Codes
+from sqlalchemy.exc import DBAPIError
+
+import app.service as service
+from app import metrics
+from app.models import db
+from .order_factory import OrderFactory
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Request Metrics Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        service.app.debug = False
+        service.initialize_logging(logging.INFO)
+
+    def setUp(self):
+        """ Runs before each test """
+        service.init_db()
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # create new tables
+        service.order_cache.clear()
+        self.app = service.app.test_client()
+
+    def tearDown(self):
+        service.app.config['SERVER_TIMING'] = False
+        db.session.remove()
+        db.drop_all()
+
+    def test_histogram(self):
+        """ Observations are counted in cumulative buckets """
+        histogram = metrics.Histogram('test_seconds', 'Test histogram', ('route',), buckets=(1, 5))
+        histogram.observe(0.5, route='/a')
+        histogram.observe(3, route='/a')
+        histogram.observe(7, route='/a')
+        self.assertEqual(histogram.count(route='/a'), 3)
+        self.assertEqual(histogram.count(route='/b'), 0)
+        samples = histogram.samples()
+        self.assertIn('test_seconds_bucket{route="/a",le="1.0"} 1', samples)
+        self.assertIn('test_seconds_bucket{route="/a",le="5.0"} 2', samples)
+        self.assertIn('test_seconds_bucket{route="/a",le="+Inf"} 3', samples)
+        self.assertIn('test_seconds_sum{route="/a"} 10.5', samples)
+        self.assertIn('test_seconds_count{route="/a"} 3', samples)
+
+    def test_gauge(self):
+        """ Gauges render the values returned by their callback """
+        gauge = metrics.Gauge('test_connections', 'Test gauge', ('state',),
+                              lambda: {('idle',): 2, ('checked_out',): 1})
+        self.assertEqual(gauge.samples(), ['test_connections{state="checked_out"} 1',
+                                           'test_connections{state="idle"} 2'])
+        self.assertEqual(metrics.Gauge('test_empty', 'Test gauge').samples(), [])
+
+    def test_pool_metrics(self):
+        """ The connection pool is reported by GET /metrics """
+        resp = self.app.get('/metrics')
+        body = resp.get_data(as_text=True)
+        self.assertIn('# TYPE orders_db_pool_connections gauge', body)
+        self.assertRegex(body, r'orders_db_pool_connections{state="idle"} \d+')
+        self.assertIn('orders_db_pool_size 5', body)
+
+    def test_request_metrics(self):
+        """ Requests are recorded per route with their query count """
+        order = OrderFactory()
+        resp = self.app.post('/orders', json=order.serialize(), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        route = '/orders/<int:order_id>'
+        before = metrics.REQUEST_QUERIES.count(method='GET', route=route)
+        resp = self.app.get(resp.headers['Location'])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(metrics.REQUEST_QUERIES.count(method='GET', route=route), before + 1)
+        self.assertGreater(metrics.RESPONSE_SIZE.count(method='GET', route=route), 0)
+        self.assertGreater(metrics.SERIALIZATION_TIME.count(method='GET', route=route), 0)
+
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        body = resp.get_data(as_text=True)
+        self.assertIn('# TYPE orders_request_duration_seconds histogram', body)
+        self.assertIn('orders_request_duration_seconds_count{method="GET",route="/orders/<int:order_id>",status="200"}',
+                      body)
+        self.assertIn('orders_request_db_queries_bucket{method="POST",route="/orders"', body)
+
+    def test_stream_metrics(self):
+        """ Streamed responses are recorded with the queries made while streaming """
+        for _ in range(3):
+            self.app.post('/orders', json=OrderFactory().serialize(), content_type='application/json')
+        before = (metrics.REQUEST_QUERIES.count(method='GET', route='/orders'),
+                  metrics.REQUEST_QUERIES.sum(method='GET', route='/orders'))
+        resp = self.app.get('/orders', query_string='stream=1')
+        self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 3)
+        resp.close()
+        self.assertEqual(metrics.REQUEST_QUERIES.count(method='GET', route='/orders'), before[0] + 1)
+        # the Orders and their items
+        self.assertGreaterEqual(metrics.REQUEST_QUERIES.sum(method='GET', route='/orders') - before[1], 2)
+        self.assertGreater(metrics.SERIALIZATION_TIME.count(method='GET', route='/orders'), 0)
+
+    def test_failed_query_timing(self):
+        """ A failed query leaves nothing behind on its pooled connection """
+        with db.engine.connect() as connection:
+            info = copy.deepcopy(connection.info)
+            self.assertRaises(DBAPIError, connection.execute, 'SELECT 1 / 0')
+            self.assertEqual(connection.info, info)
+            self.assertEqual(connection.execute('SELECT 1').scalar(), 1)
+
+    def test_server_timing(self):
+        """ Server-Timing is only sent when enabled """
+        resp = self.app.get('/orders')
+        self.assertNotIn('Server-Timing', resp.headers)
+        service.app.config['SERVER_TIMING'] = True
+        resp = self.app.get('/orders')
+        self.assertIn('db;dur=', resp.headers['Server-Timing'])
+        self.assertIn('serialize;dur=', resp.headers['Server-Timing'])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
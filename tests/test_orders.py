@@ -5,11 +5,15 @@ Test cases can be run with:
   coverage report -m
 """
 
+import json
 import unittest
 from datetime import datetime, date, timedelta
 
+from sqlalchemy import event, inspect
+
 from app import app
-from app.models import Order, OrderItem, OrderStatus, DataValidationError, db
+from app.models import Order, OrderItem, OrderStatus, DataValidationError, StatusTransitionError, db
+from app.serializers import dumps
 
 
 ######################################################################
@@ -38,6 +42,28 @@ class TestOrders(unittest.TestCase):
         db.session.remove()
         db.drop_all()
 
+    def _count_queries(self, func):
+        """ Runs func and returns the number of SQL statements it executed """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engine = db.get_engine()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            func()
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return len(statements)
+
+    def _make_orders(self, count, status=OrderStatus.RECEIVED):
+        """ Saves count orders with two items each """
+        for _ in range(count):
+            order_items = [OrderItem(product_id=1, name="Protein Bar (12 Count)", quantity=3, price=69.00),
+                           OrderItem(product_id=2, name="AirPods", quantity=1, price=159.00)]
+            Order(customer_id=1, status=status, order_items=order_items).save()
+
     def test_delete_all(self):
         order_item = OrderItem(product_id=1, name="Protein Bar (12 Count)", quantity=3, price=69.00)
         order = Order(customer_id=1, status=OrderStatus.RECEIVED, order_items=[order_item])
@@ -84,6 +110,74 @@ class TestOrders(unittest.TestCase):
         self.assertEqual(len(orders), 1)
         self.assertEqual(orders[0].status, OrderStatus.PROCESSING)
 
+    def test_update_only_changed_items(self):
+        """ Update an order by diffing its items """
+        self._make_orders(1)
+        order = Order.all()[0]
+        data = order.serialize()
+        protein_bar, airpods = data['order_items']
+        protein_bar['quantity'] = 5
+        data['order_items'] = [protein_bar,
+                               {'product_id': 3, 'name': 'Soap', 'quantity': 1, 'price': 2.5}]
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.split()[0])
+
+        engine = db.get_engine()
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            order.update(data)
+            order.save()
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(statements.count('DELETE'), 1)
+        self.assertEqual(statements.count('INSERT'), 1)
+        # the changed item and the order's last_updated
+        self.assertEqual(statements.count('UPDATE'), 2)
+
+        items = {item.product_id: item for item in Order.find(order.id).order_items}
+        self.assertEqual(sorted(items), [1, 3])
+        self.assertEqual(items[1].id, protein_bar['id'])
+        self.assertEqual(items[1].quantity, 5)
+        self.assertNotIn(airpods['id'], [item.id for item in items.values()])
+
+    def test_update_matches_items_by_product(self):
+        """ Items without an id are matched by product id """
+        self._make_orders(1)
+        order = Order.all()[0]
+        old_ids = sorted(item.id for item in order.order_items)
+        order.update({'customer_id': 2, 'status': OrderStatus.PROCESSING,
+                      'order_items': [{'product_id': 2, 'name': 'AirPods', 'quantity': 2, 'price': 150},
+                                      {'product_id': 1, 'name': 'Protein Bar', 'quantity': 1, 'price': 69}]})
+        order.save()
+        order = Order.find(order.id)
+        self.assertEqual(order.customer_id, 2)
+        self.assertEqual(sorted(item.id for item in order.order_items), old_ids)
+        self.assertEqual(order.total, 369)
+
+    def test_partial_update(self):
+        """ Partially update an order """
+        self._make_orders(1)
+        order = Order.all()[0]
+        order.update({'status': OrderStatus.PROCESSING}, partial=True)
+        order.save()
+        order = Order.find(order.id)
+        self.assertEqual(order.status, OrderStatus.PROCESSING)
+        self.assertEqual(order.customer_id, 1)
+        self.assertEqual(order.order_items.count(), 2)
+        self.assertRaises(DataValidationError, order.update, {'status': OrderStatus.SHIPPED})
+        self.assertRaises(DataValidationError, order.update, 'this is a string', True)
+
+    def test_update_checks_status_transitions(self):
+        """ An update may only move the status along OrderStatus.TRANSITIONS """
+        self._make_orders(1, status=OrderStatus.DELIVERED)
+        order = Order.all()[0]
+        self.assertRaises(StatusTransitionError, order.update, {'status': OrderStatus.RECEIVED}, True)
+        order.update({'status': OrderStatus.DELIVERED, 'customer_id': 2}, partial=True)
+        order.save()
+        self.assertEqual(Order.find(order.id).customer_id, 2)
+
     def test_delete_a_order(self):
         """ Delete an order """
         order_item = OrderItem(product_id=1, name="Protein Bar (12 Count)", quantity=3, price=69.00)
@@ -164,6 +258,30 @@ class TestOrders(unittest.TestCase):
         order = Order()
         self.assertRaises(DataValidationError, order.deserialize, data)
 
+    def test_deserialize_reports_every_error(self):
+        """ Test deserialization reports all of the invalid fields at once """
+        data = {'customer_id': 'abc', 'status': 'lost', 'order_date': 'not a date',
+                'order_items': [{'product_id': 1, 'name': 'AirPods', 'quantity': 0, 'price': -1}]}
+        with self.assertRaises(DataValidationError) as context:
+            Order().deserialize(data)
+        self.assertEqual(context.exception.errors,
+                         ['customer_id must be an integer',
+                          'status must be one of canceled, delivered, processing, received, shipped',
+                          'order_items[0].quantity must be at least 1',
+                          'order_items[0].price must be at least 0',
+                          'order_date must be an ISO 8601 date'])
+        self.assertTrue(str(context.exception).startswith('Invalid order: customer_id must be an integer; '))
+
+    def test_deserialize_converts_strings(self):
+        """ Test deserialization converts the numeric strings sent by forms """
+        data = {'customer_id': '7', 'status': OrderStatus.RECEIVED, 'order_date': '2019-04-01T10:00:00',
+                'order_items': [{'product_id': '3', 'name': 'AirPods', 'quantity': '2', 'price': '159.99'}]}
+        order = Order().deserialize(data)
+        self.assertEqual(order.customer_id, 7)
+        self.assertEqual(order.order_date, datetime(2019, 4, 1, 10))
+        order_item = order.order_items[0]
+        self.assertEqual((order_item.product_id, order_item.quantity, order_item.price), (3, 2, 159.99))
+
     def test_find_order(self):
         """ Find a order by ID """
         Order(customer_id=1, status=OrderStatus.RECEIVED).save()
@@ -186,6 +304,200 @@ class TestOrders(unittest.TestCase):
         yesterday = date.today() - timedelta(days=1)
         self.assertEqual(len(Order.find_since(yesterday)), 5)
 
+    def test_list_query_count_is_constant(self):
+        """ Serializing all orders does not issue a query per order """
+        self._make_orders(2)
+        db.session.expire_all()
+        few = self._count_queries(lambda: [order.serialize() for order in Order.all()])
+        self._make_orders(8)
+        db.session.expire_all()
+        many = self._count_queries(lambda: [order.serialize() for order in Order.all()])
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, 2)
+
+    def test_find_by_status_preloads_items(self):
+        """ Find by status loads the order items in bulk """
+        self._make_orders(3, OrderStatus.SHIPPED)
+        self._make_orders(2, OrderStatus.RECEIVED)
+        db.session.expire_all()
+        results = []
+        queries = self._count_queries(lambda: results.extend(
+            order.serialize() for order in Order.find_by_status(OrderStatus.SHIPPED)))
+        self.assertEqual(queries, 2)
+        self.assertEqual(len(results), 3)
+        for data in results:
+            self.assertEqual(len(data['order_items']), 2)
+            self.assertEqual(data['order_items'][0]['name'], 'Protein Bar (12 Count)')
+
+    def test_filter_indexes(self):
+        """ The filter columns are indexed """
+        inspector = inspect(db.get_engine())
+        order_indexes = {tuple(index['column_names']) for index in inspector.get_indexes('order')}
+        self.assertIn(('status', 'order_date'), order_indexes)
+        self.assertIn(('customer_id', 'order_date', 'id', 'status', 'last_updated'), order_indexes)
+        item_indexes = {tuple(index['column_names']) for index in inspector.get_indexes('order_item')}
+        self.assertIn(('order_id',), item_indexes)
+
+    def test_find_customer_page_newest_first(self):
+        """ Page through the Orders of a customer newest first """
+        now = datetime.now()
+        for days, customer_id in ((3, 1), (1, 1), (2, 2), (0, 1), (1, 1)):
+            Order(customer_id=customer_id, status=OrderStatus.RECEIVED, order_date=now - timedelta(days=days)).save()
+        order_rows, has_more = Order.find_page(2, newest_first=True, customer_id=1)
+        self.assertTrue(has_more)
+        self.assertEqual([order_row['id'] for order_row in order_rows], [4, 5])
+        last = order_rows[-1]
+        order_rows, has_more = Order.find_page(2, after=(last['order_date'], last['id']), newest_first=True,
+                                               customer_id=1)
+        self.assertFalse(has_more)
+        self.assertEqual([order_row['id'] for order_row in order_rows], [2, 1])
+
+    def test_customer_summary(self):
+        """ The customer summary is one aggregate query """
+        self._make_orders(2)
+        Order(customer_id=1, status=OrderStatus.RECEIVED).save()
+        Order(customer_id=2, status=OrderStatus.RECEIVED,
+              order_items=[OrderItem(product_id=2, name="AirPods", quantity=1, price=159.00)]).save()
+        summaries = []
+        self.assertEqual(self._count_queries(lambda: summaries.append(Order.customer_summary(1))), 1)
+        summary = summaries[0]
+        self.assertEqual(summary['order_count'], 3)
+        self.assertEqual(summary['lifetime_total'], 2 * (3 * 69 + 159))
+        self.assertLessEqual(summary['first_order_date'], summary['last_order_date'])
+        self.assertEqual(Order.customer_summary(3), {'customer_id': 3, 'order_count': 0, 'lifetime_total': 0,
+                                                     'first_order_date': None, 'last_order_date': None})
+
+    def test_find_by_criteria(self):
+        """ Find orders matching several criteria at once """
+        Order(customer_id=1, status=OrderStatus.RECEIVED).save()
+        Order(customer_id=1, status=OrderStatus.SHIPPED).save()
+        Order(customer_id=2, status=OrderStatus.RECEIVED).save()
+        Order(customer_id=1, status=OrderStatus.RECEIVED, order_date=datetime.today() - timedelta(weeks=52)).save()
+        yesterday = date.today() - timedelta(days=1)
+        orders = Order.find_by_criteria(customer_id=1, status=OrderStatus.RECEIVED, since=yesterday)
+        self.assertEqual(len(orders), 1)
+        self.assertEqual(orders[0].customer_id, 1)
+        self.assertEqual(orders[0].status, OrderStatus.RECEIVED)
+        self.assertEqual(len(Order.find_by_criteria(customer_id=1, before=yesterday)), 1)
+
+    def test_bulk_create(self):
+        """ Bulk create orders with a few statements """
+        orders = []
+        for customer_id in range(5):
+            data = {'customer_id': customer_id, 'status': OrderStatus.RECEIVED,
+                    'order_items': [{'product_id': 1, 'name': 'Soap', 'quantity': 2, 'price': 2.5},
+                                    {'product_id': 2, 'name': 'AirPods', 'quantity': 1, 'price': 159}]}
+            orders.append(Order().deserialize(data))
+        order_ids = []
+        queries = self._count_queries(lambda: order_ids.extend(Order.bulk_create(orders, chunk_size=2)))
+        # 3 chunks of orders, 5 chunks of items
+        self.assertEqual(queries, 8)
+        self.assertEqual(len(order_ids), 5)
+        for customer_id, order_id in enumerate(order_ids):
+            order = Order.find(order_id)
+            self.assertEqual(order.customer_id, customer_id)
+            self.assertIsNotNone(order.order_date)
+            self.assertEqual(order.total, 164)
+
+    def test_change_status(self):
+        """ Only the Orders allowed to move to a status are changed, in one statement """
+        self._make_orders(2)
+        self._make_orders(1, status=OrderStatus.PROCESSING)
+        self._make_orders(1, status=OrderStatus.DELIVERED)
+        before = Order.find(3).last_updated
+        changed = []
+        queries = self._count_queries(lambda: changed.extend(Order.change_status([3, 1, 4, 99], OrderStatus.CANCELED)))
+        self.assertEqual(queries, 1)
+        self.assertEqual(changed, [1, 3])
+        self.assertEqual([order.status for order in Order.query.order_by(Order.id)],
+                         [OrderStatus.CANCELED, OrderStatus.RECEIVED, OrderStatus.CANCELED, OrderStatus.DELIVERED])
+        self.assertGreater(Order.find(3).last_updated, before)
+        self.assertEqual(Order.change_status([2], OrderStatus.SHIPPED), [])
+        self.assertEqual(Order.change_status([2], OrderStatus.RECEIVED), [])
+
+    def test_status_transitions(self):
+        """ Every status can be reached from the statuses listed for it """
+        self.assertEqual(OrderStatus.sources(OrderStatus.CANCELED), (OrderStatus.RECEIVED, OrderStatus.PROCESSING))
+        self.assertEqual(OrderStatus.sources(OrderStatus.DELIVERED), (OrderStatus.SHIPPED,))
+        self.assertEqual(OrderStatus.sources(OrderStatus.RECEIVED), ())
+
+    def test_total_computed_by_database(self):
+        """ The total of a saved order is a single aggregate query """
+        self._make_orders(1)
+        order = Order.all()[0]
+        db.session.expire_all()
+        totals = []
+        self.assertEqual(self._count_queries(lambda: totals.append(order.total)), 2)
+        self.assertEqual(totals[0], 366)
+        self.assertEqual(order.serialize()['total'], 366)
+        self.assertEqual(Order.totals([]), {})
+
+    def test_stats(self):
+        """ Aggregate order counts and revenue """
+        self._make_orders(2, OrderStatus.SHIPPED)
+        self._make_orders(1, OrderStatus.RECEIVED)
+        Order(customer_id=2, status=OrderStatus.RECEIVED).save()
+        stats = Order.stats()
+        self.assertEqual(stats['by_status'], [{'status': OrderStatus.RECEIVED, 'count': 2, 'revenue': 366},
+                                              {'status': OrderStatus.SHIPPED, 'count': 2, 'revenue': 732}])
+        self.assertEqual(len(stats['by_day']), 1)
+        self.assertEqual(stats['by_day'][0]['count'], 4)
+        self.assertEqual(stats['by_day'][0]['day'], date.today().isoformat())
+        self.assertEqual(stats['by_customer'], [{'customer_id': 1, 'count': 3, 'revenue': 1098},
+                                                {'customer_id': 2, 'count': 1, 'revenue': 0}])
+        self.assertEqual(stats['top_products'][0], {'product_id': 1, 'name': 'Protein Bar (12 Count)',
+                                                    'quantity': 9, 'revenue': 621})
+        self.assertEqual(stats['top_products'][1]['quantity'], 3)
+
+        stats = Order.stats(top=1, status=OrderStatus.SHIPPED)
+        self.assertEqual(stats['by_status'], [{'status': OrderStatus.SHIPPED, 'count': 2, 'revenue': 732}])
+        self.assertEqual(len(stats['top_products']), 1)
+
+    def test_totals_round_items_the_same_everywhere(self):
+        """ Every total rounds each item to cents half up before adding them """
+        # 1.005 and 2.675 are stored just below the half cent as floats
+        order_items = [OrderItem(product_id=1, name='Soap', quantity=1, price=1.005),
+                       OrderItem(product_id=2, name='Gum', quantity=1, price=2.675)]
+        Order(customer_id=1, status=OrderStatus.RECEIVED, order_items=order_items).save()
+        order = Order.all()[0]
+        self.assertEqual(order.serialize()['total'], 3.69)
+        self.assertEqual(Order.totals([order.id]), {order.id: 3.69})
+        self.assertEqual(Order.fetch_item_rows(Order.fetch_rows(Order.query))[0]['total'], 3.69)
+        self.assertEqual(Order.stats()['by_status'][0]['revenue'], 3.69)
+        self.assertEqual(Order.customer_summary(1)['lifetime_total'], 3.69)
+
+    def test_fetch_rows_match_serialize(self):
+        """ Rows built from tuples serialize like the Order objects """
+        self._make_orders(3)
+        Order(customer_id=2, status=OrderStatus.RECEIVED).save()
+        db.session.expire_all()
+        expected = [json.loads(dumps(order.serialize())) for order in Order.query.order_by(Order.id)]
+        order_rows = []
+        queries = self._count_queries(lambda: order_rows.extend(
+            Order.fetch_item_rows(Order.fetch_rows(Order.query.order_by(Order.id)))))
+        self.assertEqual(queries, 2)
+        self.assertEqual(json.loads(dumps(order_rows)), expected)
+
+    def test_stream_orders_in_batches(self):
+        """ Stream orders with their items a batch at a time """
+        self._make_orders(5)
+        db.session.expire_all()
+        order_rows = list(Order.stream(batch_size=2))
+        self.assertEqual(len(order_rows), 5)
+        self.assertEqual([row['id'] for row in order_rows], sorted(row['id'] for row in order_rows))
+        for order_row in order_rows:
+            self.assertEqual(len(order_row['order_items']), 2)
+            self.assertEqual(order_row['total'], 366)
+
+    def test_preloaded_items_expire_on_commit(self):
+        """ Preloaded items are discarded once the order is saved """
+        self._make_orders(1)
+        order = Order.all()[0]
+        self.assertEqual(len(order.get_order_items()), 2)
+        order.order_items.append(OrderItem(product_id=3, name="Soap", quantity=1, price=2.50))
+        order.save()
+        self.assertEqual(len(order.serialize()['order_items']), 3)
+
 
 ######################################################################
 #   M A I N
@@ -0,0 +1,139 @@
+"""
+Test cases for the monthly partitions of the order table
+Test cases can be run with:
+  pytest
+  coverage report -m
+"""
+
+import unittest
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect
+
+from app import app, partitions
+from app.models import ArchivedOrder, Order, OrderItem, OrderStatus, OrderTombstone, db
+from .order_factory import save_order
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestPartitions(unittest.TestCase):
+    """ Test Cases for the partitioned order table """
+
+    def setUp(self):
+        Order.init_db(app)
+        db.drop_all()  # clean up the last tests
+        self._drop_detached_partitions()
+        self.assertTrue(partitions.create_tables(db.engine))
+        db.create_all()  # make the other tables
+        partitions.create_partitions(db.engine, months_ahead=2, now=datetime(2019, 4, 15))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self._drop_detached_partitions()
+
+    def _drop_detached_partitions(self):
+        names = db.session.execute("SELECT tablename FROM pg_tables WHERE tablename ~ '^order_y[0-9]{4}m[0-9]{2}'")
+        for name, in names.fetchall():
+            db.session.execute('DROP TABLE {}'.format(name))
+        db.session.commit()
+
+    def test_create_partitions(self):
+        """ Partitions are created for the coming months once """
+        self.assertTrue(partitions.is_partitioned(db.engine))
+        self.assertEqual(partitions.list_partitions(db.engine),
+                         [datetime(2019, 4, 1), datetime(2019, 5, 1), datetime(2019, 6, 1)])
+        self.assertEqual(partitions.create_partitions(db.engine, months_ahead=3, now=datetime(2019, 5, 31)),
+                         ['order_y2019m07', 'order_y2019m08'])
+        self.assertEqual(partitions.create_partitions(db.engine, months_ahead=3, now=datetime(2019, 5, 31)), [])
+        self.assertFalse(partitions.create_tables(db.engine))
+        # the partitioned table has the columns of the model
+        self.assertEqual(sorted(column['name'] for column in inspect(db.engine).get_columns('order')),
+                         sorted(Order.__table__.columns.keys()))
+
+    def test_create_partition_moves_default_orders(self):
+        """ Orders placed beyond the partitions move from the default partition to their month """
+        august = save_order(status=OrderStatus.DELIVERED, order_date=datetime(2019, 8, 10))
+        august_id, total = august.id, august.total
+        self.assertEqual(db.session.execute('SELECT id FROM order_default').fetchall(), [(august_id,)])
+        db.session.commit()  # creating a partition waits for the transactions reading the table
+        self.assertEqual(partitions.create_partitions(db.engine, months_ahead=3, now=datetime(2019, 5, 31)),
+                         ['order_y2019m07', 'order_y2019m08'])
+        self.assertEqual(db.session.execute('SELECT id FROM order_y2019m08').fetchall(), [(august_id,)])
+        self.assertEqual(db.session.execute('SELECT count(*) FROM order_default').scalar(), 0)
+        self.assertEqual(Order.find(august_id).total, total)
+        # the default partition is back for the next Orders beyond the partitions
+        save_order(order_date=datetime(2020, 1, 1))
+        self.assertEqual(db.session.execute('SELECT count(*) FROM order_default').scalar(), 1)
+
+    def test_models_on_partitioned_table(self):
+        """ Orders are saved, moved between months, archived and deleted with their items """
+        april = save_order(order_date=datetime(2019, 4, 2))
+        april_id, total = april.id, april.total
+        may_id = save_order(order_date=datetime(2019, 5, 2)).id
+        # in the default partition
+        old_id = save_order(status=OrderStatus.DELIVERED, order_date=datetime(2001, 1, 1)).id
+        self.assertEqual([order.id for order in Order.find_since(datetime(2019, 5, 1))], [may_id])
+
+        order = Order.find(april_id)
+        order.order_date = datetime(2019, 6, 2)
+        order.save()
+        self.assertEqual(Order.find(april_id).total, total)  # the items stay with the moved Order
+
+        self.assertEqual(Order.remove([may_id]), [may_id])
+        self.assertEqual(OrderItem.query.filter_by(order_id=may_id).count(), 0)
+        self.assertEqual(Order.archive_batch(datetime(2019, 1, 1), 10), [old_id])
+        self.assertEqual(ArchivedOrder.query.count(), 1)
+        self.assertEqual(OrderItem.query.filter_by(order_id=old_id).count(), 0)
+
+    def test_date_filter_prunes_partitions(self):
+        """ A query for recent Orders only scans the partitions of those months """
+        plan = '\n'.join(row[0] for row in db.session.execute(
+            'EXPLAIN SELECT id FROM "order" WHERE order_date >= :since', {'since': datetime(2019, 5, 1)}))
+        self.assertIn('order_y2019m05', plan)
+        self.assertIn('order_y2019m06', plan)
+        self.assertNotIn('order_y2019m04', plan)
+
+    def test_detach_partitions(self):
+        """ Detaching a month removes its Orders and keeps them with their items in their own tables """
+        april_id = save_order(order_date=datetime(2019, 4, 2)).id
+        may_id = save_order(order_date=datetime(2019, 5, 2)).id
+        item_count = OrderItem.query.filter_by(order_id=april_id).count()
+        db.session.commit()  # detaching waits for the transactions reading the table
+        self.assertEqual(partitions.detach_partitions(db.engine, datetime(2019, 5, 1)), ['order_y2019m04'])
+        self.assertEqual([order.id for order in Order.all()], [may_id])
+        self.assertEqual(OrderItem.query.filter_by(order_id=april_id).count(), 0)
+        self.assertEqual(db.session.execute('SELECT count(*) FROM order_y2019m04_item').scalar(), item_count)
+        self.assertEqual([tombstone.order_id for tombstone in OrderTombstone.query], [april_id])
+        self.assertEqual(partitions.list_partitions(db.engine), [datetime(2019, 5, 1), datetime(2019, 6, 1)])
+
+    def test_partition_orders_command(self):
+        """ flask partition-orders creates and detaches partitions """
+        result = app.test_cli_runner().invoke(args=['partition-orders', '--months-ahead', '0',
+                                                    '--detach-before', '2019-06'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Detached partition order_y2019m05', result.output)
+        self.assertEqual(partitions.list_partitions(db.engine)[0], datetime(2019, 6, 1))
+
+    def test_other_databases_are_not_partitioned(self):
+        """ SQLite keeps the plain tables """
+        engine = create_engine('sqlite://')
+        self.assertFalse(partitions.is_partitioned(engine))
+        self.assertFalse(partitions.create_tables(engine))
+        self.assertEqual(partitions.create_partitions(engine), [])
+        self.assertEqual(partitions.detach_partitions(engine, datetime(2019, 5, 1)), [])
+
+    def test_month_start(self):
+        """ Months are counted across years """
+        self.assertEqual(partitions.month_start(datetime(2019, 11, 30, 12), 3), datetime(2020, 2, 1))
+        self.assertEqual(partitions.month_start(datetime(2019, 1, 31), -1), datetime(2018, 12, 1))
+        self.assertEqual(partitions.partition_name(datetime(2019, 4, 1)), 'order_y2019m04')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+Test cases for archiving old Orders
+Test cases can be run with:
+  pytest
+  coverage report -m
+"""
+
+import unittest
+from datetime import datetime, timedelta
+
+from app import app
+from app.models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem, OrderStatus, OrderTombstone, db
+from app.retention import archive_orders
+from .order_factory import save_order
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRetention(unittest.TestCase):
+    """ Test Cases for the retention job """
+
+    def setUp(self):
+        Order.init_db(app)
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_archive_moves_old_final_orders(self):
+        """ Only old delivered and canceled Orders are moved, with their items """
+        old = datetime.utcnow() - timedelta(days=400)
+        old_ids = [save_order(status=OrderStatus.DELIVERED, order_date=old).id,
+                   save_order(status=OrderStatus.CANCELED, order_date=old).id]
+        kept_ids = [save_order(status=OrderStatus.SHIPPED, order_date=old).id,
+                    save_order(status=OrderStatus.DELIVERED, order_date=datetime.utcnow() - timedelta(days=10)).id]
+        item_count = OrderItem.query.filter_by(order_id=old_ids[0]).count()
+        result = archive_orders(older_than_days=365)
+        self.assertEqual((result['archived'], result['batches'], result['done']), (2, 1, True))
+        self.assertEqual(sorted(order.id for order in Order.all()), kept_ids)
+        self.assertEqual(OrderItem.query.filter(OrderItem.order_id.in_(old_ids)).count(), 0)
+
+        archived = ArchivedOrder.query.order_by(ArchivedOrder.id).all()
+        self.assertEqual([(order.id, order.status) for order in archived],
+                         [(old_ids[0], OrderStatus.DELIVERED), (old_ids[1], OrderStatus.CANCELED)])
+        self.assertIsNotNone(archived[0].archived_at)
+        self.assertEqual(ArchivedOrderItem.query.filter_by(order_id=old_ids[0]).count(), item_count)
+        # the change feed lists the archived Orders as deleted
+        self.assertEqual(sorted(tombstone.order_id for tombstone in OrderTombstone.query), old_ids)
+
+    def test_archive_in_batches(self):
+        """ Orders are archived in bounded batches and the job stops after max_batches """
+        for _ in range(5):
+            save_order(status=OrderStatus.DELIVERED, order_date=datetime.utcnow() - timedelta(days=400))
+        result = archive_orders(older_than_days=365, batch_size=2, max_batches=2)
+        self.assertEqual((result['archived'], result['batches'], result['done']), (4, 2, False))
+        archived_ids = []
+        result = archive_orders(older_than_days=365, batch_size=2, on_batch=archived_ids.append)
+        self.assertEqual((result['archived'], result['batches'], result['done']), (1, 1, True))
+        self.assertEqual([len(order_ids) for order_ids in archived_ids], [1])
+        self.assertEqual(Order.query.count(), 0)
+        self.assertEqual(ArchivedOrder.query.count(), 5)
+
+    def test_archive_command(self):
+        """ The archive-orders command archives every old Order """
+        for _ in range(3):
+            save_order(status=OrderStatus.CANCELED, order_date=datetime.utcnow() - timedelta(days=40))
+        result = app.test_cli_runner().invoke(args=['archive-orders', '--older-than-days', '30', '--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Archived 3 orders', result.output)
+        self.assertEqual(ArchivedOrder.query.count(), 3)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
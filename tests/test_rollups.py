@@ -0,0 +1,85 @@
+"""
+Test cases for the daily Order rollups
+Test cases can be run with:
+  pytest
+  coverage report -m
+"""
+
+import unittest
+from datetime import date, datetime
+from unittest.mock import patch
+
+from app import app
+from app.models import Order, OrderRollup, OrderRollupState, OrderStatus, db
+from app.rollups import refresh_rollups
+from .order_factory import save_order
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRollups(unittest.TestCase):
+    """ Test Cases for the daily Order rollups """
+
+    def setUp(self):
+        Order.init_db(app)
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def _rollups(self):
+        return [(rollup.day, rollup.status, rollup.order_count, round(rollup.revenue, 2))
+                for rollup in OrderRollup.find_range(date(2019, 1, 1), date(2019, 12, 31))]
+
+    def test_first_refresh_computes_every_day(self):
+        """ The first refresh computes the rollups of every day, archived Orders included """
+        orders = [save_order(status=OrderStatus.RECEIVED, order_date=datetime(2019, 4, 1)),
+                  save_order(status=OrderStatus.RECEIVED, order_date=datetime(2019, 4, 1)),
+                  save_order(status=OrderStatus.DELIVERED, order_date=datetime(2019, 4, 2)),
+                  save_order(status=OrderStatus.CANCELED, order_date=datetime(2019, 4, 3))]
+        totals = [order.total for order in orders]
+        Order.archive_batch(datetime(2019, 4, 3), 10)
+        self.assertIsNone(OrderRollupState.current_watermark())
+        self.assertIsNone(refresh_rollups())
+        self.assertEqual(self._rollups(), [(date(2019, 4, 1), OrderStatus.RECEIVED, 2, round(totals[0] + totals[1], 2)),
+                                           (date(2019, 4, 2), OrderStatus.DELIVERED, 1, totals[2]),
+                                           (date(2019, 4, 3), OrderStatus.CANCELED, 1, totals[3])])
+        self.assertIsNotNone(OrderRollupState.current_watermark())
+
+    @patch('app.rollups.ROLLUP_OVERLAP', 0)
+    def test_refresh_recomputes_changed_days(self):
+        """ Later refreshes only recompute the days Orders were added to, changed on or left """
+        first, second, third, moved = [save_order(status=OrderStatus.RECEIVED, order_date=datetime(2019, 4, day))
+                                       for day in range(1, 5)]
+        totals = [order.total for order in (first, third, moved)]
+        refresh_rollups()
+        self.assertEqual(refresh_rollups(), 0)
+
+        Order.change_status([first.id], OrderStatus.PROCESSING)
+        Order.remove([second.id])
+        order = Order.find(moved.id)
+        order.update({'order_date': '2019-04-05'}, partial=True)
+        order.save()
+        self.assertEqual(refresh_rollups(), 4)
+        self.assertEqual(self._rollups(), [(date(2019, 4, 1), OrderStatus.PROCESSING, 1, totals[0]),
+                                           (date(2019, 4, 3), OrderStatus.RECEIVED, 1, totals[1]),
+                                           (date(2019, 4, 5), OrderStatus.RECEIVED, 1, totals[2])])
+        self.assertEqual(refresh_rollups(), 0)
+
+    def test_refresh_rollups_command(self):
+        """ flask refresh-rollups refreshes the rollups """
+        save_order(order_date=datetime(2019, 4, 1))
+        result = app.test_cli_runner().invoke(args=['refresh-rollups'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Refreshed the rollups of all days', result.output)
+        self.assertEqual(len(self._rollups()), 1)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
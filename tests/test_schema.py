@@ -0,0 +1,94 @@
+"""
+Test cases for the payload validation
+Test cases can be run with:
+  pytest
+  coverage report -m
+"""
+
+import unittest
+from datetime import datetime
+
+from app import schema
+
+ITEM_SCHEMA = schema.Schema(required={'name': schema.string(10), 'quantity': schema.integer(1)},
+                            optional={'price': schema.number(0)})
+ORDER_SCHEMA = schema.Schema(required={'status': schema.choice(['open', 'closed']),
+                                       'items': schema.list_of(ITEM_SCHEMA)},
+                             optional={'order_date': schema.iso_datetime})
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSchema(unittest.TestCase):
+    """ Payload Validation Tests """
+
+    def test_validate_converts_values(self):
+        """ Valid payloads are converted, numeric strings included """
+        clean, errors = ORDER_SCHEMA.validate({'status': 'open', 'order_date': '2019-04-01T12:30:05.5',
+                                               'items': [{'name': 'Bar', 'quantity': '3', 'price': '1.50'}]})
+        self.assertEqual(errors, [])
+        self.assertEqual(clean, {'status': 'open', 'order_date': datetime(2019, 4, 1, 12, 30, 5, 500000),
+                                 'items': [{'name': 'Bar', 'quantity': 3, 'price': 1.5}]})
+
+    def test_validate_collects_every_error(self):
+        """ Every invalid and missing field is reported at once """
+        _, errors = ORDER_SCHEMA.validate({'status': 'lost', 'order_date': 'yesterday',
+                                           'items': [{'name': 'Bar', 'quantity': 0, 'price': 'free'},
+                                                     'Baz', {'name': 'x' * 11, 'quantity': True}]})
+        self.assertEqual(errors, ['status must be one of closed, open',
+                                  'items[0].quantity must be at least 1',
+                                  'items[0].price must be a number',
+                                  'items[1] must be an object',
+                                  'items[2].name must be at most 10 characters',
+                                  'items[2].quantity must be an integer',
+                                  'order_date must be an ISO 8601 date'])
+
+    def test_validate_missing_fields(self):
+        """ Missing, None and empty required fields are reported unless partial """
+        _, errors = ORDER_SCHEMA.validate({'status': None, 'items': ''})
+        self.assertEqual(errors, ['missing status', 'missing items'])
+        clean, errors = ORDER_SCHEMA.validate({'status': 'closed'}, partial=True)
+        self.assertEqual((clean, errors), ({'status': 'closed'}, []))
+        _, errors = ORDER_SCHEMA.validate('not an object')
+        self.assertEqual(errors, ['body of request must be an object'])
+        _, errors = ORDER_SCHEMA.validate({'status': 'open', 'items': {}})
+        self.assertEqual(errors, ['items must be a list'])
+
+    def test_number_rejects_non_finite(self):
+        """ NaN and infinity are not valid numbers """
+        check = schema.number()
+        self.assertRaises(ValueError, check, 'nan')
+        self.assertRaises(ValueError, check, float('inf'))
+        self.assertRaises(ValueError, check, None)
+        self.assertEqual(check(2), 2.0)
+
+    def test_integer_bounds(self):
+        """ Integers are checked against their minimum and maximum """
+        check = schema.integer(minimum=1, maximum=10)
+        self.assertEqual(check('10'), 10)
+        self.assertRaises(ValueError, check, 0)
+        self.assertRaises(ValueError, check, 11)
+
+    def test_list_of_values(self):
+        """ Lists of values are checked element by element and by length """
+        check = schema.list_of_values(schema.integer(minimum=1), max_length=3)
+        self.assertEqual(check([1, '2'], 'ids'), ([1, 2], []))
+        self.assertEqual(check([1, 0, 'x'], 'ids')[1], ['ids[1] must be at least 1', 'ids[2] must be an integer'])
+        self.assertEqual(check([], 'ids')[1], ['ids must be a non-empty list'])
+        self.assertEqual(check([1, 2, 3, 4], 'ids')[1], ['ids must have at most 3 elements'])
+
+    def test_parse_datetime(self):
+        """ ISO 8601 dates skip dateutil, other formats fall back to it """
+        self.assertEqual(schema.parse_datetime('2019-04-01'), datetime(2019, 4, 1))
+        self.assertEqual(schema.parse_datetime('2019-04-01 08:15'), datetime(2019, 4, 1, 8, 15))
+        self.assertEqual(schema.parse_datetime('April 1 2019'), datetime(2019, 4, 1))
+        self.assertRaises(ValueError, schema.iso_datetime, '2019-13-01')
+        self.assertRaises(ValueError, schema.iso_datetime, 20190401)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+Test cases for the JSON encoding
+Test cases can be run with:
+  pytest
+  coverage report -m
+"""
+
+import json
+import unittest
+from datetime import datetime, date
+from unittest.mock import patch
+
+from app import serializers
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSerializers(unittest.TestCase):
+    """ JSON Encoding Tests """
+
+    def test_dumps_dates(self):
+        """ Dates are encoded as ISO 8601 strings """
+        data = {'order_date': datetime(2019, 4, 1, 12, 30, 5, 123), 'day': date(2019, 4, 1)}
+        self.assertEqual(json.loads(serializers.dumps(data)),
+                         {'order_date': '2019-04-01T12:30:05.000123', 'day': '2019-04-01'})
+
+    def test_dumps_stdlib_fallback(self):
+        """ The standard library encoder is compact and rejects unknown types """
+        with patch('app.serializers.orjson', None):
+            encoded = serializers.dumps({'id': 1, 'order_items': [{'price': 1.5}],
+                                         'order_date': datetime(2019, 4, 1)})
+            self.assertEqual(encoded, b'{"id":1,"order_items":[{"price":1.5}],"order_date":"2019-04-01T00:00:00"}')
+            self.assertRaises(TypeError, serializers.dumps, {'bad': object()})
+
+    def test_json_response(self):
+        """ Responses are sent as application/json """
+        response = serializers.json_response([{'id': 1}], 200, {'X-Test': 'yes'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.headers['X-Test'], 'yes')
+        self.assertEqual(json.loads(response.get_data()), [{'id': 1}])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
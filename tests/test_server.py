@@ -8,6 +8,7 @@ Test cases can be run with the following:
 
 import json
 import logging
+import threading
 import unittest
 from datetime import datetime, date, timedelta
 from unittest.mock import patch
@@ -15,7 +16,7 @@ from unittest.mock import patch
 from flask_api import status  # HTTP Status Codes
 
 import app.service as service
-from app.models import Order, OrderItem, db, OrderStatus
+from app.models import Order, OrderItem, OrderEvent, db, OrderStatus
 from .order_factory import OrderFactory
 
 
@@ -42,17 +43,18 @@ class TestOrderServer(unittest.TestCase):
         service.init_db()
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
+        service.order_cache.clear()
         self.app = service.app.test_client()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
 
-    def _create_orders(self, count):
+    def _create_orders(self, count, **kwargs):
         """ Factory method to create orders in bulk """
         orders = []
         for _ in range(count):
-            test_order = OrderFactory()
+            test_order = OrderFactory(**kwargs)
             resp = self.app.post('/orders',
                                  json=test_order.serialize(),
                                  content_type='application/json')
@@ -84,6 +86,113 @@ class TestOrderServer(unittest.TestCase):
         resp = self.app.get('/orders/0')
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_order_cached(self):
+        """ Get a single order twice and hit the cache the second time """
+        test_order = self._create_orders(1)[0]
+        before = self.app.get('/orders/cache').get_json()
+        with patch('app.service.Order.find_with_items', wraps=Order.find_with_items) as find_mock:
+            for _ in range(2):
+                resp = self.app.get('/orders/{}'.format(test_order.id))
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(resp.get_json()['id'], test_order.id)
+            self.assertEqual(find_mock.call_count, 1)
+        after = self.app.get('/orders/cache').get_json()
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 1)
+
+    def test_cache_invalidated_by_writes(self):
+        """ Updates, cancels and deletes are visible through the cache """
+        test_order = self._create_orders(1, status=OrderStatus.RECEIVED)[0]
+        url = '/orders/{}'.format(test_order.id)
+        order = self.app.get(url).get_json()
+        order['status'] = OrderStatus.PROCESSING
+        resp = self.app.put(url, json=order, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(url).get_json()['status'], OrderStatus.PROCESSING)
+
+        resp = self.app.put(url + '/cancel', content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(url).get_json()['status'], OrderStatus.CANCELED)
+
+        resp = self.app.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_order_not_modified(self):
+        """ Get an order with If-None-Match and If-Modified-Since """
+        test_order = self._create_orders(1)[0]
+        url = '/orders/{}'.format(test_order.id)
+        resp = self.app.get(url)
+        etag = resp.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        self.assertIsNotNone(resp.headers.get('Last-Modified'))
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        # the cache misses still honor the conditional headers
+        service.order_cache.clear()
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get(url, headers={'If-Modified-Since': 'Fri, 31 Dec 9999 23:59:59 GMT'})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get(url, headers={'If-None-Match': '"stale"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_update_order_if_match(self):
+        """ Update an order only if it has not changed since it was read """
+        test_order = self._create_orders(1, status=OrderStatus.RECEIVED)[0]
+        url = '/orders/{}'.format(test_order.id)
+        resp = self.app.get(url)
+        etag = resp.headers['ETag']
+        order = resp.get_json()
+        order['status'] = OrderStatus.PROCESSING
+        resp = self.app.put(url, json=order, content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        # a second writer with the old ETag loses
+        resp = self.app.put(url, json=order, content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url + '/cancel', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url + '/cancel', headers={'If-Match': self.app.get(url).headers['ETag']})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_update_order_if_match_concurrent(self):
+        """ A writer with an ETag that another transaction is changing waits for it and loses """
+        test_order = self._create_orders(1, status=OrderStatus.RECEIVED)[0]
+        url = '/orders/{}'.format(test_order.id)
+        resp = self.app.get(url)
+        etag = resp.headers['ETag']
+        order = resp.get_json()
+        db.session.remove()
+        # another writer has changed the Order but not committed yet
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        connection.execute('UPDATE "order" SET customer_id = customer_id + 1, last_updated = now() WHERE id = %s',
+                           test_order.id)
+        timer = threading.Timer(0.5, transaction.commit)
+        timer.start()
+        try:
+            resp = self.app.put(url, json=order, content_type='application/json', headers={'If-Match': etag})
+        finally:
+            timer.join()
+            connection.close()
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        service.order_cache.clear()  # the other writer did not invalidate it
+        self.assertEqual(self.app.get(url).get_json()['customer_id'], order['customer_id'] + 1)
+
+    def test_get_order_list_not_modified(self):
+        """ Get the order list with If-None-Match """
+        orders = self._create_orders(3)
+        resp = self.app.get('/orders')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/orders', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.delete('/orders/{}'.format(orders[0].id))
+        resp = self.app.get('/orders', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+
     def test_create_order(self):
         """ Create a new Order """
         test_order_item = OrderItem(product_id=1, name='Test Item', quantity=10, price=69.00)
@@ -114,10 +223,54 @@ class TestOrderServer(unittest.TestCase):
         self.assertEqual(new_order['customer_id'], test_order.customer_id, "Customer Id does not match")
         self.assertEqual(len(new_order['order_items']), len(test_order.order_items.all()), "Order items don't match")
 
+    def test_create_orders_bulk(self):
+        """ Create many Orders at once """
+        test_orders = [OrderFactory() for _ in range(3)]
+        resp = self.app.post('/orders/bulk',
+                             json=[order.serialize() for order in test_orders],
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        results = resp.get_json()
+        self.assertEqual([result['index'] for result in results], [0, 1, 2])
+        for result, test_order in zip(results, test_orders):
+            resp = self.app.get(result['location'])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            new_order = resp.get_json()
+            self.assertEqual(new_order['id'], result['id'])
+            self.assertEqual(new_order['customer_id'], test_order.customer_id)
+            self.assertEqual(len(new_order['order_items']), len(test_order.order_items.all()))
+
+    def test_create_orders_bulk_ndjson(self):
+        """ Create many Orders from newline delimited JSON """
+        test_orders = [OrderFactory() for _ in range(2)]
+        body = '\n'.join(json.dumps(order.serialize(), default=str) for order in test_orders)
+        resp = self.app.post('/orders/bulk', data=body, content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(resp.get_json()), 2)
+        resp = self.app.get('/orders')
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_create_orders_bulk_bad_request(self):
+        """ Reject the whole batch when any Order is invalid """
+        good_order = OrderFactory().serialize()
+        bad_order = dict(status=OrderStatus.RECEIVED)
+        resp = self.app.post('/orders/bulk',
+                             json=[good_order, bad_order],
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = resp.get_json()['errors']
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]['index'], 1)
+        resp = self.app.get('/orders')
+        self.assertEqual(len(resp.get_json()), 0)
+
+        resp = self.app.post('/orders/bulk', json=good_order, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_order(self):
         """ Update an existing Order """
         # create a order to update
-        test_order = OrderFactory()
+        test_order = OrderFactory(status=OrderStatus.PROCESSING)
         resp = self.app.post('/orders',
                              json=test_order.serialize(),
                              content_type='application/json')
@@ -133,6 +286,40 @@ class TestOrderServer(unittest.TestCase):
         updated_order = resp.get_json()
         self.assertEqual(updated_order['status'], OrderStatus.SHIPPED)
 
+    def test_update_order_keeps_item_ids(self):
+        """ Update an Order without rewriting its unchanged items """
+        test_order = self._create_orders(1)[0]
+        url = '/orders/{}'.format(test_order.id)
+        order = self.app.get(url).get_json()
+        order['order_items'][0]['quantity'] += 1
+        resp = self.app.put(url, json=order, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        updated_order = resp.get_json()
+        self.assertEqual([item['id'] for item in updated_order['order_items']],
+                         [item['id'] for item in order['order_items']])
+        self.assertEqual(updated_order['order_items'][0]['quantity'], order['order_items'][0]['quantity'])
+
+    def test_patch_order(self):
+        """ Patch the status of an Order """
+        test_order = self._create_orders(1, status=OrderStatus.SHIPPED)[0]
+        url = '/orders/{}'.format(test_order.id)
+        order = self.app.get(url).get_json()
+        resp = self.app.patch(url, json={'status': OrderStatus.DELIVERED}, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        patched_order = resp.get_json()
+        self.assertEqual(patched_order['status'], OrderStatus.DELIVERED)
+        self.assertEqual(patched_order['customer_id'], order['customer_id'])
+        self.assertEqual(patched_order['order_items'], order['order_items'])
+
+        resp = self.app.patch('/orders/0', json={'status': OrderStatus.DELIVERED}, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        # a delivered Order cannot go back
+        resp = self.app.patch(url, json={'status': OrderStatus.RECEIVED}, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.app.get(url).get_json()['status'], OrderStatus.DELIVERED)
+        resp = self.app.patch(url, json={'order_items': [{'product_id': 1}]}, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_order_not_found(self):
         """ Update an order that is not found """
         test_order = OrderFactory()
@@ -209,15 +396,249 @@ class TestOrderServer(unittest.TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 5)
 
+    def test_query_order_list_by_combined_filters(self):
+        """ Query Orders by customer, status and date range together """
+        orders = self._create_orders(10)
+        test_order = orders[0]
+        old_order = OrderFactory(customer_id=test_order.customer_id, status=test_order.status)
+        old_order.order_date = datetime.today() - timedelta(days=300)
+        resp = self.app.post('/orders', json=old_order.serialize(), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        matching = [order for order in orders
+                    if order.customer_id == test_order.customer_id and order.status == test_order.status]
+        orders_since = date.today() - timedelta(days=30)
+        resp = self.app.get('/orders', query_string={'customer_id': test_order.customer_id,
+                                                     'status': test_order.status,
+                                                     'orders_since': orders_since.strftime('%Y-%m-%d'),
+                                                     'orders_until': date.today().strftime('%Y-%m-%d')})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(sorted(order['id'] for order in data), sorted(order.id for order in matching))
+
+        # only the old order is placed before the date range
+        resp = self.app.get('/orders', query_string={'customer_id': test_order.customer_id,
+                                                     'orders_until': orders_since.strftime('%Y-%m-%d')})
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['customer_id'], test_order.customer_id)
+
+    def test_query_order_list_bad_filters(self):
+        """ Reject badly formatted filters """
+        resp = self.app.get('/orders', query_string='orders_since=yesterday')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/orders', query_string='customer_id=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/orders', query_string='orders_until=9999-12-31')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_stats(self):
+        """ Get the order statistics """
+        orders = self._create_orders(5)
+        resp = self.app.get('/orders/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        stats = resp.get_json()
+        self.assertEqual(sum(row['count'] for row in stats['by_status']), 5)
+        revenue = sum(order.total for order in orders)
+        self.assertAlmostEqual(sum(row['revenue'] for row in stats['by_status']), revenue, places=2)
+        self.assertIn('by_day', stats)
+        self.assertIn('by_customer', stats)
+        self.assertIn('top_products', stats)
+
+        resp = self.app.get('/orders/stats', query_string='top=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/orders/stats', query_string='top=-1')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/orders/stats', query_string='top=0')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['top_products'], [])
+
+    def test_get_order_total(self):
+        """ Serialized orders include their total """
+        test_order = self._create_orders(1)[0]
+        data = self.app.get('/orders/{}'.format(test_order.id)).get_json()
+        self.assertAlmostEqual(data['total'], sum(item['price'] * item['quantity'] for item in data['order_items']),
+                               places=2)
+
+    def test_get_order_list_fields(self):
+        """ List only some fields of the Orders without querying their items """
+        orders = self._create_orders(3)
+        with patch('app.service.Order.fetch_item_rows') as items_mock:
+            resp = self.app.get('/orders', query_string='fields=id,status,order_date')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            items_mock.assert_not_called()
+        self.assertEqual([sorted(order) for order in data], [['id', 'order_date', 'status']] * 3)
+        self.assertEqual([order['id'] for order in data], [order.id for order in orders])
+
+        resp = self.app.get('/orders', query_string='fields=id,total')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        for order, test_order in zip(resp.get_json(), orders):
+            self.assertEqual(sorted(order), ['id', 'total'])
+            self.assertAlmostEqual(order['total'], test_order.total, places=2)
+
+        resp = self.app.get('/orders', query_string='fields=id&include=items&limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(sorted(data[0]), ['id', 'order_items'])
+        self.assertIn('X-Next-Cursor', resp.headers)
+
+        resp = self.app.get('/orders', query_string='fields=id,status&stream=1')
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual([sorted(json.loads(line)) for line in lines], [['id', 'status']] * 3)
+
+    def test_get_order_fields(self):
+        """ Get only some fields of an Order """
+        test_order = self._create_orders(1)[0]
+        url = '/orders/{}'.format(test_order.id)
+        full_etag = self.app.get(url).headers['ETag']
+        resp = self.app.get(url, query_string='fields=id,status')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {'id': test_order.id, 'status': test_order.status})
+        self.assertNotEqual(resp.headers['ETag'], full_etag)
+        # projected from the cache
+        resp = self.app.get(url, query_string='fields=customer_id')
+        self.assertEqual(resp.get_json(), {'customer_id': test_order.customer_id})
+
+        service.order_cache.clear()
+        with patch('app.service.Order.fetch_item_rows') as items_mock:
+            resp = self.app.get(url, query_string='fields=status')
+            self.assertEqual(resp.get_json(), {'status': test_order.status})
+            items_mock.assert_not_called()
+        etag = resp.headers['ETag']
+        resp = self.app.get(url, query_string='fields=status', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get(url, query_string='fields=id&include=items')
+        self.assertEqual(len(resp.get_json()['order_items']), len(test_order.order_items.all()))
+        resp = self.app.get('/orders/0', query_string='fields=id')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_order_bad_fields(self):
+        """ Reject unknown fields and includes """
+        resp = self.app.get('/orders', query_string='fields=id,password')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/orders', query_string='include=customers')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for fields in ('', ' , '):
+            resp = self.app.get('/orders', query_string={'fields': fields})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_list_paginated(self):
+        """ Page through the Orders with a cursor """
+        orders = self._create_orders(7)
+        seen = []
+        resp = self.app.get('/orders', query_string='limit=3')
+        while True:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertLessEqual(len(data), 3)
+            seen.extend(order['id'] for order in data)
+            link = resp.headers.get('Link')
+            if not link:
+                break
+            self.assertIn('rel="next"', link)
+            resp = self.app.get('/orders', query_string={'limit': 3, 'cursor': resp.headers['X-Next-Cursor']})
+        self.assertEqual(sorted(seen), sorted(order.id for order in orders))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_list_customer_orders(self):
+        """ Page through the Orders of a customer, newest first """
+        orders = self._create_orders(6)
+        customer_id = orders[0].customer_id
+        expected = sorted(((order.order_date, order.id) for order in orders if order.customer_id == customer_id),
+                          reverse=True)
+        seen = []
+        resp = self.app.get('/customers/{}/orders'.format(customer_id), query_string='limit=1')
+        while True:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertTrue(all(order['customer_id'] == customer_id for order in data))
+            self.assertTrue(all('order_items' in order for order in data))
+            seen.extend(order['id'] for order in data)
+            if 'Link' not in resp.headers:
+                break
+            self.assertIn('/customers/{}/orders?'.format(customer_id), resp.headers['Link'])
+            resp = self.app.get('/customers/{}/orders'.format(customer_id),
+                                query_string={'limit': 1, 'cursor': resp.headers['X-Next-Cursor']})
+        self.assertEqual(seen, [order_id for _, order_id in expected])
+
+        resp = self.app.get('/customers/{}/orders/summary'.format(customer_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        summary = resp.get_json()
+        self.assertEqual(summary['order_count'], len(expected))
+        self.assertAlmostEqual(summary['lifetime_total'],
+                               sum(order.total for order in orders if order.customer_id == customer_id), places=2)
+
+    def test_get_order_list_paginated_by_status(self):
+        """ Page through the Orders with a status filter """
+        orders = self._create_orders(10)
+        test_status = orders[0].status
+        status_ids = [order.id for order in orders if order.status == test_status]
+        resp = self.app.get('/orders', query_string={'status': test_status, 'limit': 1})
+        seen = []
+        while True:
+            data = resp.get_json()
+            for order in data:
+                self.assertEqual(order['status'], test_status)
+            seen.extend(order['id'] for order in data)
+            if 'X-Next-Cursor' not in resp.headers:
+                break
+            resp = self.app.get('/orders', query_string={'status': test_status, 'limit': 1,
+                                                         'cursor': resp.headers['X-Next-Cursor']})
+        self.assertEqual(sorted(seen), sorted(status_ids))
+
+    def test_get_order_list_bad_page_params(self):
+        """ Reject bad limits and cursors """
+        resp = self.app.get('/orders', query_string='limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/orders', query_string='limit=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/orders', query_string='cursor=not-a-cursor')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_order_list(self):
+        """ Stream the Orders as NDJSON """
+        orders = self._create_orders(5)
+        resp = self.app.get('/orders', query_string='stream=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        data = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([order['id'] for order in data], [order.id for order in orders])
+        for order in data:
+            self.assertGreater(len(order['order_items']), 0)
+
+    def test_stream_order_list_by_accept_header(self):
+        """ Stream the Orders with a status filter using the Accept header """
+        orders = self._create_orders(10)
+        test_status = orders[0].status
+        resp = self.app.get('/orders',
+                            query_string={'status': test_status},
+                            headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(data), len([order for order in orders if order.status == test_status]))
+        for order in data:
+            self.assertEqual(order['status'], test_status)
+
     def test_cancel_order(self):
         """ Cancel a single Order """
-        test_order = self._create_orders(1)[0]
+        test_order = self._create_orders(1, status=OrderStatus.PROCESSING)[0]
         resp = self.app.put('/orders/{}/cancel'.format(test_order.id),
                             content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         cancelled_order = resp.get_json()
         self.assertEqual(cancelled_order['status'], OrderStatus.CANCELED)
 
+    def test_cancel_shipped_order(self):
+        """ Orders that were shipped, delivered or canceled cannot be canceled """
+        for order_status in (OrderStatus.SHIPPED, OrderStatus.DELIVERED, OrderStatus.CANCELED):
+            test_order = self._create_orders(1, status=order_status)[0]
+            resp = self.app.put('/orders/{}/cancel'.format(test_order.id),
+                                content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+            self.assertEqual(self.app.get('/orders/{}'.format(test_order.id)).get_json()['status'], order_status)
+
     def test_cancel_non_existing_order(self):
         """ Cancel an order that doesn't exist """
         resp = self.app.put('/orders/0/cancel', content_type='application/json')
@@ -241,12 +662,188 @@ class TestOrderServer(unittest.TestCase):
                              content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_bad_request_lists_errors(self):
+        """ Test a Bad Request lists every invalid field """
+        bad_order = {'customer_id': 1, 'status': 'lost',
+                     'order_items': [{'product_id': 1, 'name': 'AirPods', 'price': 'free'}]}
+        resp = self.app.post('/orders', json=bad_order, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()['errors'],
+                         ['status must be one of canceled, delivered, processing, received, shipped',
+                          'missing order_items[0].quantity',
+                          'order_items[0].price must be a number'])
+
+    def test_bad_request_integer_out_of_range(self):
+        """ Reject integers too large for the database """
+        order = OrderFactory().serialize()
+        order['order_items'][0]['quantity'] = 10 ** 12
+        resp = self.app.post('/orders', json=order, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()['errors'], ['order_items[0].quantity must be at most 2147483647'])
+
+        test_order = self._create_orders(1)[0]
+        order = test_order.serialize()
+        order['customer_id'] = 99999999999
+        resp = self.app.put('/orders/{}'.format(test_order.id), json=order, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()['errors'], ['customer_id must be at most 2147483647'])
+
+    def test_order_changes_record_events(self):
+        """ Creating, canceling and deleting an Order records events for the worker """
+        order = OrderFactory(status=OrderStatus.RECEIVED)
+        resp = self.app.post('/orders', json=order.serialize(), content_type='application/json')
+        order_id = resp.get_json()['id']
+        self.app.put('/orders/{}/cancel'.format(order_id))
+        self.app.delete('/orders/{}'.format(order_id))
+        events = OrderEvent.query.order_by(OrderEvent.id).all()
+        self.assertEqual([(event.order_id, event.event_type) for event in events],
+                         [(order_id, OrderEvent.CREATED), (order_id, OrderEvent.CANCELED),
+                          (order_id, OrderEvent.DELETED)])
+        resp = self.app.get('/orders/events')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {'pending': 3, 'failed': 0})
+
+    def test_change_orders_status(self):
+        """ Move many orders to a status, skipping the ones that may not move to it """
+        order_ids = []
+        for order_status in (OrderStatus.PROCESSING, OrderStatus.PROCESSING, OrderStatus.DELIVERED):
+            order = OrderFactory(status=order_status)
+            resp = self.app.post('/orders', json=order.serialize(), content_type='application/json')
+            order_ids.append(resp.get_json()['id'])
+        url = '/orders/{}'.format(order_ids[0])
+        self.assertEqual(self.app.get(url).get_json()['status'], OrderStatus.PROCESSING)  # cached
+
+        payload = {'ids': order_ids + [99999, order_ids[0]], 'status': OrderStatus.SHIPPED}
+        resp = self.app.post('/orders/status', json=payload, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {'status': OrderStatus.SHIPPED, 'changed': order_ids[:2],
+                                           'unchanged': [order_ids[2], 99999]})
+        self.assertEqual(self.app.get(url).get_json()['status'], OrderStatus.SHIPPED)
+        events = OrderEvent.query.filter_by(event_type=OrderEvent.UPDATED).order_by(OrderEvent.id).all()
+        self.assertEqual([(event.order_id, json.loads(event.payload)['status']) for event in events],
+                         [(order_ids[0], OrderStatus.SHIPPED), (order_ids[1], OrderStatus.SHIPPED)])
+
+        resp = self.app.post('/orders/status', json={'ids': ['x'], 'status': 'lost'}, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()['errors'],
+                         ['ids[0] must be an integer',
+                          'status must be one of canceled, delivered, processing, received, shipped'])
+
+    @patch.dict(service.app.config, {'ADMIN_TOKEN': 'secret'})
+    def test_archive_old_orders(self):
+        """ Archive old delivered orders in bounded batches """
+        order_ids = []
+        for _ in range(3):
+            order = OrderFactory(status=OrderStatus.DELIVERED, order_date=datetime(2010, 1, 1))
+            resp = self.app.post('/orders', json=order.serialize(), content_type='application/json')
+            order_ids.append(resp.get_json()['id'])
+        url = '/orders/{}'.format(order_ids[0])
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_200_OK)  # cached
+
+        # the endpoint needs the admin token
+        resp = self.app.post('/orders/archive')
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+        resp = self.app.post('/orders/archive', headers={'Authorization': 'Bearer guess'})
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_200_OK)
+
+        headers = {'Authorization': 'Bearer secret'}
+        resp = self.app.post('/orders/archive', json={'batch_size': 2, 'max_batches': 1},
+                             content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual((resp.get_json()['archived'], resp.get_json()['done']), (2, False))
+        resp = self.app.post('/orders/archive', headers=headers)
+        self.assertEqual((resp.get_json()['archived'], resp.get_json()['done']), (1, True))
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+        resp = self.app.post('/orders/archive', json={'older_than_days': 0}, content_type='application/json',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()['errors'], ['older_than_days must be at least 1'])
+        resp = self.app.post('/orders/archive', json={'older_than_days': 1000000000}, content_type='application/json',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()['errors'], ['older_than_days must be at most 36500'])
+
+    @patch.dict(service.app.config, {'ADMIN_TOKEN': None})
+    def test_archive_turned_off_without_admin_token(self):
+        """ Archiving over HTTP is refused when no admin token is set """
+        for headers in ({}, {'Authorization': 'Bearer '}, {'Authorization': 'Bearer None'}):
+            resp = self.app.post('/orders/archive', headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_get_order_rollups(self):
+        """ Get the order counts and revenue per day from the rollups """
+        for order_date in (datetime(2019, 4, 1, 9), datetime(2019, 4, 1, 17), datetime(2019, 4, 20)):
+            order = OrderFactory(status=OrderStatus.DELIVERED, order_date=order_date)
+            self.app.post('/orders', json=order.serialize(), content_type='application/json')
+        resp = self.app.get('/orders/rollups?from=2019-04-01&to=2019-04-10')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual((resp.get_json()['rollups'], resp.get_json()['watermark']), ([], None))
+
+        service.refresh_rollups()
+        data = self.app.get('/orders/rollups?from=2019-04-01&to=2019-04-10').get_json()
+        self.assertEqual(data['from'], '2019-04-01')
+        self.assertIsNotNone(data['watermark'])
+        self.assertEqual([(rollup['day'], rollup['status'], rollup['order_count']) for rollup in data['rollups']],
+                         [('2019-04-01', OrderStatus.DELIVERED, 2)])
+        self.assertEqual(len(self.app.get('/orders/rollups?from=2019-04-01&to=2019-04-30').get_json()['rollups']), 2)
+
+        resp = self.app.get('/orders/rollups?from=2018-01-01&to=2019-04-30')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/orders/rollups?from=April')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # the default range stops at the first possible day
+        resp = self.app.get('/orders/rollups?to=0001-01-05')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['from'], '0001-01-01')
+
+    @patch('app.service.CHANGE_FEED_DELAY', 0)
+    def test_list_order_changes(self):
+        """ Sync the changed and deleted orders page by page with the change feed """
+        order_ids = []
+        for _ in range(3):
+            order = OrderFactory(status=OrderStatus.RECEIVED)
+            resp = self.app.post('/orders', json=order.serialize(), content_type='application/json')
+            order_ids.append(resp.get_json()['id'])
+        resp = self.app.get('/orders/changes?limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([(change['type'], change['id']) for change in data['changes']],
+                         [('upsert', order_ids[0]), ('upsert', order_ids[1])])
+        self.assertEqual(data['changes'][0]['order']['status'], OrderStatus.RECEIVED)
+        self.assertEqual(data['changes'][0]['order']['order_items'][0]['order_id'], order_ids[0])
+        self.assertTrue(data['has_more'])
+        self.assertIn('since=' + data['next'], resp.headers['Link'])
+        data = self.app.get('/orders/changes?limit=2&since=' + data['next']).get_json()
+        self.assertEqual([change['id'] for change in data['changes']], [order_ids[2]])
+        self.assertFalse(data['has_more'])
+
+        self.app.put('/orders/{}/cancel'.format(order_ids[0]))
+        self.app.delete('/orders/{}'.format(order_ids[1]))
+        token = data['next']
+        data = self.app.get('/orders/changes?fields=id,status&since=' + token).get_json()
+        self.assertEqual([(change['type'], change['id']) for change in data['changes']],
+                         [('upsert', order_ids[0]), ('delete', order_ids[1])])
+        self.assertEqual(data['changes'][0]['order'], {'id': order_ids[0], 'status': OrderStatus.CANCELED})
+        again = self.app.get('/orders/changes?since=' + data['next']).get_json()
+        self.assertEqual((again['changes'], again['next']), ([], data['next']))
+
+        resp = self.app.get('/orders/changes?since=bogus')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_order_changes_waits_for_settled_changes(self):
+        """ Changes younger than the feed delay are listed on a later call """
+        self._create_orders(1)
+        data = self.app.get('/orders/changes').get_json()
+        self.assertEqual((data['changes'], data['has_more']), ([], False))
+
     def test_method_not_allowed(self):
         """ Test a sending invalid http method """
         resp = self.app.post('/orders/1')
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
-    @patch('app.service.Order.all')
+    @patch('app.service.Order.fetch_rows')
     def test_unexpected_error(self, bad_request_mock):
         """ Test an unexpected error from Find All """
         bad_request_mock.side_effect = KeyError
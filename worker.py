@@ -0,0 +1,24 @@
+"""
+Order Event Worker
+Delivers the Order events recorded by the service to the configured sink
+(EVENT_SINK_URL or EVENT_SINK_PATH) until it receives SIGTERM or SIGINT
+"""
+
+import signal
+from app import app, service
+from app.events import EventDispatcher, EventWorker, sink_from_env
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    print("*******************************************")
+    print("   O R D E R   E V E N T   W O R K E R")
+    print("*******************************************")
+    service.initialize_logging()
+    worker = EventWorker(app, EventDispatcher(sink_from_env()))
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+    worker.start()
+    while worker.is_alive():
+        worker.join(1)